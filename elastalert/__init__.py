@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import copy
+import threading
 import time
 
 from elasticsearch import Elasticsearch
@@ -32,6 +33,7 @@ class ElasticSearchClient(Elasticsearch):
                                                   client_key=conf['client_key'])
         self._conf = copy.copy(conf)
         self._es_version = None
+        self._es_version_lock = threading.Lock()
 
     @property
     def conf(self):
@@ -46,14 +48,18 @@ class ElasticSearchClient(Elasticsearch):
         Returns the reported version from the Elasticsearch server.
         """
         if self._es_version is None:
-            for retry in range(3):
-                try:
-                    self._es_version = self.info()['version']['number']
-                    break
-                except TransportError:
-                    if retry == 2:
-                        raise
-                    time.sleep(3)
+            # Clients are shared between rules, make sure only one of them asks the server
+            with self._es_version_lock:
+                for retry in range(3):
+                    if self._es_version is not None:
+                        break
+                    try:
+                        self._es_version = self.info()['version']['number']
+                        break
+                    except TransportError:
+                        if retry == 2:
+                            raise
+                        time.sleep(3)
         return self._es_version
 
     def is_atleastfive(self):
@@ -88,6 +94,13 @@ class ElasticSearchClient(Elasticsearch):
         """
         return int(self.es_version.split(".")[0]) >= 7
 
+    def is_atleastseventwelve(self):
+        """
+        Returns True when the Elasticsearch server version >= 7.12
+        """
+        major, minor = list(map(int, self.es_version.split(".")[:2]))
+        return major > 7 or (major == 7 and minor >= 12)
+
     def resolve_writeback_index(self, writeback_index, doc_type):
         """ In ES6, you cannot have multiple _types per index,
         therefore we use self.writeback_index as the prefix for the actual
@@ -257,3 +270,66 @@ class ElasticSearchClient(Elasticsearch):
         if type(res) == list or type(res) == tuple:
             return res[1]
         return res
+
+    @query_params("expand_wildcards", "ignore_unavailable", "keep_alive", "preference", "routing")
+    def open_point_in_time(self, index=None, params=None):
+        """
+        Open a point in time that can be used in subsequent searches.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/point-in-time-api.html>`_
+        :arg index: A comma-separated list of index names to open point in time; use `_all`
+            or empty string to perform the operation on all indices
+        :arg expand_wildcards: Whether to expand wildcard expression to concrete
+            indices that are open, closed or both., default 'open', valid
+            choices are: 'open', 'closed', 'hidden', 'none', 'all'
+        :arg ignore_unavailable: Whether specified concrete indices should be
+            ignored when unavailable (missing or closed)
+        :arg keep_alive: Specific the time to live for the point in time
+        :arg preference: Specify the node or shard the operation should be
+            performed on (default: random)
+        :arg routing: Specific routing value
+        """
+        return self.transport.perform_request(
+            "POST", _make_path(index, "_pit"), params=params
+        )
+
+    @query_params()
+    def close_point_in_time(self, body=None, params=None):
+        """
+        Close a point in time
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/point-in-time-api.html>`_
+        :arg body: a point-in-time id to close
+        """
+        return self.transport.perform_request(
+            "DELETE", "/_pit", params=params, body=body
+        )
+
+    @query_params(
+        "_source",
+        "_source_excludes",
+        "_source_includes",
+        "allow_partial_search_results",
+        "size",
+        "track_total_hits",
+    )
+    def point_in_time_search(self, body=None, params=None):
+        """
+        Execute a search against a point in time opened with :meth:`open_point_in_time`.
+        The indices are those of the point in time, which must be given in the body as
+        ``{"pit": {"id": ..., "keep_alive": ...}}``, so none are put in the path.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/paginate-search-results.html#search-after>`_
+        :arg body: The search definition using the Query DSL
+        :arg _source: True or false to return the _source field or not, or a
+            list of fields to return
+        :arg _source_excludes: A list of fields to exclude from the returned
+            _source field
+        :arg _source_includes: A list of fields to extract and return from the
+            _source field
+        :arg allow_partial_search_results: Set to false to return an overall
+            failure if the request would produce partial results
+        :arg size: Number of hits to return (default: 10)
+        :arg track_total_hits: Indicate if the number of documents that match
+            the query should be tracked
+        """
+        return self.transport.perform_request(
+            "GET", "/_search", params=params, body=body
+        )
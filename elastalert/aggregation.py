@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+
+
+class AggregationBuffer(object):
+    """ The aggregated matches of a rule which could not be written to the writeback index, kept in memory
+    until the alert time of their aggregation.
+
+    Matches are grouped by aggregation key value, and a heap of alert times tells which groups are due
+    without looking at every match. Iterating over the buffer yields every match, grouped by key.
+    """
+
+    def __init__(self):
+        self._matches = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(matches) for matches in self._matches.values())
+
+    def __bool__(self):
+        return bool(self._matches)
+
+    def __iter__(self):
+        for matches in list(self._matches.values()):
+            for match in matches:
+                yield match
+
+    def add(self, aggregation_key_value, match, alert_time):
+        """ Buffers match until alert_time, the alert time of the aggregation of aggregation_key_value. """
+        if aggregation_key_value not in self._matches:
+            self._matches[aggregation_key_value] = []
+            self._push(alert_time, aggregation_key_value)
+        self._matches[aggregation_key_value].append(match)
+
+    def _push(self, alert_time, aggregation_key_value):
+        # The counter breaks ties without comparing keys, which may be None
+        heapq.heappush(self._heap, (alert_time, next(self._counter), aggregation_key_value))
+
+    def pop_due(self, now, alert_times):
+        """ Removes and returns (aggregation_key_value, matches) for every aggregation which was due before now.
+
+        :param alert_times: The current alert time of each aggregation key value, which takes precedence over
+            the alert time the matches were buffered with.
+        """
+        due = []
+        while self._heap and self._heap[0][0] < now:
+            alert_time, _, aggregation_key_value = heapq.heappop(self._heap)
+            if aggregation_key_value not in self._matches:
+                continue
+            current_alert_time = alert_times.get(aggregation_key_value, alert_time)
+            if current_alert_time != alert_time and not current_alert_time < now:
+                # The aggregation was moved to a later alert time
+                self._push(current_alert_time, aggregation_key_value)
+                continue
+            due.append((aggregation_key_value, self._matches.pop(aggregation_key_value)))
+        return due
+
+    def drain(self):
+        """ Removes and returns every buffered match. """
+        matches = list(self)
+        self._matches.clear()
+        self._heap = []
+        return matches
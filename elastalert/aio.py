@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import concurrent.futures
+import json
+import ssl
+import threading
+import warnings
+
+from elasticsearch.client import _make_path
+from elasticsearch.client.utils import _escape
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import HTTP_EXCEPTIONS
+from elasticsearch.exceptions import TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from .util import elastalert_logger
+
+try:
+    import aiohttp
+except ImportError:
+    # Installed with the async extra, without it the rules query on threads
+    aiohttp = None
+
+
+class AsyncElasticsearch(object):
+    """ An asyncio client for the search APIs used by the queries of rules, sending its requests with aiohttp.
+
+    It is created from the :class:`ElasticSearchClient` of a rule and connects to the same host with the same
+    TLS settings, headers, basic or bearer authentication and proxies from the environment. Like the transport
+    of that client, it sends GET bodies as ``send_get_body_as`` says, and retries requests which failed to
+    connect or were answered with one of its ``retry_on_status``. Other attributes, such as the version checks,
+    are those of that client. Requests signed for AWS are not supported, see :meth:`supports`.
+
+    :param client: The synchronous client of the rules using this client.
+    :param max_connections: The maximum number of requests in flight.
+    """
+
+    def __init__(self, client, max_connections=100):
+        conf = client.conf
+        self.client = client
+        self.url = 'http%s://%s:%s' % ('s' if conf['use_ssl'] else '', conf['es_host'], conf['es_port'])
+        if conf['es_url_prefix']:
+            self.url += '/' + conf['es_url_prefix'].strip('/')
+        self.timeout = conf['es_conn_timeout']
+        self.send_get_body_as = conf.get('send_get_body_as', 'GET')
+        self.max_connections = max_connections
+        self.max_retries = client.transport.max_retries
+        self.retry_on_status = client.transport.retry_on_status
+        self.retry_on_timeout = client.transport.retry_on_timeout
+        self.headers = {'content-type': 'application/json'}
+        if conf['http_auth']:
+            self.headers['authorization'] = 'Basic ' + base64.b64encode(conf['http_auth'].encode('utf-8')).decode('ascii')
+        if conf['headers']:
+            self.headers.update((name.lower(), value) for name, value in conf['headers'].items())
+
+        self.ssl = None
+        if conf['use_ssl']:
+            self.ssl = ssl.create_default_context(cafile=conf['ca_certs'])
+            if not conf['verify_certs']:
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+                if conf.get('ssl_show_warn', True):
+                    warnings.warn('Connecting to %s using SSL with verify_certs=False is insecure.' % (self.url))
+            if conf['client_cert']:
+                self.ssl.load_cert_chain(conf['client_cert'], conf['client_key'])
+
+        self.serializer = JSONSerializer()
+        self.requests = 0
+        # Created on the event loop by the first request
+        self._session = None
+
+    @staticmethod
+    def supports(client):
+        """ Returns whether the connection settings of client can be used by an AsyncElasticsearch. """
+        return aiohttp is not None and (client.conf['http_auth'] is None or isinstance(client.conf['http_auth'], str))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def perform_request(self, method, path, params=None, body=None):
+        """ Sends a request and returns its decoded response, raising the exceptions of the elasticsearch client. """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections, ssl=self.ssl),
+                                                  headers=self.headers, trust_env=True,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        # Escaped like the parameters of the synchronous client, which encodes them
+        params = dict((key, _escape(value)) for key, value in (params or {}).items() if value is not None)
+        params = dict((key, value.decode('utf-8') if isinstance(value, bytes) else value) for key, value in params.items())
+        data = self.serializer.dumps(body) if body is not None else None
+        if data is not None and method == 'GET' and self.send_get_body_as != 'GET':
+            if self.send_get_body_as == 'POST':
+                method = 'POST'
+            elif self.send_get_body_as == 'source':
+                params['source'] = data
+                data = None
+
+        for attempt in range(self.max_retries + 1):
+            # The same delays as the transport of the synchronous client, 0, 1, 3, 7 seconds...
+            await asyncio.sleep(2 ** attempt - 1)
+            try:
+                status, payload = await self._send(method, path, params, data)
+                if status not in self.retry_on_status or attempt == self.max_retries:
+                    break
+            except ConnectionTimeout:
+                if not self.retry_on_timeout or attempt == self.max_retries:
+                    raise
+            except ConnectionError:
+                if attempt == self.max_retries:
+                    raise
+        self.requests += 1
+
+        if not 200 <= status < 300:
+            error, info = payload, None
+            try:
+                info = json.loads(payload)
+                error = info.get('error', error)
+                if isinstance(error, dict) and 'type' in error:
+                    error = error['type']
+            except (ValueError, TypeError, AttributeError):
+                pass
+            raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error, info)
+        return json.loads(payload) if payload else {}
+
+    async def _send(self, method, path, params, data):
+        try:
+            async with self._session.request(method, self.url + path, params=params, data=data) as response:
+                return response.status, await response.text()
+        except asyncio.TimeoutError as e:
+            raise ConnectionTimeout('TIMEOUT', 'Request to %s timed out' % (self.url), e)
+        except aiohttp.ClientError as e:
+            raise ConnectionError('N/A', str(e), e)
+
+    async def search(self, index=None, body=None, **params):
+        return await self.perform_request('GET', _make_path(index, '_search'), params, body)
+
+    async def deprecated_search(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request('GET', _make_path(index, doc_type, '_search'), params, body)
+
+    async def count(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request('GET', _make_path(index, doc_type, '_count'), params, body)
+
+    async def scroll(self, scroll_id, scroll=None):
+        return await self.perform_request('GET', '/_search/scroll', body={'scroll_id': scroll_id, 'scroll': scroll})
+
+    async def clear_scroll(self, scroll_id):
+        return await self.perform_request('DELETE', '/_search/scroll', body={'scroll_id': [scroll_id]})
+
+    async def open_point_in_time(self, index=None, **params):
+        return await self.perform_request('POST', _make_path(index, '_pit'), params)
+
+    async def close_point_in_time(self, body=None):
+        return await self.perform_request('DELETE', '/_pit', body=body)
+
+    async def point_in_time_search(self, body=None, **params):
+        return await self.perform_request('GET', '/_search', params, body)
+
+    async def close(self):
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+
+class QueryEngine(object):
+    """ Runs coroutines, the queries of rules, on an asyncio event loop in a background thread, so that
+    the number of queries in flight is not bound by the number of threads.
+
+    Blocking work of the coroutines, such as alerting and the rule types processing hits, is handed to a
+    small pool of threads with ``loop.run_in_executor(None, ...)``.
+
+    :param max_connections: The maximum number of requests in flight to each Elasticsearch cluster.
+    :param threads: The number of threads running the blocking work of the coroutines.
+    """
+
+    def __init__(self, max_connections=100, threads=4):
+        self.max_connections = max_connections
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='elastalert-query-engine')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self._clients = {}
+        self._running = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='elastalert-query-engine', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def available():
+        """ Returns whether aiohttp, which the engine sends its queries with, is installed. """
+        return aiohttp is not None
+
+    def supports(self, client):
+        return AsyncElasticsearch.supports(client)
+
+    def client(self, client):
+        """ Returns the AsyncElasticsearch of the synchronous client, shared by every rule using that client. """
+        with self._lock:
+            if client not in self._clients:
+                self._clients[client] = AsyncElasticsearch(client, self.max_connections)
+            return self._clients[client]
+
+    def release(self, clients):
+        """ Closes the AsyncElasticsearch of each of the synchronous clients, which no rule uses anymore. """
+        with self._lock:
+            released = [self._clients.pop(client) for client in clients if client in self._clients]
+        for client in released:
+            asyncio.run_coroutine_threadsafe(client.close(), self.loop)
+
+    def submit(self, key, coro):
+        """ Runs coro on the event loop, unless the last coroutine submitted with the same key is still running.
+
+        :return: A concurrent.futures.Future of the result of coro, or None if it was not run.
+        """
+        with self._lock:
+            if key in self._running and not self._running[key].done():
+                coro.close()
+                return None
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+            self._running[key] = future
+        future.add_done_callback(self._log_exception)
+        return future
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            elastalert_logger.error('Error in query engine: %s' % (future.exception()))
+
+    def close(self, timeout=60):
+        """ Waits up to timeout seconds for the running coroutines, then stops the event loop. """
+        with self._lock:
+            running = list(self._running.values())
+            clients, self._clients = list(self._clients.values()), {}
+        concurrent.futures.wait(running, timeout)
+        closing = [asyncio.run_coroutine_threadsafe(client.close(), self.loop) for client in clients]
+        concurrent.futures.wait(closing, timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
@@ -5,6 +5,7 @@ import os
 
 from texttable import Texttable
 
+from .util import compile_es_key
 from .util import EAException
 from .util import lookup_es_key
 from .yaml import read_yaml
@@ -249,8 +250,9 @@ class Alerter(object):
             match_aggregation = {}
 
             # Maintain an aggregate count for each unique key encountered in the aggregation period
+            getters = [compile_es_key(key) for key in summary_table_fields]
             for match in matches:
-                key_tuple = tuple([str(lookup_es_key(match, key)) for key in summary_table_fields])
+                key_tuple = tuple([str(get_key(match)) for get_key in getters])
                 if key_tuple not in match_aggregation:
                     match_aggregation[key_tuple] = 1
                 else:
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+
+# The rule_name of the elastalert_status document of a cluster member starts with this
+MEMBER_PREFIX = '_elastalert_instance.'
+
+
+class HashRing(object):
+    """ A consistent hash ring which assigns rules to the ElastAlert instances of a cluster.
+
+    Each member is placed on the ring replicas times, and a rule belongs to the first member after
+    the hash of its name. When a member joins or leaves, only the rules of the ring segments it
+    takes or gives up change owner, instead of most rules as with a plain modulo.
+
+    :param members: The ids of the instances in the cluster.
+    :param replicas: The number of places of each member on the ring.
+    """
+
+    def __init__(self, members, replicas=64):
+        self.members = sorted(set(members))
+        ring = sorted((self._hash('%s#%s' % (member, i)), member) for member in self.members for i in range(replicas))
+        self._hashes = [position for position, _ in ring]
+        self._members = [member for _, member in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        """ Returns the member which owns key, or None if there are no members. """
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._members[i]
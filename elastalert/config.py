@@ -91,6 +91,20 @@ def load_conf(args, defaults=None, overwrites=None):
             conf['old_query_limit'] = datetime.timedelta(**conf['old_query_limit'])
         else:
             conf['old_query_limit'] = datetime.timedelta(weeks=1)
+        if 'msearch_window' in conf:
+            conf['msearch_window'] = datetime.timedelta(**conf['msearch_window'])
+        if 'silence_compaction_interval' in conf:
+            conf['silence_compaction_interval'] = datetime.timedelta(**conf['silence_compaction_interval'])
+        if 'writeback_flush_interval' in conf:
+            conf['writeback_flush_interval'] = datetime.timedelta(**conf['writeback_flush_interval'])
+        if 'cluster_heartbeat_interval' in conf:
+            conf['cluster_heartbeat_interval'] = datetime.timedelta(**conf['cluster_heartbeat_interval'])
+        if 'cluster_member_timeout' in conf:
+            conf['cluster_member_timeout'] = datetime.timedelta(**conf['cluster_member_timeout'])
+        if 'rule_state_interval' in conf:
+            conf['rule_state_interval'] = datetime.timedelta(**conf['rule_state_interval'])
+        if 'rule_worker_timeout' in conf:
+            conf['rule_worker_timeout'] = datetime.timedelta(**conf['rule_worker_timeout'])
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % e)
 
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import heapq
+import math
+
+
+class ProcessedHits(dict):
+    """ The ids of the hits a rule has already processed, mapped to their timestamps.
+
+    Besides the mapping, ids are filed into buckets of bucket_seconds by timestamp, so that
+    :meth:`remove_older_than` only looks at the buckets which are (partly) older than the cutoff
+    instead of scanning every id.
+
+    :param max_size: If set, the oldest ids are dropped as soon as there are more than this many.
+    :param compact: If true, ids are stored as 64-bit hashes instead of the full _id strings.
+    :param bucket_seconds: The time span covered by a bucket.
+    """
+
+    def __init__(self, max_size=0, compact=False, bucket_seconds=10):
+        super(ProcessedHits, self).__init__()
+        self.max_size = max_size
+        self.compact = compact
+        self.bucket_seconds = bucket_seconds
+        # The number of ids dropped to stay below max_size
+        self.evicted = 0
+        self._buckets = {}
+        self._bucket_heap = []
+
+    def __reduce__(self):
+        # The keys are already hashed in compact mode, so they are restored without going through __setitem__
+        return self.__class__, (self.max_size, self.compact, self.bucket_seconds), self.__getstate__()
+
+    def __getstate__(self):
+        return {'hits': dict(self),
+                'evicted': self.evicted,
+                'buckets': dict((bucket, collections.deque(keys)) for bucket, keys in self._buckets.items()),
+                'bucket_heap': list(self._bucket_heap)}
+
+    def __setstate__(self, state):
+        dict.update(self, state['hits'])
+        self.evicted = state['evicted']
+        self._buckets = state['buckets']
+        self._bucket_heap = state['bucket_heap']
+
+    def _key(self, _id):
+        if self.compact:
+            return int.from_bytes(hashlib.blake2b(str(_id).encode('utf-8'), digest_size=8).digest(), 'big')
+        return _id
+
+    def _bucket(self, timestamp):
+        return int(timestamp.timestamp()) // self.bucket_seconds
+
+    def _filed_under(self, key, bucket):
+        """ Returns the timestamp of key if it is still filed under bucket, otherwise None.
+        Keys are not taken out of their bucket when they are removed or set again. """
+        timestamp = dict.get(self, key)
+        if timestamp is None or self._bucket(timestamp) != bucket:
+            return None
+        return timestamp
+
+    def __contains__(self, _id):
+        return dict.__contains__(self, self._key(_id))
+
+    def __getitem__(self, _id):
+        return dict.__getitem__(self, self._key(_id))
+
+    def __delitem__(self, _id):
+        dict.__delitem__(self, self._key(_id))
+
+    def get(self, _id, default=None):
+        return dict.get(self, self._key(_id), default)
+
+    def pop(self, _id, *default):
+        return dict.pop(self, self._key(_id), *default)
+
+    def __setitem__(self, _id, timestamp):
+        self._set_key(self._key(_id), timestamp)
+
+    def _set_key(self, key, timestamp):
+        dict.__setitem__(self, key, timestamp)
+        bucket = self._bucket(timestamp)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = collections.deque()
+            heapq.heappush(self._bucket_heap, bucket)
+        self._buckets[bucket].append(key)
+        if self.max_size and len(self) > self.max_size:
+            self._evict_oldest()
+
+    def copy_to(self, processed_hits):
+        """ Adds the ids, oldest first, to processed_hits, another store of processed hits. Returns whether
+        they could be added: in compact mode only the hashes of the ids are known, which only go into another
+        compact ProcessedHits. """
+        if self.compact and not (isinstance(processed_hits, ProcessedHits) and processed_hits.compact):
+            return False
+        for key, timestamp in sorted(self.items(), key=lambda item: item[1]):
+            if self.compact:
+                processed_hits._set_key(key, timestamp)
+            else:
+                processed_hits[key] = timestamp
+        return True
+
+    def _pop_oldest_bucket(self):
+        del self._buckets[heapq.heappop(self._bucket_heap)]
+
+    def _evict_oldest(self):
+        while len(self) > self.max_size and self._bucket_heap:
+            bucket = self._bucket_heap[0]
+            keys = self._buckets[bucket]
+            while keys and len(self) > self.max_size:
+                key = keys.popleft()
+                if self._filed_under(key, bucket) is not None:
+                    dict.__delitem__(self, key)
+                    self.evicted += 1
+            if not keys:
+                self._pop_oldest_bucket()
+
+    def remove_older_than(self, cutoff):
+        """ Forgets every id with a timestamp before cutoff. """
+        cutoff_bucket = self._bucket(cutoff)
+        # Every id in a bucket before that of the cutoff is older than the cutoff
+        while self._bucket_heap and self._bucket_heap[0] < cutoff_bucket:
+            for key in self._buckets[self._bucket_heap[0]]:
+                if self._filed_under(key, self._bucket_heap[0]) is not None:
+                    dict.__delitem__(self, key)
+            self._pop_oldest_bucket()
+
+        # The bucket of the cutoff itself has to be checked id by id
+        if self._bucket_heap and self._bucket_heap[0] == cutoff_bucket:
+            keep = collections.deque()
+            for key in self._buckets[cutoff_bucket]:
+                timestamp = self._filed_under(key, cutoff_bucket)
+                if timestamp is None:
+                    continue
+                if timestamp < cutoff:
+                    dict.__delitem__(self, key)
+                else:
+                    keep.append(key)
+            if keep:
+                self._buckets[cutoff_bucket] = keep
+            else:
+                self._pop_oldest_bucket()
+
+
+class BloomFilter(object):
+    """ A Bloom filter sized for capacity items at the given false positive rate.
+
+    All filters with the same capacity and error_rate use the same bit positions for an item,
+    so :meth:`positions` can be computed once and checked against many of them.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits, self.num_hashes = self.size(capacity, error_rate)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.bits_set = 0
+
+    @staticmethod
+    def size(capacity, error_rate):
+        """ Returns the number of bits and hash functions for capacity items at error_rate. """
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return num_bits, num_hashes
+
+    @staticmethod
+    def positions(item, num_bits, num_hashes):
+        digest = hashlib.blake2b(str(item).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+    def __contains__(self, positions):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def add(self, positions):
+        bits = self.bits
+        for position in positions:
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                self.bits_set += 1
+        self.count += 1
+
+    @property
+    def fill_ratio(self):
+        return self.bits_set / self.num_bits
+
+
+class ProbabilisticProcessedHits(object):
+    """ Remembers processed hit ids in Bloom filters instead of a dictionary, for rules with
+    too many hits per buffer_time to keep every id in memory.
+
+    Ids are added to the filters of the time slice of their timestamp. A slice holds as many filters
+    of capacity ids as it needs, so the false positive rate of each filter stays at error_rate. Whole
+    slices are dropped once they are older than the cutoff of :meth:`remove_older_than`, so ids may be
+    remembered for up to slice_seconds longer than asked.
+
+    A false positive means a new hit is taken for a duplicate and skipped.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, slice_seconds=60):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.slice_seconds = slice_seconds
+        self.num_bits, self.num_hashes = BloomFilter.size(capacity, error_rate)
+        # Ids are never dropped to stay below a size
+        self.evicted = 0
+        self._slices = {}
+        self._slice_heap = []
+
+    def _slice(self, timestamp):
+        return int(timestamp.timestamp()) // self.slice_seconds
+
+    def _filters(self):
+        for filters in self._slices.values():
+            for bloom_filter in filters:
+                yield bloom_filter
+
+    def __contains__(self, _id):
+        positions = BloomFilter.positions(_id, self.num_bits, self.num_hashes)
+        return any(positions in bloom_filter for bloom_filter in self._filters())
+
+    def __setitem__(self, _id, timestamp):
+        time_slice = self._slice(timestamp)
+        if time_slice not in self._slices:
+            self._slices[time_slice] = []
+            heapq.heappush(self._slice_heap, time_slice)
+        filters = self._slices[time_slice]
+        if not filters or filters[-1].count >= self.capacity:
+            filters.append(BloomFilter(self.capacity, self.error_rate))
+        filters[-1].add(BloomFilter.positions(_id, self.num_bits, self.num_hashes))
+
+    def __len__(self):
+        """ The number of ids added to the filters which are still kept. """
+        return sum(bloom_filter.count for bloom_filter in self._filters())
+
+    def remove_older_than(self, cutoff):
+        """ Drops the slices which only hold ids with timestamps before cutoff. """
+        cutoff_slice = self._slice(cutoff)
+        while self._slice_heap and self._slice_heap[0] < cutoff_slice:
+            del self._slices[heapq.heappop(self._slice_heap)]
+
+    @property
+    def fill_ratio(self):
+        """ The fill ratio of the fullest filter. """
+        return max([bloom_filter.fill_ratio for bloom_filter in self._filters()] or [0.0])
+
+    @property
+    def false_positive_rate(self):
+        """ The estimated chance that an id which was never added is found in any of the filters. """
+        miss = 1.0
+        for bloom_filter in self._filters():
+            miss *= 1.0 - bloom_filter.fill_ratio ** self.num_hashes
+        return 1.0 - miss
+
+    def memory_size(self):
+        """ The number of bytes taken by the bits of the filters. """
+        return sum(len(bloom_filter.bits) for bloom_filter in self._filters())
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import argparse
+import asyncio
+import concurrent.futures
 import copy
 import datetime
+import functools
 import json
 import logging
+import math
 import os
 import random
 import signal
@@ -12,10 +16,13 @@ import threading
 import time
 import timeit
 import traceback
+import types
+import uuid
 from email.mime.text import MIMEText
 from smtplib import SMTP
 from smtplib import SMTPException
 from socket import error
+from socket import gethostname
 import statsd
 
 
@@ -32,17 +39,35 @@ from .prometheus_wrapper import PrometheusWrapper
 
 from . import kibana
 from elastalert.alerters.debug import DebugAlerter
+from .aggregation import AggregationBuffer
+from .aio import QueryEngine
+from .cluster import HashRing
+from .cluster import MEMBER_PREFIX
 from .config import load_conf
+from .dedup import ProbabilisticProcessedHits
+from .dedup import ProcessedHits
 from .enhancements import DropMatchException
 from .kibana_discover import generate_kibana_discover_url
+from .msearch import MultiSearchCoalescer
 from .ruletypes import FlatlineRule
+from .ruletypes import FrequencyRule
+from .ruletypes import NewTermsRule
+from .ruletypes import RuleType
+from .scheduling import RuleScheduler
+from .spool import WritebackSpool
+from .state import dumps_state
+from .state import FileRuleStateStore
+from .state import loads_state
+from .state import WritebackRuleStateStore
 from .util import add_raw_postfix
+from .util import compile_es_key
 from .util import cronite_datetime_to_timestamp
 from .util import dt_to_ts
 from .util import dt_to_unix
 from .util import EAException
 from .util import elastalert_logger
 from .util import elasticsearch_client
+from .util import es_client_pool
 from .util import format_index
 from .util import lookup_es_key
 from .util import parse_deadline
@@ -57,7 +82,11 @@ from .util import ts_add
 from .util import ts_now
 from .util import ts_to_dt
 from .util import unix_to_dt
+from .util import unixms_to_dt
 from .util import ts_utc_to_tz
+from .writeback import is_retryable
+from .writeback import WritebackQueue
+from .workers import RuleWorkerPool
 
 
 class ElastAlerter(object):
@@ -118,8 +147,10 @@ class ElastAlerter(object):
         parser.add_argument('--prometheus_port', type=int, dest='prometheus_port', help='Enables Prometheus metrics on specified port.')
         self.args = parser.parse_args(args)
 
-    def __init__(self, args):
-        self.es_clients = {}
+    def __init__(self, args, rule_filter=None):
+        self.es_clients = es_client_pool
+        # Kept to load the same rules in rule worker processes
+        self.argv = args
         self.parse_args(args)
         self.debug = self.args.debug
         self.verbose = self.args.verbose
@@ -148,12 +179,17 @@ class ElastAlerter(object):
 
         self.conf = load_conf(self.args)
         self.rules_loader = self.conf['rules_loader']
+        # Rule worker processes only load the rules they run
+        self.rules_loader.rule_filter = rule_filter
         self.rules = self.rules_loader.load(self.conf, self.args)
 
         print(len(self.rules), 'rules loaded')
 
         self.max_query_size = self.conf['max_query_size']
+        self.hits_chunk_size = self.conf.get('hits_chunk_size', 0)
+        self.backfill_prefetch_segments = self.conf.get('backfill_prefetch_segments', 0)
         self.scroll_keepalive = self.conf['scroll_keepalive']
+        self.use_point_in_time = self.conf.get('use_point_in_time', True)
         self.writeback_index = self.conf['writeback_index']
         self.run_every = self.conf['run_every']
         self.alert_time_limit = self.conf['alert_time_limit']
@@ -165,6 +201,8 @@ class ElastAlerter(object):
         self.max_aggregation = self.conf.get('max_aggregation', 10000)
         self.buffer_time = self.conf['buffer_time']
         self.silence_cache = {}
+        # The @timestamp of the newest silence loaded by refresh_silences, None until they are loaded
+        self.silences_refreshed_at = None
         self.rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
         self.starttime = self.args.start
         self.disabled_rules = []
@@ -181,6 +219,13 @@ class ElastAlerter(object):
             'max_instances': 1
         }
         self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+        if self.conf.get('rule_scheduler') == 'priority':
+            # Rules are run by the priority scheduler, and the background scheduler only runs the internal jobs
+            self.priority_classes = self.conf.get('priority_classes', [])
+            self.rule_scheduler = RuleScheduler(self.conf.get('max_threads', 10),
+                                                self.conf.get('priority_reserved_threads', 1 if self.priority_classes else 0))
+        else:
+            self.rule_scheduler = None
         self.string_multi_field_name = self.conf.get('string_multi_field_name', False)
         self.statsd_instance_tag = self.conf.get('statsd_instance_tag', '')
         self.statsd_host = self.conf.get('statsd_host', '')
@@ -191,8 +236,44 @@ class ElastAlerter(object):
         self.add_metadata_alert = self.conf.get('add_metadata_alert', False)
         self.prometheus_port = self.args.prometheus_port
         self.show_disabled_rules = self.conf.get('show_disabled_rules', True)
+        if self.conf.get('msearch_window'):
+            self.query_coalescer = MultiSearchCoalescer(total_seconds(self.conf['msearch_window']),
+                                                        self.conf.get('msearch_max_batch_size', 100))
+        else:
+            self.query_coalescer = None
+        # Created by start(), so that one-off commands write synchronously
+        self.writeback_queue = None
+        # Created by start() if rule_processes is set
+        self.rule_workers = None
+        self.rule_worker_timeout = self.conf.get('rule_worker_timeout')
+        # Created by start() if query_engine is asyncio
+        self.query_engine = None
+        if self.conf.get('cluster_mode') and not self.debug:
+            self.instance_id = self.conf.get('cluster_instance_id') or '%s-%s' % (gethostname(), os.getpid())
+        else:
+            self.instance_id = None
+        # The ids of the live instances of the cluster and their hash ring, set by refresh_cluster_members
+        self.cluster_members = None
+        self.hash_ring = None
+        if self.conf.get('writeback_spool_path'):
+            self.writeback_spool = WritebackSpool(self.conf['writeback_spool_path'],
+                                                  self.conf.get('writeback_spool_max_size', 100 * 1024 * 1024))
+        else:
+            self.writeback_spool = None
+
+        self.writeback_es = self.es_clients.get(self.conf, elasticsearch_client)
+
+        if self.conf.get('rule_state_store') == 'file':
+            self.rule_state_store = FileRuleStateStore(self.conf['rule_state_path'])
+        elif self.conf.get('rule_state_store') == 'writeback':
+            self.rule_state_store = WritebackRuleStateStore(self.writeback_es, self.writeback_index)
+        else:
+            self.rule_state_store = None
+        self.rule_state_interval = self.conf.get('rule_state_interval', datetime.timedelta(0))
 
-        self.writeback_es = elasticsearch_client(self.conf)
+        # Ask each distinct cluster for its version once, rather than once per rule
+        self.es_clients.probe([self.conf] + self.rules, elasticsearch_client)
+        elastalert_logger.info('%s rules share %s Elasticsearch clients' % (len(self.rules), len(self.es_clients)))
 
         remove = []
         for rule in self.rules:
@@ -337,6 +418,9 @@ class ElastAlerter(object):
         :return: A list of processed _source dictionaries.
         """
 
+        get_ts = compile_es_key(rule['timestamp_field'])
+        get_query_keys = [compile_es_key(key) for key in rule.get('compound_query_key') or []]
+        get_aggregation_keys = [compile_es_key(key) for key in rule.get('compound_aggregation_key') or []]
         processed_hits = []
         for hit in hits:
             # Merge fields and _source
@@ -347,14 +431,14 @@ class ElastAlerter(object):
                 hit['_source'].setdefault(key, value[0] if type(value) is list and len(value) == 1 else value)
 
             # Convert the timestamp to a datetime
-            ts = lookup_es_key(hit['_source'], rule['timestamp_field'])
+            ts = get_ts(hit['_source'])
             if not ts and not rule["_source_enabled"]:
                 raise EAException(
                     "Error: No timestamp was found for hit. '_source_enabled' is set to false, check your mappings for stored fields"
                 )
 
             set_es_key(hit['_source'], rule['timestamp_field'], rule['ts_to_dt'](ts))
-            set_es_key(hit, rule['timestamp_field'], lookup_es_key(hit['_source'], rule['timestamp_field']))
+            set_es_key(hit, rule['timestamp_field'], get_ts(hit['_source']))
 
             # Tack metadata fields into _source
             for field in ['_id', '_index', '_type']:
@@ -362,11 +446,11 @@ class ElastAlerter(object):
                     hit['_source'][field] = hit[field]
 
             if rule.get('compound_query_key'):
-                values = [lookup_es_key(hit['_source'], key) for key in rule['compound_query_key']]
+                values = [get_key(hit['_source']) for get_key in get_query_keys]
                 hit['_source'][rule['query_key']] = ', '.join([str(value) for value in values])
 
             if rule.get('compound_aggregation_key'):
-                values = [lookup_es_key(hit['_source'], key) for key in rule['compound_aggregation_key']]
+                values = [get_key(hit['_source']) for get_key in get_aggregation_keys]
                 hit['_source'][rule['aggregation_key']] = ', '.join([str(value) for value in values])
 
             processed_hits.append(hit['_source'])
@@ -378,9 +462,47 @@ class ElastAlerter(object):
         :param rule: The rule configuration.
         :param starttime: The earliest time to query.
         :param endtime: The latest time to query.
+        :param scroll: If true, return the next page of the results of the previous call.
         :return: A list of hits, bounded by rule['max_query_size'] (or self.max_query_size).
         """
+        client = self.thread_data.current_es
+        query, extra_args = self.get_hits_query(rule, starttime, endtime, client)
+        scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
+        size = rule.get('max_query_size', self.max_query_size)
+
+        try:
+            if not scroll and self.point_in_time_enabled(rule):
+                rule['pit_id'] = client.open_point_in_time(
+                    index=index,
+                    keep_alive=scroll_keepalive,
+                    ignore_unavailable=True
+                )['id']
+
+            if 'pit_id' in rule:
+                res = self.get_point_in_time_page(rule, query, size, scroll_keepalive, extra_args)
+            elif scroll:
+                res = client.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
+            else:
+                res = client.search(
+                    scroll=scroll_keepalive,
+                    index=index,
+                    size=size,
+                    body=query,
+                    ignore_unavailable=True,
+                    **extra_args
+                )
+                if '_scroll_id' in res:
+                    rule['scroll_id'] = res['_scroll_id']
+
+            self.check_shard_failures(res)
+            elastalert_logger.debug(str(res))
+        except ElasticsearchException as e:
+            self.handle_query_error(rule, e, 'Error running query: %s', query)
+            return None
+        return self.handle_hits_response(rule, res, starttime, endtime, size, scroll, self.thread_data, client)
 
+    def get_hits_query(self, rule, starttime, endtime, client):
+        """ Returns the query of get_hits and the extra search arguments which select the fields of the hits. """
         query = self.get_query(
             rule['filter'],
             starttime,
@@ -389,66 +511,66 @@ class ElastAlerter(object):
             to_ts_func=rule['dt_to_ts'],
             five=rule['five'],
         )
-        if self.thread_data.current_es.is_atleastsixsix():
+        if client.is_atleastsixsix():
             extra_args = {'_source_includes': rule['include']}
         else:
             extra_args = {'_source_include': rule['include']}
-        scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
         if not rule.get('_source_enabled'):
             if rule['five']:
                 query['stored_fields'] = rule['include']
             else:
                 query['fields'] = rule['include']
             extra_args = {}
+        return query, extra_args
 
-        try:
-            if scroll:
-                res = self.thread_data.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
+    @staticmethod
+    def check_shard_failures(res):
+        """ Raises an ElasticsearchException if a shard failed to parse the query. """
+        if len(res.get('_shards', {}).get('failures', [])) > 0:
+            try:
+                errs = [e['reason']['reason'] for e in res['_shards']['failures'] if 'Failed to parse' in e['reason']['reason']]
+                if len(errs):
+                    raise ElasticsearchException(errs)
+            except (TypeError, KeyError):
+                # Different versions of ES have this formatted in different ways. Fallback to str-ing the whole thing
+                raise ElasticsearchException(str(res['_shards']['failures']))
+
+    def handle_query_error(self, rule, e, message, query=None):
+        """ Handles an error running a query of rule, message having a placeholder for the error. """
+        # Elasticsearch sometimes gives us GIGANTIC error messages
+        # (so big that they will fill the entire terminal buffer)
+        if len(str(e)) > 1024:
+            e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+        data = {'rule': rule['name']}
+        if query is not None:
+            data['query'] = query
+        self.handle_error(message % (e), data)
+
+    def handle_hits_response(self, rule, res, starttime, endtime, size, scroll, state, client):
+        """ Counts the hits of a page returned for get_hits in state and returns them processed. """
+        if not scroll:
+            if client.is_atleastseven():
+                state.total_hits = int(res['hits']['total']['value'])
             else:
-                res = self.thread_data.current_es.search(
-                    scroll=scroll_keepalive,
-                    index=index,
-                    size=rule.get('max_query_size', self.max_query_size),
-                    body=query,
-                    ignore_unavailable=True,
-                    **extra_args
-                )
-                if '_scroll_id' in res:
-                    rule['scroll_id'] = res['_scroll_id']
+                state.total_hits = int(res['hits']['total'])
 
-                if self.thread_data.current_es.is_atleastseven():
-                    self.thread_data.total_hits = int(res['hits']['total']['value'])
-                else:
-                    self.thread_data.total_hits = int(res['hits']['total'])
-
-            if len(res.get('_shards', {}).get('failures', [])) > 0:
-                try:
-                    errs = [e['reason']['reason'] for e in res['_shards']['failures'] if 'Failed to parse' in e['reason']['reason']]
-                    if len(errs):
-                        raise ElasticsearchException(errs)
-                except (TypeError, KeyError):
-                    # Different versions of ES have this formatted in different ways. Fallback to str-ing the whole thing
-                    raise ElasticsearchException(str(res['_shards']['failures']))
-
-            elastalert_logger.debug(str(res))
-        except ElasticsearchException as e:
-            # Elasticsearch sometimes gives us GIGANTIC error messages
-            # (so big that they will fill the entire terminal buffer)
-            if len(str(e)) > 1024:
-                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
-            self.handle_error('Error running query: %s' % (e), {'rule': rule['name'], 'query': query})
-            return None
         hits = res['hits']['hits']
-        self.thread_data.num_hits += len(hits)
+        state.num_hits += len(hits)
+        if 'pit_id' in rule:
+            # A full page means there may be more, continue after the sort values of its last hit
+            if len(hits) >= size:
+                rule['search_after'] = hits[-1]['sort']
+            else:
+                rule.pop('search_after', None)
         lt = rule.get('use_local_time')
         status_log = "Queried rule %s from %s to %s: %s / %s hits" % (
             rule['name'],
             pretty_ts(starttime, lt),
             pretty_ts(endtime, lt),
-            self.thread_data.num_hits,
+            state.num_hits,
             len(hits)
         )
-        if self.thread_data.total_hits > rule.get('max_query_size', self.max_query_size):
+        if self.has_next_page(rule, state):
             elastalert_logger.info("%s (scrolling..)" % status_log)
         else:
             elastalert_logger.info(status_log)
@@ -460,6 +582,55 @@ class ElastAlerter(object):
             rule['doc_type'] = hits[0]['_type']
         return hits
 
+    def point_in_time_enabled(self, rule, client=None):
+        """ Pages of hits are fetched with search_after in a point in time instead of scrolling
+        on ES 7.12+, which breaks ties between equal sort values by itself """
+        if client is None:
+            client = self.thread_data.current_es
+        return rule.get('use_point_in_time', self.use_point_in_time) and client.is_atleastseventwelve()
+
+    def get_point_in_time_page(self, rule, query, size, keep_alive, extra_args):
+        """ Searches the point in time of the rule, after the last hit of the previous page if there was one. """
+        body, extra_args = self.get_point_in_time_query(rule, query, keep_alive, extra_args)
+        res = self.thread_data.current_es.point_in_time_search(body=body, size=size, **extra_args)
+        # The id of a point in time may change between searches
+        rule['pit_id'] = res.get('pit_id', rule['pit_id'])
+        return res
+
+    @staticmethod
+    def get_point_in_time_query(rule, query, keep_alive, extra_args):
+        """ Returns the body and extra search arguments of the next search of the point in time of the rule. """
+        body = dict(query, pit={'id': rule['pit_id'], 'keep_alive': keep_alive})
+        if 'search_after' in rule:
+            body['search_after'] = rule['search_after']
+            # The total was already counted with the first page
+            extra_args = dict(extra_args, track_total_hits=False)
+        return body, extra_args
+
+    def has_next_page(self, rule, state=None):
+        """ Returns True if the last call to get_hits for rule left results to be fetched. """
+        if state is None:
+            state = self.thread_data
+        if 'pit_id' in rule:
+            return 'search_after' in rule
+        return bool(rule.get('scroll_id')) and state.num_hits < state.total_hits
+
+    def clear_pagination(self, rule):
+        """ Frees the scroll context or point in time left open by get_hits for rule. """
+        rule.pop('search_after', None)
+        if 'pit_id' in rule:
+            pit_id = rule.pop('pit_id')
+            try:
+                self.thread_data.current_es.close_point_in_time(body={'id': pit_id})
+            except NotFoundError:
+                pass
+        if 'scroll_id' in rule:
+            scroll_id = rule.pop('scroll_id')
+            try:
+                self.thread_data.current_es.clear_scroll(scroll_id=scroll_id)
+            except NotFoundError:
+                pass
+
     def get_hits_count(self, rule, starttime, endtime, index):
         """ Query Elasticsearch for the count of results and returns a list of timestamps
         equal to the endtime. This allows the results to be passed to rules which expect
@@ -470,7 +641,20 @@ class ElastAlerter(object):
         :param endtime: The latest time to query.
         :return: A dictionary mapping timestamps to number of hits for that time period.
         """
-        query = self.get_query(
+        query = self.get_hits_count_query(rule, starttime, endtime)
+
+        try:
+            if self.use_query_coalescer(rule):
+                res = self.coalesced_count(rule, index, query)
+            else:
+                res = self.thread_data.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
+        except ElasticsearchException as e:
+            self.handle_query_error(rule, e, 'Error running count query: %s', query)
+            return None
+        return self.handle_count_response(rule, res, starttime, endtime, self.thread_data)
+
+    def get_hits_count_query(self, rule, starttime, endtime):
+        return self.get_query(
             rule['filter'],
             starttime,
             endtime,
@@ -480,17 +664,8 @@ class ElastAlerter(object):
             five=rule['five']
         )
 
-        try:
-            res = self.thread_data.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
-        except ElasticsearchException as e:
-            # Elasticsearch sometimes gives us GIGANTIC error messages
-            # (so big that they will fill the entire terminal buffer)
-            if len(str(e)) > 1024:
-                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
-            self.handle_error('Error running count query: %s' % (e), {'rule': rule['name'], 'query': query})
-            return None
-
-        self.thread_data.num_hits += res['count']
+    def handle_count_response(self, rule, res, starttime, endtime, state):
+        state.num_hits += res['count']
         lt = rule.get('use_local_time')
         elastalert_logger.info(
             "Queried rule %s from %s to %s: %s hits" % (rule['name'], pretty_ts(starttime, lt), pretty_ts(endtime, lt), res['count'])
@@ -498,6 +673,28 @@ class ElastAlerter(object):
         return {endtime: res['count']}
 
     def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+        query = self.get_hits_terms_query(rule, starttime, endtime, key, qk, size)
+
+        try:
+            if self.use_query_coalescer(rule):
+                res = self.coalesced_search(rule, index, query, rule['doc_type'])
+            elif not rule['five']:
+                res = self.thread_data.current_es.deprecated_search(
+                    index=index,
+                    doc_type=rule['doc_type'],
+                    body=query,
+                    search_type='count',
+                    ignore_unavailable=True
+                )
+            else:
+                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule['doc_type'],
+                                                                    body=query, size=0, ignore_unavailable=True)
+        except ElasticsearchException as e:
+            self.handle_query_error(rule, e, 'Error running terms query: %s', query)
+            return None
+        return self.handle_terms_response(rule, res, starttime, endtime, self.thread_data)
+
+    def get_hits_terms_query(self, rule, starttime, endtime, key, qk=None, size=None):
         rule_filter = copy.copy(rule['filter'])
         if qk:
             qk_list = qk.split(",")
@@ -532,35 +729,16 @@ class ElastAlerter(object):
         )
         if size is None:
             size = rule.get('terms_size', 50)
-        query = self.get_terms_query(base_query, rule, size, key, rule['five'])
-
-        try:
-            if not rule['five']:
-                res = self.thread_data.current_es.deprecated_search(
-                    index=index,
-                    doc_type=rule['doc_type'],
-                    body=query,
-                    search_type='count',
-                    ignore_unavailable=True
-                )
-            else:
-                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule['doc_type'],
-                                                                    body=query, size=0, ignore_unavailable=True)
-        except ElasticsearchException as e:
-            # Elasticsearch sometimes gives us GIGANTIC error messages
-            # (so big that they will fill the entire terminal buffer)
-            if len(str(e)) > 1024:
-                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
-            self.handle_error('Error running terms query: %s' % (e), {'rule': rule['name'], 'query': query})
-            return None
+        return self.get_terms_query(base_query, rule, size, key, rule['five'])
 
+    def handle_terms_response(self, rule, res, starttime, endtime, state):
         if 'aggregations' not in res:
             return {}
         if not rule['five']:
             buckets = res['aggregations']['filtered']['counts']['buckets']
         else:
             buckets = res['aggregations']['counts']['buckets']
-        self.thread_data.num_hits += len(buckets)
+        state.num_hits += len(buckets)
         lt = rule.get('use_local_time')
         elastalert_logger.info(
             'Queried rule %s from %s to %s: %s buckets' % (rule['name'], pretty_ts(starttime, lt), pretty_ts(endtime, lt), len(buckets))
@@ -568,21 +746,11 @@ class ElastAlerter(object):
         return {endtime: buckets}
 
     def get_hits_aggregation(self, rule, starttime, endtime, index, query_key, term_size=None):
-        rule_filter = copy.copy(rule['filter'])
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
-        if term_size is None:
-            term_size = rule.get('terms_size', 50)
-        query = self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
+        query = self.get_hits_aggregation_query(rule, starttime, endtime, query_key, term_size)
         try:
-            if not rule['five']:
+            if self.use_query_coalescer(rule):
+                res = self.coalesced_search(rule, index, query, rule.get('doc_type'))
+            elif not rule['five']:
                 res = self.thread_data.current_es.deprecated_search(
                     index=index,
                     doc_type=rule.get('doc_type'),
@@ -594,10 +762,26 @@ class ElastAlerter(object):
                 res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
                                                                     body=query, size=0, ignore_unavailable=True)
         except ElasticsearchException as e:
-            if len(str(e)) > 1024:
-                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
-            self.handle_error('Error running query: %s' % (e), {'rule': rule['name']})
+            self.handle_query_error(rule, e, 'Error running query: %s')
             return None
+        return self.handle_aggregation_response(rule, res, endtime, self.thread_data, self.thread_data.current_es)
+
+    def get_hits_aggregation_query(self, rule, starttime, endtime, query_key, term_size=None):
+        rule_filter = copy.copy(rule['filter'])
+        base_query = self.get_query(
+            rule_filter,
+            starttime,
+            endtime,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=rule['dt_to_ts'],
+            five=rule['five']
+        )
+        if term_size is None:
+            term_size = rule.get('terms_size', 50)
+        return self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
+
+    def handle_aggregation_response(self, rule, res, endtime, state, client):
         if 'aggregations' not in res:
             return {}
         if not rule['five']:
@@ -605,36 +789,105 @@ class ElastAlerter(object):
         else:
             payload = res['aggregations']
 
-        if self.thread_data.current_es.is_atleastseven():
-            self.thread_data.num_hits += res['hits']['total']['value']
+        if client.is_atleastseven():
+            state.num_hits += res['hits']['total']['value']
         else:
-            self.thread_data.num_hits += res['hits']['total']
+            state.num_hits += res['hits']['total']
 
         return {endtime: payload}
 
+    def use_query_coalescer(self, rule):
+        """ Size 0 searches of ES5+ rules are batched into _msearch requests when msearch_window is set """
+        return self.query_coalescer is not None and rule['five'] and rule.get('use_msearch', True)
+
+    def coalesced_search(self, rule, index, query, doc_type=None):
+        """ Runs an aggregation query without hits as part of an _msearch shared with other rules """
+        body = dict(query, size=0)
+        if self.thread_data.current_es.is_atleastseven():
+            doc_type = None
+        return self.query_coalescer.search(self.thread_data.current_es, index, body, doc_type)
+
+    def coalesced_count(self, rule, index, query):
+        """ Runs a count query as part of an _msearch shared with other rules, returning a _count style response """
+        if self.thread_data.current_es.is_atleastseven():
+            res = self.coalesced_search(rule, index, dict(query, track_total_hits=True))
+            return {'count': res['hits']['total']['value']}
+        res = self.coalesced_search(rule, index, query, rule['doc_type'])
+        return {'count': res['hits']['total']}
+
     def remove_duplicate_events(self, data, rule):
-        new_events = []
+        return list(self.iter_new_events(data, rule))
+
+    def iter_new_events(self, data, rule):
+        """ Yields the events of data which were not seen by an earlier query of the rule. """
+        get_ts = compile_es_key(rule['timestamp_field'])
         for event in data:
             if event['_id'] in rule['processed_hits']:
                 continue
 
             # Remember the new data's IDs
-            rule['processed_hits'][event['_id']] = lookup_es_key(event, rule['timestamp_field'])
-            new_events.append(event)
+            rule['processed_hits'][event['_id']] = get_ts(event)
+            yield event
 
-        return new_events
+    def add_data_in_chunks(self, rule, data):
+        """ Streams the new events of a page of hits into the RuleType instance, at most hits_chunk_size at a time.
 
-    def remove_old_events(self, rule):
-        # Anything older than the buffer time we can forget
-        now = ts_now()
-        remove = []
+        :return: The number of events passed to the rule.
+        """
+        chunk_size = rule.get('hits_chunk_size', self.hits_chunk_size)
+        added = 0
+        chunk = []
+        for event in self.iter_new_events(data, rule):
+            chunk.append(event)
+            if len(chunk) == chunk_size:
+                rule['type'].add_data(chunk)
+                added += len(chunk)
+                chunk = []
+        if chunk:
+            rule['type'].add_data(chunk)
+            added += len(chunk)
+        return added
+
+    def get_dedup_window(self, rule):
+        """ Returns how long the ids of processed hits are remembered for. """
         buffer_time = rule.get('buffer_time', self.buffer_time)
         if rule.get('query_delay'):
             buffer_time += rule['query_delay']
-        for _id, timestamp in rule['processed_hits'].items():
-            if now - timestamp > buffer_time:
-                remove.append(_id)
-        list(map(rule['processed_hits'].pop, remove))
+        return buffer_time
+
+    def new_processed_hits(self, rule):
+        """ Returns an empty store for the ids of the hits processed by rule, according to its dedup_mode. """
+        if rule.get('dedup_mode') == 'probabilistic':
+            slice_seconds = max(1, int(self.get_dedup_window(rule).total_seconds() / 4))
+            return ProbabilisticProcessedHits(rule.get('dedup_capacity', 100000),
+                                              rule.get('dedup_false_positive_rate', 0.001),
+                                              slice_seconds)
+        return ProcessedHits(rule.get('max_processed_hits', 0), rule.get('dedup_mode') == 'compact')
+
+    def processed_hits_settings(self, rule):
+        """ Returns the options of rule which new_processed_hits builds its store from. """
+        return (rule.get('dedup_mode'), rule.get('max_processed_hits', 0), rule.get('dedup_capacity', 100000),
+                rule.get('dedup_false_positive_rate', 0.001), self.get_dedup_window(rule))
+
+    def reload_processed_hits(self, rule, new_rule):
+        """ Returns the store of processed hits of rule for new_rule, its reloaded configuration. If the options
+        of the store changed, a new one is built and the ids which can be are copied over. """
+        if self.processed_hits_settings(rule) == self.processed_hits_settings(new_rule):
+            return rule['processed_hits']
+        processed_hits = self.new_processed_hits(new_rule)
+        if not (isinstance(rule['processed_hits'], ProcessedHits) and rule['processed_hits'].copy_to(processed_hits)):
+            elastalert_logger.warning('The deduplication options of rule %s changed, its processed hits are forgotten and '
+                                      'some of their events may be processed again' % (new_rule['name']))
+        return processed_hits
+
+    def remove_old_events(self, rule):
+        # Anything older than the buffer time we can forget
+        rule['processed_hits'].remove_older_than(ts_now() - self.get_dedup_window(rule))
+
+        if rule['processed_hits'].evicted:
+            elastalert_logger.warning('Forgot %s processed hits of rule %s to stay below max_processed_hits, '
+                                      'some of their events may be processed again' % (rule['processed_hits'].evicted, rule['name']))
+            rule['processed_hits'].evicted = 0
 
     def run_query(self, rule, start=None, end=None, scroll=False):
         """ Query for the rule and pass all of the results to the RuleType instance.
@@ -648,16 +901,8 @@ class ElastAlerter(object):
             start = self.get_index_start(rule['index'])
         if end is None:
             end = ts_now()
+        start, end, index = self.get_query_range(rule, start, end)
 
-        if rule.get('query_timezone') != "":
-            elastalert_logger.info("Query start and end time converting UTC to query_timezone : {}".format(rule.get('query_timezone')))
-            start = ts_utc_to_tz(start, rule.get('query_timezone'))
-            end = ts_utc_to_tz(end, rule.get('query_timezone'))
-
-        # Reset hit counter and query
-        rule_inst = rule['type']
-        rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
-        index = self.get_index(rule, start, end)
         if rule.get('use_count_query'):
             data = self.get_hits_count(rule, start, end, index)
         elif rule.get('use_terms_query'):
@@ -665,41 +910,59 @@ class ElastAlerter(object):
         elif rule.get('aggregation_query_element'):
             data = self.get_hits_aggregation(rule, start, end, index, rule.get('query_key', None))
         else:
-            data = self.get_hits(rule, start, end, index, scroll)
-            if data:
-                old_len = len(data)
-                data = self.remove_duplicate_events(data, rule)
-                self.thread_data.num_dupes += old_len - len(data)
+            try:
+                return self.run_paginated_query(rule, start, end, index, scroll)
+            finally:
+                self.clear_pagination(rule)
+
+        return self.add_query_data(rule, data)
 
+    def get_query_range(self, rule, start, end):
+        """ Converts the time range of a query of rule to its query_timezone and returns it with the index to query. """
+        if rule.get('query_timezone') != "":
+            elastalert_logger.info("Query start and end time converting UTC to query_timezone : {}".format(rule.get('query_timezone')))
+            start = ts_utc_to_tz(start, rule.get('query_timezone'))
+            end = ts_utc_to_tz(end, rule.get('query_timezone'))
+
+        # Reset hit counter and query
+        rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
+        return start, end, self.get_index(rule, start, end)
+
+    @staticmethod
+    def add_query_data(rule, data):
+        """ Passes the result of a count, terms or aggregation query to the RuleType instance.
+        Returns False if the query failed. """
         # There was an exception while querying
         if data is None:
             return False
         elif data:
             if rule.get('use_count_query'):
-                rule_inst.add_count_data(data)
+                rule['type'].add_count_data(data)
             elif rule.get('use_terms_query'):
-                rule_inst.add_terms_data(data)
+                rule['type'].add_terms_data(data)
             elif rule.get('aggregation_query_element'):
-                rule_inst.add_aggregation_data(data)
-            else:
-                rule_inst.add_data(data)
+                rule['type'].add_aggregation_data(data)
 
-        try:
-            if rule.get('scroll_id') and self.thread_data.num_hits < self.thread_data.total_hits and should_scrolling_continue(rule):
-                if not self.run_query(rule, start, end, scroll=True):
-                    return False
-        except RuntimeError:
-            # It's possible to scroll far enough to hit max recursive depth
-            pass
+        return True
 
-        if 'scroll_id' in rule:
-            scroll_id = rule.pop('scroll_id')
-            try:
-                self.thread_data.current_es.clear_scroll(scroll_id=scroll_id)
-            except NotFoundError:
-                pass
+    def run_paginated_query(self, rule, start, end, index, scroll=False):
+        """ Passes every page of hits for the rule to the RuleType instance, one page at a time.
+        Each page is split into chunks of at most hits_chunk_size events, see :meth:`add_data_in_chunks`.
 
-        return True
+        Returns True on success and False on failure.
+        """
+        while True:
+            data = self.get_hits(rule, start, end, index, scroll)
+            # There was an exception while querying
+            if data is None:
+                return False
+            if data:
+                self.thread_data.num_dupes += len(data) - self.add_data_in_chunks(rule, data)
+
+            if not self.has_next_page(rule) or not should_scrolling_continue(rule):
+                return True
+            rule['scrolling_cycle'] += 1
+            scroll = True
 
     def get_starttime(self, rule):
         """ Query ES for the last time we ran this rule.
@@ -707,6 +970,7 @@ class ElastAlerter(object):
         :param rule: The rule configuration.
         :return: A timestamp or None.
         """
+        self.flush_writeback()
         sort = {'sort': {'@timestamp': {'order': 'desc'}}}
         query = {'filter': {'term': {'rule_name': '%s' % (rule['name'])}}}
         if self.writeback_es.is_atleastfive():
@@ -880,22 +1144,31 @@ class ElastAlerter(object):
             filters.append({'query': query_str_filter})
         elastalert_logger.debug("Enhanced filter with {} terms: {}".format(listname, str(query_str_filter)))
 
-    def run_rule(self, rule, endtime, starttime=None):
-        """ Run a rule for a given time period, including querying and alerting on results.
+    def find_matches(self, rule, endtime, starttime=None):
+        """ Queries for a rule over a given time period and passes the hits to its RuleType, which
+        adds its matches to rule['type'].matches.
 
         :param rule: The rule configuration.
         :param starttime: The earliest timestamp to query.
         :param endtime: The latest timestamp to query.
-        :return: The number of matches that the rule produced.
+        :return: The latest timestamp queried, or None if the rule did not run.
         """
-        run_start = time.time()
-        self.thread_data.current_es = self.es_clients.setdefault(rule['name'], elasticsearch_client(rule))
+        if not self.start_find_matches(rule, endtime, starttime, self.thread_data):
+            return None
 
-        # If there are pending aggregate matches, try processing them
-        for x in range(len(rule['agg_matches'])):
-            match = rule['agg_matches'].pop()
-            self.add_aggregated_alert(match, rule)
+        # Run the rule. If querying over a large time period, split it up into segments
+        segments, endtime = self.get_query_segments(rule, endtime)
+        if len(segments) > 1 and self.get_segment_prefetch(rule) > 0:
+            return self.find_matches_concurrently(rule, segments, endtime)
+        for start, end, last in segments:
+            if not self.run_query(rule, start, end):
+                return None
+            self.count_segment_hits(rule, end, last, self.thread_data)
+        return endtime
 
+    def start_find_matches(self, rule, endtime, starttime, state):
+        """ Sets the starttime of rule for find_matches and resets the hit counters in state.
+        Returns False if the rule should not run. """
         # Start from provided time if it's given
         if starttime:
             rule['starttime'] = starttime
@@ -905,47 +1178,410 @@ class ElastAlerter(object):
         rule['original_starttime'] = rule['starttime']
         rule['scrolling_cycle'] = 0
 
-        self.thread_data.num_hits = 0
-        self.thread_data.num_dupes = 0
-        self.thread_data.cumulative_hits = 0
+        state.num_hits = 0
+        state.num_dupes = 0
+        state.cumulative_hits = 0
 
         # Don't run if starttime was set to the future
         if ts_now() <= rule['starttime']:
             elastalert_logger.warning("Attempted to use query start time in the future (%s), sleeping instead" % (starttime))
+            return False
+        return True
+
+    def get_segment_prefetch(self, rule):
+        """ Returns how many segments of a run of rule are fetched while one is passed to its RuleType. Only
+        queries for hits are prefetched. """
+        if rule.get('use_count_query') or rule.get('use_terms_query') or rule.get('aggregation_query_element'):
             return 0
+        prefetch = rule.get('backfill_prefetch_segments', self.backfill_prefetch_segments)
+        if rule.get('segment_concurrency', 1) > 1 and rule['type'].stateless:
+            prefetch = max(prefetch, rule['segment_concurrency'])
+        return prefetch
+
+    def find_matches_concurrently(self, rule, segments, endtime):
+        """ Runs the segments of find_matches, fetching the hits of the next segments in other threads while
+        the hits of a segment are passed to the RuleType. Segments are still passed one after the other, in
+        order, so this is safe for every rule type. Logs the progress of the run every 10 seconds. """
+        prefetch = self.get_segment_prefetch(rule)
+        total = len(segments)
+        run_start = logged_at = time.time()
+        with concurrent.futures.ThreadPoolExecutor(prefetch, thread_name_prefix='elastalert-segment') as executor:
+            fetching = []
+            segments = iter(segments)
+
+            def fetch_ahead():
+                # Keep at most prefetch segments in memory
+                for start, end, last in segments:
+                    segment_rule = copy.copy(rule)
+                    fetching.append((end, last, segment_rule,
+                                     executor.submit(self.fetch_segment_hits, segment_rule, start, end)))
+                    if len(fetching) == prefetch:
+                        break
 
-        # Run the rule. If querying over a large time period, split it up into segments
+            try:
+                for done in range(1, total + 1):
+                    fetch_ahead()
+                    end, last, segment_rule, future = fetching.pop(0)
+                    pages, num_hits = future.result()
+                    if pages is None:
+                        return None
+                    fetch_ahead()
+
+                    if 'doc_type' in segment_rule:
+                        rule.setdefault('doc_type', segment_rule['doc_type'])
+                    for data in pages:
+                        self.thread_data.num_dupes += len(data) - self.add_data_in_chunks(rule, data)
+                    self.thread_data.num_hits = num_hits
+                    self.count_segment_hits(rule, end, last, self.thread_data)
+
+                    now = time.time()
+                    if now - logged_at >= 10 or last:
+                        logged_at = now
+                        hits = self.thread_data.cumulative_hits
+                        elastalert_logger.info('Backfilled %s up to %s: %s/%s segments, %s hits, %.1f hits per second' % (
+                            rule['name'], pretty_ts(end, rule.get('use_local_time')), done, total, hits,
+                            hits / max(now - run_start, 0.001)))
+                return endtime
+            finally:
+                for _, _, _, future in fetching:
+                    future.cancel()
+
+    def fetch_segment_hits(self, rule, start, end):
+        """ Fetches every page of hits of a segment for find_matches_concurrently, in a thread of its own.
+        Scroll ids and points in time are kept in rule, a copy of the rule for this segment.
+
+        :return: The pages of hits and the number of hits, or None and 0 if a query failed.
+        """
+        self.thread_data.current_es = self.es_clients.get(rule, elasticsearch_client)
+        self.thread_data.num_hits = 0
+        self.thread_data.total_hits = 0
+        start, end, index = self.get_query_range(rule, start, end)
+        pages = []
+        scroll = False
+        try:
+            while True:
+                data = self.get_hits(rule, start, end, index, scroll)
+                if data is None:
+                    return None, 0
+                pages.append(data)
+                if not self.has_next_page(rule) or not should_scrolling_continue(rule):
+                    return pages, self.thread_data.num_hits
+                rule['scrolling_cycle'] += 1
+                scroll = True
+        finally:
+            self.clear_pagination(rule)
+
+    def get_query_segments(self, rule, endtime, client=None):
+        """ Splits the time range of a run of rule, from rule['starttime'] to endtime, into segments of at most
+        the segment size of the rule, which are queried one after the other.
+
+        Queries for hits are instead split into segments of about segment_target_hits hits if the rule sets it,
+        see :meth:`get_adaptive_segment_cuts`.
+
+        :param client: The client to probe the hits of the rule with, thread_data.current_es by default.
+        :return: A list of (start, end, last) tuples and the latest timestamp queried, which is None if there
+            is nothing to query.
+        """
         segment_size = self.get_segment_size(rule)
+        segments = []
+        start = rule['starttime']
+        if rule.get('segment_target_hits') and endtime - start > segment_size and self.supports_adaptive_segments(rule):
+            cuts = self.get_adaptive_segment_cuts(rule, start, endtime, client or self.thread_data.current_es)
+            if cuts is not None:
+                bounds = [start] + cuts + [endtime]
+                return [(bounds[i], bounds[i + 1], i == len(cuts)) for i in range(len(cuts) + 1)], endtime
+
+        while endtime - start > segment_size:
+            segments.append((start, start + segment_size, False))
+            start = start + segment_size
 
-        tmp_endtime = rule['starttime']
+        if rule.get('aggregation_query_element'):
+            # Aggregation queries only run over whole segments
+            if endtime - start == segment_size:
+                segments.append((start, endtime, True))
+            elif not segments:
+                return [], None
+            else:
+                endtime = start
+        else:
+            segments.append((start, endtime, True))
+        return segments, endtime
 
-        while endtime - rule['starttime'] > segment_size:
-            tmp_endtime = tmp_endtime + segment_size
-            if not self.run_query(rule, rule['starttime'], tmp_endtime):
-                return 0
-            self.thread_data.cumulative_hits += self.thread_data.num_hits
-            self.thread_data.num_hits = 0
-            rule['starttime'] = tmp_endtime
-            rule['type'].garbage_collect(tmp_endtime)
+    @staticmethod
+    def supports_adaptive_segments(rule):
+        """ Returns whether the segments of rule may be sized by segment_target_hits. Count, terms and aggregation
+        queries keep segments of their size. So do rule types which may match in garbage_collect, such as flatline,
+        spike and cardinality rules: they check for missing data at the end of every segment, which merging the quiet
+        stretches would skip. Only the types whose garbage_collect merely forgets old data are allowed. """
+        if rule.get('use_count_query') or rule.get('use_terms_query') or rule.get('aggregation_query_element'):
+            return False
+        garbage_collect = getattr(type(rule['type']), 'garbage_collect', RuleType.garbage_collect)
+        return garbage_collect in (RuleType.garbage_collect, FrequencyRule.garbage_collect, NewTermsRule.garbage_collect)
+
+    def get_adaptive_segment_cuts(self, rule, start, end, client, depth=0):
+        """ Returns the times between start and end at which to split the query of rule into segments of about
+        segment_target_hits hits, from the number of hits over time found by a histogram probe. Stretches with
+        few hits become one segment, and a bucket of the probe with more than twice the target is probed again
+        once. Returns None if the probe failed. """
+        probe = self.probe_hit_density(rule, start, end, client)
+        if probe is None:
+            return None
+        buckets, width = probe
+        target = rule['segment_target_hits']
+        cuts = []
+        hits = 0
+        for key, count in buckets:
+            bucket_start = max(key, start)
+            bucket_end = min(key + width, end)
+            if hits and hits + count > target:
+                cuts.append(bucket_start)
+                hits = 0
+            if count > 2 * target and not depth and width > datetime.timedelta(seconds=1):
+                finer = self.get_adaptive_segment_cuts(rule, bucket_start, bucket_end, client, depth + 1)
+                if finer is not None:
+                    cuts += finer + [bucket_end]
+                    continue
+            hits += count
+        return sorted(set(cut for cut in cuts if start < cut < end))
 
-        if rule.get('aggregation_query_element'):
-            if endtime - tmp_endtime == segment_size:
-                if not self.run_query(rule, tmp_endtime, endtime):
-                    return 0
-                self.thread_data.cumulative_hits += self.thread_data.num_hits
-            elif total_seconds(rule['original_starttime'] - tmp_endtime) == 0:
-                rule['starttime'] = rule['original_starttime']
-                return 0
+    def probe_hit_density(self, rule, start, end, client, max_buckets=1000):
+        """ Counts the hits of rule from start to end in at most max_buckets buckets of whole seconds with a size 0
+        histogram search.
+
+        :return: A list of (bucket start, hit count) tuples and the width of the buckets, or None if the search failed.
+        """
+        width = max(1, int(math.ceil(total_seconds(end - start) / max_buckets)))
+        query = self.get_query(rule['filter'], start, end, sort=False, timestamp_field=rule['timestamp_field'],
+                               to_ts_func=rule['dt_to_ts'], five=rule['five'])
+        # Histograms of numeric timestamps are in their own unit, and date histograms in milliseconds
+        if rule.get('timestamp_type') == 'unix':
+            histogram = {'histogram': {'field': rule['timestamp_field'], 'interval': width}}
+            key_to_dt = unix_to_dt
+        elif rule.get('timestamp_type') == 'unix_ms':
+            histogram = {'histogram': {'field': rule['timestamp_field'], 'interval': width * 1000}}
+            key_to_dt = unixms_to_dt
+        else:
+            interval = 'fixed_interval' if client.is_atleastseventwelve() else 'interval'
+            histogram = {'date_histogram': {'field': rule['timestamp_field'], interval: '%ss' % (width)}}
+            key_to_dt = unixms_to_dt
+        query['aggs'] = {'hit_density': histogram}
+
+        try:
+            res = client.search(index=self.get_index(rule, start, end), body=query, size=0, ignore_unavailable=True)
+            buckets = res['aggregations']['hit_density']['buckets']
+        except (ElasticsearchException, KeyError) as e:
+            elastalert_logger.warning('Error probing the hits of rule %s, querying in fixed size segments: %s' % (rule['name'], e))
+            return None
+        return [(key_to_dt(bucket['key']), bucket['doc_count']) for bucket in buckets], datetime.timedelta(seconds=width)
+
+    def count_segment_hits(self, rule, end, last, state):
+        """ Moves the start of rule past a segment queried by find_matches. """
+        state.cumulative_hits += state.num_hits
+        if not last:
+            state.num_hits = 0
+            rule['starttime'] = end
+        if not last or not rule.get('aggregation_query_element'):
+            rule['type'].garbage_collect(end)
+
+    def find_matches_for_coordinator(self, rule_name, endtime, starttime=None):
+        """ Runs find_matches for a rule in a rule worker process (see :class:`RuleWorkerPool`) and
+        returns what the process running the rule needs to handle its matches. """
+        rule = next((rule for rule in self.rules if rule['name'] == rule_name), None)
+        if rule is None:
+            raise EAException('Rule %s is not loaded by this rule worker' % (rule_name))
+        self.thread_data.current_es = self.es_clients.get(rule, elasticsearch_client)
+
+        endtime = self.find_matches(rule, endtime, starttime)
+        found = self.get_found_matches(rule, endtime, self.thread_data)
+        if endtime is not None:
+            rule['previous_endtime'] = endtime
+        self.remove_old_events(rule)
+        return found
+
+    @staticmethod
+    def get_found_matches(rule, endtime, state):
+        """ Takes the matches found for rule out of its RuleType, with the hit counts of state. """
+        matches, rule['type'].matches = rule['type'].matches, []
+        return {'endtime': endtime,
+                'matches': matches,
+                'starttime': rule['starttime'],
+                'original_starttime': rule['original_starttime'],
+                'num_hits': state.num_hits,
+                'num_dupes': state.num_dupes,
+                'cumulative_hits': state.cumulative_hits}
+
+    async def find_matches_async(self, rule, endtime, starttime=None):
+        """ Runs find_matches for a rule on the event loop of the asyncio query engine and returns its matches
+        like find_matches_for_coordinator. Hits are counted in a state of their own instead of thread_data,
+        as the rules running on the event loop share its thread. """
+        state = types.SimpleNamespace(total_hits=0)
+        client = self.query_engine.client(self.es_clients.get(rule, elasticsearch_client))
+        loop = asyncio.get_event_loop()
+
+        # Looking up the last run searches the writeback index
+        if not await loop.run_in_executor(None, self.start_find_matches, rule, endtime, starttime, state):
+            return self.get_found_matches(rule, None, state)
+
+        if rule.get('segment_target_hits'):
+            # Probing the hits of the rule is synchronous
+            segments, endtime = await loop.run_in_executor(None, self.get_query_segments, rule, endtime, client.client)
+        else:
+            segments, endtime = self.get_query_segments(rule, endtime)
+        for start, end, last in segments:
+            if not await self.run_query_async(rule, start, end, state, client):
+                return self.get_found_matches(rule, None, state)
+            await loop.run_in_executor(None, self.count_segment_hits, rule, end, last, state)
+        return self.get_found_matches(rule, endtime, state)
+
+    async def run_query_async(self, rule, start, end, state, client):
+        """ The asyncio version of run_query. """
+        start, end, index = self.get_query_range(rule, start, end)
+        loop = asyncio.get_event_loop()
+        if rule.get('use_count_query'):
+            query = self.get_hits_count_query(rule, start, end)
+            try:
+                res = await client.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
+            except ElasticsearchException as e:
+                await loop.run_in_executor(None, self.handle_query_error, rule, e, 'Error running count query: %s', query)
+                return False
+            data = self.handle_count_response(rule, res, start, end, state)
+        elif rule.get('use_terms_query'):
+            query = self.get_hits_terms_query(rule, start, end, rule['query_key'])
+            try:
+                res = await self.search_without_hits_async(rule, index, query, client)
+            except ElasticsearchException as e:
+                await loop.run_in_executor(None, self.handle_query_error, rule, e, 'Error running terms query: %s', query)
+                return False
+            data = self.handle_terms_response(rule, res, start, end, state)
+        elif rule.get('aggregation_query_element'):
+            query = self.get_hits_aggregation_query(rule, start, end, rule.get('query_key', None))
+            try:
+                res = await self.search_without_hits_async(rule, index, query, client)
+            except ElasticsearchException as e:
+                await loop.run_in_executor(None, self.handle_query_error, rule, e, 'Error running query: %s')
+                return False
+            data = self.handle_aggregation_response(rule, res, end, state, client)
+        else:
+            try:
+                return await self.run_paginated_query_async(rule, start, end, index, state, client)
+            finally:
+                await self.clear_pagination_async(rule, client)
+        # The rule type runs in a thread, not to hold up the queries of other rules
+        return await loop.run_in_executor(None, self.add_query_data, rule, data)
+
+    @staticmethod
+    async def search_without_hits_async(rule, index, query, client):
+        """ Runs the query of a terms or aggregation rule. """
+        if not rule['five']:
+            return await client.deprecated_search(index=index, doc_type=rule.get('doc_type'), body=query,
+                                                  search_type='count', ignore_unavailable=True)
+        return await client.deprecated_search(index=index, doc_type=rule.get('doc_type'), body=query, size=0,
+                                              ignore_unavailable=True)
+
+    async def run_paginated_query_async(self, rule, start, end, index, state, client):
+        """ The asyncio version of run_paginated_query. """
+        scroll = False
+        while True:
+            data = await self.get_hits_async(rule, start, end, index, state, client, scroll)
+            # There was an exception while querying
+            if data is None:
+                return False
+            if data:
+                # The rule type runs in a thread, not to hold up the queries of other rules
+                added = await asyncio.get_event_loop().run_in_executor(None, self.add_data_in_chunks, rule, data)
+                state.num_dupes += len(data) - added
+
+            if not self.has_next_page(rule, state) or not should_scrolling_continue(rule):
+                return True
+            rule['scrolling_cycle'] += 1
+            scroll = True
+
+    async def get_hits_async(self, rule, starttime, endtime, index, state, client, scroll=False):
+        """ The asyncio version of get_hits. """
+        query, extra_args = self.get_hits_query(rule, starttime, endtime, client)
+        scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
+        size = rule.get('max_query_size', self.max_query_size)
+
+        try:
+            if not scroll and self.point_in_time_enabled(rule, client):
+                res = await client.open_point_in_time(index=index, keep_alive=scroll_keepalive, ignore_unavailable=True)
+                rule['pit_id'] = res['id']
+
+            if 'pit_id' in rule:
+                body, page_args = self.get_point_in_time_query(rule, query, scroll_keepalive, extra_args)
+                res = await client.point_in_time_search(body=body, size=size, **page_args)
+                rule['pit_id'] = res.get('pit_id', rule['pit_id'])
+            elif scroll:
+                res = await client.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
             else:
-                endtime = tmp_endtime
+                res = await client.search(scroll=scroll_keepalive, index=index, size=size, body=query,
+                                          ignore_unavailable=True, **extra_args)
+                if '_scroll_id' in res:
+                    rule['scroll_id'] = res['_scroll_id']
+
+            self.check_shard_failures(res)
+        except ElasticsearchException as e:
+            await asyncio.get_event_loop().run_in_executor(None, self.handle_query_error, rule, e, 'Error running query: %s', query)
+            return None
+        return self.handle_hits_response(rule, res, starttime, endtime, size, scroll, state, client)
+
+    @staticmethod
+    async def clear_pagination_async(rule, client):
+        """ The asyncio version of clear_pagination. """
+        rule.pop('search_after', None)
+        if 'pit_id' in rule:
+            pit_id = rule.pop('pit_id')
+            try:
+                await client.close_point_in_time(body={'id': pit_id})
+            except NotFoundError:
+                pass
+        if 'scroll_id' in rule:
+            scroll_id = rule.pop('scroll_id')
+            try:
+                await client.clear_scroll(scroll_id=scroll_id)
+            except NotFoundError:
+                pass
+
+    def run_rule(self, rule, endtime, starttime=None, found=None):
+        """ Run a rule for a given time period, including querying and alerting on results.
+
+        :param rule: The rule configuration.
+        :param starttime: The earliest timestamp to query.
+        :param endtime: The latest timestamp to query.
+        :param found: A future of the matches of the rule, as returned by find_matches_for_coordinator,
+            if they were found by a rule worker process or the asyncio query engine instead of here.
+        :return: The number of matches that the rule produced.
+        """
+        run_start = time.time()
+        self.thread_data.current_es = self.es_clients.get(rule, elasticsearch_client)
+
+        # If there are pending aggregate matches, try processing them
+        for match in rule['agg_matches'].drain():
+            self.add_aggregated_alert(match, rule)
+
+        if found is None and self.rule_workers is not None:
+            # The worker process of the rule queries and matches, and the matches are handled here
+            timeout = total_seconds(self.rule_worker_timeout or rule['run_every'] * 10)
+            # The pool fails the future if the worker exits, or runs the rule for longer than timeout
+            found = self.rule_workers.submit(rule['name'], endtime, starttime, timeout)
+        if found is not None:
+            result = found.result()
+            rule['starttime'] = result['starttime']
+            rule['original_starttime'] = result['original_starttime']
+            rule['type'].matches = result['matches']
+            self.thread_data.num_hits = result['num_hits']
+            self.thread_data.num_dupes = result['num_dupes']
+            self.thread_data.cumulative_hits = result['cumulative_hits']
+            endtime = result['endtime']
         else:
-            if not self.run_query(rule, rule['starttime'], endtime):
-                return 0
-            self.thread_data.cumulative_hits += self.thread_data.num_hits
-            rule['type'].garbage_collect(endtime)
+            endtime = self.find_matches(rule, endtime, starttime)
+        if endtime is None:
+            return 0
 
         # Process any new matches
         num_matches = len(rule['type'].matches)
+        # The silences set by this run, written together once every match is processed
+        silences = {}
         while rule['type'].matches:
             match = rule['type'].matches.pop(0)
             match['num_hits'] = self.thread_data.cumulative_hits
@@ -965,7 +1601,7 @@ class ElastAlerter(object):
 
             if rule['realert']:
                 next_alert, exponent = self.next_alert_time(rule, silence_cache_key, ts_now())
-                self.set_realert(silence_cache_key, next_alert, exponent)
+                self.set_realert(silence_cache_key, next_alert, exponent, silences)
 
             if rule.get('run_enhancements_first'):
                 try:
@@ -985,6 +1621,8 @@ class ElastAlerter(object):
             # Add it as an aggregated match
             self.add_aggregated_alert(match, rule)
 
+        self.write_silences(silences)
+
         # Mark this endtime for next run's start
         rule['previous_endtime'] = endtime
 
@@ -998,13 +1636,14 @@ class ElastAlerter(object):
                 '@timestamp': ts_now(),
                 'time_taken': time_taken}
         self.writeback('elastalert_status', body)
+        self.snapshot_rule_state(rule, endtime)
 
         return num_matches
 
     def init_rule(self, new_rule, new=True):
         ''' Copies some necessary non-config state from an exiting rule to a new rule. '''
-        if not new and self.scheduler.get_job(job_id=new_rule['name']):
-            self.scheduler.remove_job(job_id=new_rule['name'])
+        if not new:
+            self.unschedule_rule(new_rule['name'])
 
         try:
             self.modify_rule_for_ES5(new_rule)
@@ -1037,10 +1676,10 @@ class ElastAlerter(object):
             else:
                 raise EAException("Could not download filters from %s" % (new_rule['filter']['download_dashboard']))
 
-        blank_rule = {'agg_matches': [],
+        blank_rule = {'agg_matches': AggregationBuffer(),
                       'aggregate_alert_time': {},
                       'current_aggregate_id': {},
-                      'processed_hits': {},
+                      'processed_hits': self.new_processed_hits(new_rule),
                       'run_every': self.run_every,
                       'has_run_once': False}
         rule = blank_rule
@@ -1065,20 +1704,113 @@ class ElastAlerter(object):
                 continue
             new_rule[prop] = rule[prop]
 
+        if rule is not blank_rule:
+            new_rule['processed_hits'] = self.reload_processed_hits(rule, new_rule)
+            self.copy_rule_state(rule, new_rule)
+        elif new:
+            self.restore_rule_state(new_rule)
+
+        self.schedule_rule(new_rule)
+
+        return new_rule
+
+    def copy_rule_state(self, rule, new_rule):
+        """ Keeps the state of the RuleType of a reloaded rule if rule_state_store is set, unless its rule type
+        or query_key changed. """
+        if self.rule_state_store is None:
+            return
+        if type(rule['type']) is not type(new_rule['type']) or rule.get('query_key') != new_rule.get('query_key'):
+            return
+        state = rule['type'].get_state()
+        if state is not None:
+            new_rule['type'].set_state(state)
+
+    def restore_rule_state(self, rule):
+        """ Restores the last snapshot of the state of the RuleType of rule taken by snapshot_rule_state, and makes
+        the rule run on from the end of the run the snapshot was taken after. """
+        if self.rule_state_store is None:
+            return
+        try:
+            data = self.rule_state_store.load(rule['name'])
+            if data is None:
+                return
+            snapshot = loads_state(data)
+            if snapshot['type'] != type(rule['type']).__name__ or snapshot['query_key'] != rule.get('query_key'):
+                elastalert_logger.info('Not restoring the state of %s, its type or query_key changed' % (rule['name']))
+                return
+            if ts_now() - snapshot['endtime'] > self.old_query_limit:
+                elastalert_logger.info('Not restoring the state of %s as of %s, which is older than old_query_limit' %
+                                       (rule['name'], pretty_ts(snapshot['endtime'])))
+                return
+            rule['type'].set_state(snapshot['state'])
+        except (ElasticsearchException, OSError, ValueError, KeyError, TypeError) as e:
+            elastalert_logger.warning('Error restoring the state of %s: %s' % (rule['name'], e))
+            return
+        # Query on from the snapshot, so that no events are missed nor counted twice
+        rule['starttime'] = rule['minimum_starttime'] = rule['previous_endtime'] = snapshot['endtime']
+        elastalert_logger.info('Restored the state of %s as of %s' % (rule['name'], pretty_ts(snapshot['endtime'])))
+
+    def snapshot_rule_state(self, rule, endtime):
+        """ Saves the state of the RuleType of rule after a run up to endtime to rule_state_store, at most once
+        per rule_state_interval. Rules run by rule worker processes keep their state in those processes. """
+        if self.rule_state_store is None or self.rule_workers is not None or self.debug:
+            return
+        if time.time() - rule.get('state_snapshot_time', 0) < total_seconds(self.rule_state_interval):
+            return
+        state = rule['type'].get_state()
+        if state is None:
+            return
+        try:
+            data = dumps_state({'type': type(rule['type']).__name__,
+                                'query_key': rule.get('query_key'),
+                                'endtime': endtime,
+                                'state': state})
+            self.rule_state_store.save(rule['name'], data)
+        except TypeError as e:
+            elastalert_logger.warning('Cannot snapshot the state of %s: %s' % (rule['name'], e))
+        except (ElasticsearchException, OSError) as e:
+            elastalert_logger.warning('Error saving the state of %s: %s' % (rule['name'], e))
+        else:
+            rule['state_snapshot_time'] = time.time()
+
+    def schedule_rule(self, rule):
+        """ Runs rule every run_every, starting within 15 seconds. """
+        if self.rule_scheduler is not None:
+            self.rule_scheduler.add(rule['name'], self.handle_rule_execution, [rule],
+                                    rule['run_every'].total_seconds(),
+                                    priority=self.get_rule_priority(rule),
+                                    slack=total_seconds(rule.get('query_delay', datetime.timedelta(0))),
+                                    next_run=time.time() + random.randint(0, 15))
+            return
         job = self.scheduler.add_job(self.handle_rule_execution, 'interval',
-                                     args=[new_rule],
-                                     seconds=new_rule['run_every'].total_seconds(),
-                                     id=new_rule['name'],
+                                     args=[rule],
+                                     seconds=rule['run_every'].total_seconds(),
+                                     id=rule['name'],
                                      max_instances=1,
                                      jitter=5)
         job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=random.randint(0, 15)))
 
-        return new_rule
+    def unschedule_rule(self, name):
+        """ Stops running the rule name. """
+        if self.rule_scheduler is not None:
+            self.rule_scheduler.remove(name)
+        elif self.scheduler.get_job(job_id=name):
+            self.scheduler.remove_job(job_id=name)
+
+    def get_rule_priority(self, rule):
+        """ Returns the position of the priority_class of rule in priority_classes, 0 being the highest priority.
+        Rules without a known class are in the default class, which comes last unless it is listed. """
+        priority_class = rule.get('priority_class', 'default')
+        if priority_class not in self.priority_classes:
+            priority_class = 'default'
+        if priority_class in self.priority_classes:
+            return self.priority_classes.index(priority_class)
+        return len(self.priority_classes)
 
     @staticmethod
     def modify_rule_for_ES5(new_rule):
-        # Get ES version per rule
-        rule_es = elasticsearch_client(new_rule)
+        # Get ES version per rule, from the client shared by every rule on the same cluster
+        rule_es = es_client_pool.get(new_rule, elasticsearch_client)
         if rule_es.is_atleastfive():
             new_rule['five'] = True
         else:
@@ -1109,7 +1841,7 @@ class ElastAlerter(object):
                         break
                 else:
                     continue
-                self.scheduler.remove_job(job_id=rule['name'])
+                self.unschedule_rule(rule['name'])
                 self.rules.remove(rule)
                 continue
             if hash_value != new_rule_hashes[rule_file]:
@@ -1119,13 +1851,16 @@ class ElastAlerter(object):
                     if not new_rule:
                         elastalert_logger.error('Invalid rule file skipped: %s' % rule_file)
                         continue
+                    if not self.rules_loader.is_included(new_rule):
+                        # Renamed to a rule which this process does not run
+                        self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
+                        continue
                     if 'is_enabled' in new_rule and not new_rule['is_enabled']:
                         elastalert_logger.info('Rule file %s is now disabled.' % (rule_file))
                         # Remove this rule if it's been disabled
                         self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
                         # Stop job if is running
-                        if self.scheduler.get_job(job_id=new_rule['name']):
-                            self.scheduler.remove_job(job_id=new_rule['name'])
+                        self.unschedule_rule(new_rule['name'])
                         # Append to disabled_rule
                         for disabled_rule in self.disabled_rules:
                             if disabled_rule['name'] == new_rule['name']:
@@ -1167,7 +1902,7 @@ class ElastAlerter(object):
                     if not new_rule:
                         elastalert_logger.error('Invalid rule file skipped: %s' % rule_file)
                         continue
-                    if 'is_enabled' in new_rule and not new_rule['is_enabled']:
+                    if not self.rules_loader.is_included(new_rule) or ('is_enabled' in new_rule and not new_rule['is_enabled']):
                         continue
                     if new_rule['name'] in [rule['name'] for rule in self.rules]:
                         raise EAException("A rule with the name %s already exists" % (new_rule['name']))
@@ -1177,11 +1912,15 @@ class ElastAlerter(object):
                     continue
                 if self.init_rule(new_rule):
                     elastalert_logger.info('Loaded new rule %s' % (rule_file))
-                    if new_rule['name'] in self.es_clients:
-                        self.es_clients.pop(new_rule['name'])
                     self.rules.append(new_rule)
 
         self.rule_hashes = new_rule_hashes
+        # Close the connections of the clusters which no rule queries anymore
+        released = self.es_clients.release_unused([self.conf] + self.rules)
+        if released:
+            elastalert_logger.info('Released %s Elasticsearch clients which no rule uses' % (len(released)))
+            if self.query_engine is not None:
+                self.query_engine.release(released)
 
     def start(self):
         """ Periodically go through each rule and run it """
@@ -1199,12 +1938,43 @@ class ElastAlerter(object):
             rule['initial_starttime'] = self.starttime
         self.wait_until_responsive(timeout=self.args.timeout)
         self.running = True
+        if self.conf.get('writeback_bulk_size'):
+            self.writeback_queue = WritebackQueue(self.writeback_es, self.conf['writeback_bulk_size'],
+                                                  total_seconds(self.conf.get('writeback_flush_interval',
+                                                                              datetime.timedelta(seconds=1))),
+                                                  self.spool_writeback_actions if self.writeback_spool is not None else None)
+        if self.conf.get('rule_processes'):
+            self.rule_workers = RuleWorkerPool(self.argv, self.conf['rule_processes'])
+            elastalert_logger.info('Running rules in %s worker processes' % (self.conf['rule_processes']))
+        elif self.conf.get('query_engine') == 'asyncio' and not QueryEngine.available():
+            elastalert_logger.warning('The asyncio query engine needs aiohttp, install elastalert2[async] to use it. '
+                                      'Querying on threads instead')
+        elif self.conf.get('query_engine') == 'asyncio':
+            self.query_engine = QueryEngine(self.conf.get('query_engine_connections', 100),
+                                            self.conf.get('query_engine_threads', 4))
+            elastalert_logger.info('Querying on the asyncio query engine')
+        # Restore the alerts and silences of a writeback outage before any rule runs
+        self.replay_writeback_spool()
+        self.refresh_silences()
+        if self.instance_id is not None:
+            # Join the cluster before any rule runs, so that only the rules of this instance are run
+            self.cluster_heartbeat()
+            self.scheduler.add_job(self.cluster_heartbeat, 'interval',
+                                   seconds=self.conf.get('cluster_heartbeat_interval',
+                                                         datetime.timedelta(seconds=30)).total_seconds(),
+                                   id='_internal_cluster_heartbeat')
         elastalert_logger.info("Starting up")
         self.scheduler.add_job(self.handle_pending_alerts, 'interval',
                                seconds=self.run_every.total_seconds(), id='_internal_handle_pending_alerts')
         self.scheduler.add_job(self.handle_config_change, 'interval',
                                seconds=self.run_every.total_seconds(), id='_internal_handle_config_change')
+        if self.conf.get('silence_compaction_interval'):
+            self.scheduler.add_job(self.compact_silences, 'interval',
+                                   seconds=self.conf['silence_compaction_interval'].total_seconds(),
+                                   id='_internal_compact_silences')
         self.scheduler.start()
+        if self.rule_scheduler is not None:
+            self.rule_scheduler.start()
         while self.running:
             next_run = datetime.datetime.utcnow() + self.run_every
 
@@ -1213,6 +1983,10 @@ class ElastAlerter(object):
                 endtime = ts_to_dt(self.args.end)
 
                 if next_run.replace(tzinfo=dateutil.tz.tzutc()) > endtime:
+                    self.leave_cluster()
+                    self.close_query_engine()
+                    self.close_rule_workers()
+                    self.close_writeback()
                     exit(0)
 
             if next_run < datetime.datetime.utcnow():
@@ -1271,6 +2045,8 @@ class ElastAlerter(object):
 
     def handle_pending_alerts(self):
         self.thread_data.alerts_sent = 0
+        self.replay_writeback_spool()
+        self.refresh_silences()
         self.send_pending_alerts()
         elastalert_logger.info("Background alerts thread %s pending alerts sent at %s" % (self.thread_data.alerts_sent,
                                                                                           pretty_ts(ts_now())))
@@ -1278,11 +2054,39 @@ class ElastAlerter(object):
     def handle_config_change(self):
         if not self.args.pin_rules:
             self.load_rule_changes()
+            if self.rule_workers is not None:
+                self.rule_workers.reload()
             elastalert_logger.info("Background configuration change check run at %s" % (pretty_ts(ts_now())))
 
     def handle_rule_execution(self, rule):
-        self.thread_data.alerts_sent = 0
+        if not self.owns_rule(rule):
+            # Run by another instance of the cluster
+            return
         next_run = datetime.datetime.utcnow() + rule['run_every']
+        endtime = self.prepare_rule_execution(rule)
+        if endtime is None:
+            return
+
+        if self.use_query_engine(rule):
+            # The job returns at once, and the rule is run on the event loop of the engine
+            if self.query_engine.submit(rule['name'], self.run_rule_async(rule, endtime, next_run)) is None:
+                elastalert_logger.warning('Skipping run of %s, its previous run is still running' % (rule['name']))
+            return
+        self.execute_rule(rule, endtime, next_run)
+
+    def use_query_engine(self, rule):
+        """ Returns whether rule is run on the asyncio query engine. """
+        return self.query_engine is not None and self.query_engine.supports(self.es_clients.get(rule, elasticsearch_client))
+
+    async def run_rule_async(self, rule, endtime, next_run):
+        """ Runs rule on the asyncio query engine. The rule is queried on the event loop, and its matches are
+        handled by execute_rule in a thread of the engine. """
+        found = asyncio.ensure_future(self.find_matches_async(rule, endtime, rule.get('initial_starttime')))
+        await asyncio.wait([found])
+        await asyncio.get_event_loop().run_in_executor(None, self.execute_rule, rule, endtime, next_run, found)
+
+    def prepare_rule_execution(self, rule):
+        """ Returns the endtime of the next run of rule, or None if limit_execution pauses the rule. """
         # Set endtime based on the rule's delay
         delay = rule.get('query_delay')
         if hasattr(self.args, 'end') and self.args.end:
@@ -1307,11 +2111,16 @@ class ElastAlerter(object):
                     rule['next_min_starttime'] = rule['next_starttime']
                 if not rule['has_run_once']:
                     self.reset_rule_schedule(rule)
-                    return
+                    return None
 
         rule['has_run_once'] = True
+        return endtime
+
+    def execute_rule(self, rule, endtime, next_run, found=None):
+        """ Runs rule up to endtime, see run_rule, and reports how the run went. """
+        self.thread_data.alerts_sent = 0
         try:
-            num_matches = self.run_rule(rule, endtime, rule.get('initial_starttime'))
+            num_matches = self.run_rule(rule, endtime, rule.get('initial_starttime'), found)
         except EAException as e:
             self.handle_error("Error running rule %s: %s" % (rule['name'], e), {'rule': rule['name']})
         except Exception as e:
@@ -1338,6 +2147,21 @@ class ElastAlerter(object):
                     self.statsd.gauge(
                         'query.alerts_sent', self.thread_data.alerts_sent,
                         tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
+                    job = self.rule_scheduler.get_job(rule['name']) if self.rule_scheduler is not None else None
+                    if job is not None:
+                        self.statsd.gauge(
+                            'rule.lag', job.lag,
+                            tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
+                        self.statsd.gauge(
+                            'rule.dropped_runs', job.dropped_runs,
+                            tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
+                    if isinstance(rule['type'], NewTermsRule):
+                        self.statsd.gauge(
+                            'new_terms.seen', rule['type'].num_seen_terms,
+                            tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
+                        self.statsd.gauge(
+                            'new_terms.bytes', rule['type'].seen_terms_bytes,
+                            tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
                 except BaseException as e:
                     elastalert_logger.error("unable to send metrics:\n%s" % str(e))
 
@@ -1364,7 +2188,10 @@ class ElastAlerter(object):
     def reset_rule_schedule(self, rule):
         # We hit the end of a execution schedule, pause ourselves until next run
         if rule.get('limit_execution') and rule['next_starttime']:
-            self.scheduler.modify_job(job_id=rule['name'], next_run_time=rule['next_starttime'])
+            if self.rule_scheduler is not None:
+                self.rule_scheduler.reschedule(rule['name'], dt_to_unix(rule['next_starttime']))
+            else:
+                self.scheduler.modify_job(job_id=rule['name'], next_run_time=rule['next_starttime'])
             # If we are preventing covering non-scheduled time periods, reset min_starttime and previous_endtime
             if rule['next_min_starttime']:
                 rule['minimum_starttime'] = rule['next_min_starttime']
@@ -1374,6 +2201,24 @@ class ElastAlerter(object):
     def stop(self):
         """ Stop an ElastAlert runner that's been started """
         self.running = False
+        if self.rule_scheduler is not None:
+            self.rule_scheduler.shutdown(0)
+        self.leave_cluster()
+        self.close_query_engine()
+        self.close_rule_workers()
+        self.close_writeback()
+
+    def close_query_engine(self):
+        """ Waits for the rules running on the asyncio query engine and stops it. """
+        if self.query_engine is not None:
+            query_engine, self.query_engine = self.query_engine, None
+            query_engine.close()
+
+    def close_rule_workers(self):
+        """ Stops the rule worker processes. """
+        if self.rule_workers is not None:
+            rule_workers, self.rule_workers = self.rule_workers, None
+            rule_workers.close()
 
     def get_disabled_rules(self):
         """ Return disabled rules """
@@ -1452,7 +2297,7 @@ class ElastAlerter(object):
                    'dashboard': db_js}
 
         # Upload
-        es = elasticsearch_client(rule)
+        es = self.es_clients.get(rule, elasticsearch_client)
         # TODO: doc_type = _doc for elastic >= 6
         res = es.index(index='kibana-int',
                        doc_type='temp',
@@ -1467,7 +2312,7 @@ class ElastAlerter(object):
 
     def get_dashboard(self, rule, db_name):
         """ Download dashboard which matches use_kibana_dashboard from Elasticsearch. """
-        es = elasticsearch_client(rule)
+        es = self.es_clients.get(rule, elasticsearch_client)
         if not db_name:
             raise EAException("use_kibana_dashboard undefined")
         query = {'query': {'term': {'_id': db_name}}}
@@ -1653,7 +2498,7 @@ class ElastAlerter(object):
             body['alert_exception'] = alert_exception
         return body
 
-    def writeback(self, doc_type, body, rule=None, match_body=None):
+    def get_writeback_body(self, body):
         # ES 2.0 - 2.3 does not support dots in field names.
         if self.replace_dots_in_field_names:
             writeback_body = replace_dots_in_field_names(body)
@@ -1664,6 +2509,10 @@ class ElastAlerter(object):
             # Convert any datetime objects to timestamps
             if isinstance(writeback_body[key], datetime.datetime):
                 writeback_body[key] = dt_to_ts(writeback_body[key])
+        return writeback_body
+
+    def writeback(self, doc_type, body, rule=None, match_body=None):
+        writeback_body = self.get_writeback_body(body)
 
         if self.debug:
             elastalert_logger.info("Skipping writing to ES: %s" % (writeback_body))
@@ -1671,9 +2520,13 @@ class ElastAlerter(object):
 
         if '@timestamp' not in writeback_body:
             writeback_body['@timestamp'] = dt_to_ts(ts_now())
+        self.add_writeback_id(doc_type, writeback_body)
 
+        index = None
         try:
             index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+            if self.writeback_queue is not None:
+                return self.writeback_queue.add(index, body, None if self.writeback_es.is_atleastsixtwo() else doc_type)
             if self.writeback_es.is_atleastsixtwo():
                 res = self.writeback_es.index(index=index, body=body)
             else:
@@ -1681,41 +2534,156 @@ class ElastAlerter(object):
             return res
         except ElasticsearchException as e:
             elastalert_logger.exception("Error writing alert info to Elasticsearch: %s" % (e))
+            if self.writeback_spool is not None:
+                _id = self.writeback_spool.append([(index, doc_type, None, body)])[0]
+                return {'_index': index, '_id': _id, 'result': 'spooled'}
 
-    def find_recent_pending_alerts(self, time_limit):
-        """ Queries writeback_es to find alerts that did not send
-        and are newer than time_limit """
+    @staticmethod
+    def add_writeback_id(doc_type, body):
+        """ Gives the alerts and silences a unique writeback_id, which breaks the ties of the sorts paging through
+        them before ES 7.12, see :meth:`get_writeback_tiebreaker`. Unlike _id, it is a keyword with doc values. """
+        if doc_type in ('elastalert', 'silence'):
+            body.setdefault('writeback_id', uuid.uuid4().hex)
+
+    def writeback_bulk(self, doc_type, bodies):
+        """ Writes bodies to the writeback index in one _bulk request, or queues them if writeback_bulk_size is set.
+        Documents which could not be written are spooled if writeback_spool_path is set. """
+        bodies = [self.get_writeback_body(body) for body in bodies]
+        if self.debug:
+            for body in bodies:
+                elastalert_logger.info("Skipping writing to ES: %s" % (body))
+            return
 
-        # XXX only fetches 1000 results. If limit is reached, next loop will catch them
-        # unless there is constantly more than 1000 alerts to send.
+        for body in bodies:
+            if '@timestamp' not in body:
+                body['@timestamp'] = dt_to_ts(ts_now())
+            self.add_writeback_id(doc_type, body)
 
+        index = None
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+            _type = None if self.writeback_es.is_atleastsixtwo() else doc_type
+            if self.writeback_queue is not None:
+                for body in bodies:
+                    self.writeback_queue.add(index, body, _type)
+                return
+            actions = []
+            for body in bodies:
+                actions += [{'index': {'_index': index, '_type': _type} if _type else {'_index': index}}, body]
+            res = self.writeback_es.bulk(body=actions)
+            retry = []
+            for body, item in zip(bodies, res['items']):
+                if 'error' in item['index']:
+                    elastalert_logger.error('Error writing %s document to Elasticsearch: %s' % (doc_type, item['index']['error']))
+                    if is_retryable(item['index']):
+                        retry.append(body)
+        except ElasticsearchException as e:
+            elastalert_logger.exception("Error writing %s %s documents to Elasticsearch: %s" % (len(bodies), doc_type, e))
+            retry = bodies
+        if retry and self.writeback_spool is not None:
+            self.writeback_spool.append([(index, doc_type, None, body) for body in retry])
+
+    def spool_writeback_actions(self, pairs):
+        """ Spools the (action, body) pairs of a _bulk request which could not be written. """
+        self.writeback_spool.append([(action['index']['_index'], action['index'].get('_type'), action['index']['_id'], body)
+                                     for action, body in pairs])
+
+    def send_spooled_writeback(self, documents):
+        """ Writes (index, doc_type, _id, body) tuples from the writeback spool in one _bulk request.
+        Raises ElasticsearchException if any of them should be sent again later. """
+        actions = []
+        for index, doc_type, _id, body in documents:
+            meta = {'_index': index or self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type), '_id': _id}
+            if doc_type and not self.writeback_es.is_atleastsixtwo():
+                meta['_type'] = doc_type
+            actions += [{'index': meta}, body]
+        res = self.writeback_es.bulk(body=actions)
+        retry = 0
+        for item in res['items']:
+            if 'error' in item['index']:
+                if is_retryable(item['index']):
+                    retry += 1
+                else:
+                    elastalert_logger.error('Dropping spooled document %s: %s' % (item['index'].get('_id'), item['index']['error']))
+        if retry:
+            raise ElasticsearchException('%s spooled documents could not be written' % (retry))
+
+    def replay_writeback_spool(self):
+        """ Writes the documents spooled while the writeback index was unavailable. """
+        if not self.writeback_spool:
+            return
+        try:
+            self.writeback_spool.replay(self.send_spooled_writeback)
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Writeback index is still unavailable, keeping %s bytes of spooled documents: %s' %
+                                      (self.writeback_spool.size, e))
+
+    def flush_writeback(self):
+        """ Writes the queued writeback documents, so that they are found by the queries that follow. """
+        if self.writeback_queue is not None:
+            self.writeback_queue.flush()
+
+    def close_writeback(self):
+        """ Writes the queued writeback documents and stops queueing new ones. """
+        if self.writeback_queue is not None:
+            writeback_queue, self.writeback_queue = self.writeback_queue, None
+            writeback_queue.close()
+        if self.writeback_spool is not None:
+            self.writeback_spool.close()
+
+    def find_recent_pending_alerts(self, time_limit, search_after=None, size=1000, pit=None):
+        """ Queries writeback_es to find alerts that did not send
+        and are newer than time_limit. Returns up to size alerts, earliest first.
+        On Elasticsearch 5 and above, the sort values of the last alert can be passed
+        as search_after to get the next ones, in the point in time pit if there is one
+        (see :meth:`open_writeback_point_in_time`). """
+        self.flush_writeback()
         # Fetch recent, unsent alerts that aren't part of an aggregate, earlier alerts first.
         inner_query = {'query_string': {'query': '!_exists_:aggregate_id AND alert_sent:false'}}
         time_filter = {'range': {'alert_time': {'from': dt_to_ts(ts_now() - time_limit),
                                                 'to': dt_to_ts(ts_now())}}}
-        sort = {'sort': {'alert_time': {'order': 'asc'}}}
+        sort = {'sort': [{'alert_time': {'order': 'asc'}}, {'@timestamp': {'order': 'asc'}}]}
         if self.writeback_es.is_atleastfive():
             query = {'query': {'bool': {'must': inner_query, 'filter': time_filter}}}
+            sort['sort'].append(self.get_writeback_tiebreaker(pit))
+            if search_after:
+                query['search_after'] = search_after
         else:
             query = {'query': inner_query, 'filter': time_filter}
         query.update(sort)
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query, size=1000)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index,
-                                                          doc_type='elastalert', body=query, size=1000)
+            res = self.search_writeback('elastalert', query, size, pit)
             if res['hits']['hits']:
                 return res['hits']['hits']
         except ElasticsearchException as e:
             elastalert_logger.exception("Error finding recent pending alerts: %s %s" % (e, query))
         return []
 
-    def send_pending_alerts(self):
-        pending_alerts = self.find_recent_pending_alerts(self.alert_time_limit)
-        for alert in pending_alerts:
-            _id = alert['_id']
-            alert = alert['_source']
+    def send_pending_alerts(self, page_size=1000):
+        search_after = None
+        pit = self.open_writeback_point_in_time('elastalert')
+        try:
+            while True:
+                pending_alerts = self.find_recent_pending_alerts(self.alert_time_limit, search_after, page_size, pit)
+                self.send_pending_alert_page(pending_alerts)
+                # Older versions have no search_after, the next run picks up the rest
+                if len(pending_alerts) < page_size or not self.writeback_es.is_atleastfive():
+                    break
+                search_after = pending_alerts[-1]['sort']
+        finally:
+            self.close_writeback_point_in_time(pit)
+
+        # Send in memory aggregated alerts
+        for rule in self.rules:
+            for aggregation_key_value, alertable_matches in rule['agg_matches'].pop_due(ts_now(), rule['aggregate_alert_time']):
+                self.alert(alertable_matches, rule)
+
+    def send_pending_alert_page(self, pending_alerts):
+        """ Sends the pending alerts which are due, with their aggregated matches, and deletes them
+        from writeback_es in one _bulk request. """
+        due = []
+        for pending_alert in pending_alerts:
+            alert = pending_alert['_source']
             try:
                 rule_name = alert.pop('rule_name')
                 alert_time = alert.pop('alert_time')
@@ -1731,81 +2699,135 @@ class ElastAlerter(object):
             else:
                 # Original rule is missing, keep alert for later if rule reappears
                 continue
-
-            # Set current_es for top_count_keys query
-            self.thread_data.current_es = elasticsearch_client(rule)
+            if not self.owns_rule(rule):
+                # Sent by the instance which runs the rule
+                continue
 
             # Send the alert unless it's a future alert
             if ts_now() > ts_to_dt(alert_time):
-                aggregated_matches = self.get_aggregated_matches(_id)
-                if aggregated_matches:
-                    matches = [match_body] + [agg_match['match_body'] for agg_match in aggregated_matches]
-                    self.alert(matches, rule, alert_time=alert_time)
-                else:
-                    # If this rule isn't using aggregation, this must be a retry of a failed alert
-                    retried = False
-                    if not rule.get('aggregation'):
-                        retried = True
-                    self.alert([match_body], rule, alert_time=alert_time, retried=retried)
-
-                if rule['current_aggregate_id']:
-                    for qk, agg_id in rule['current_aggregate_id'].items():
-                        if agg_id == _id:
-                            rule['current_aggregate_id'].pop(qk)
-                            break
-
-                # Delete it from the index
-                try:
-                    if self.writeback_es.is_atleastsixtwo():
-                        self.writeback_es.delete(index=self.writeback_index, id=_id)
-                    else:
-                        self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=_id)
-                except ElasticsearchException:  # TODO: Give this a more relevant exception, try:except: is evil.
-                    self.handle_error("Failed to delete alert %s at %s" % (_id, alert_time))
+                due.append((pending_alert, rule, alert_time, match_body))
 
-        # Send in memory aggregated alerts
-        for rule in self.rules:
-            if rule['agg_matches']:
-                for aggregation_key_value, aggregate_alert_time in rule['aggregate_alert_time'].items():
-                    if ts_now() > aggregate_alert_time:
-                        alertable_matches = [
-                            agg_match
-                            for agg_match
-                            in rule['agg_matches']
-                            if self.get_aggregation_key_value(rule, agg_match) == aggregation_key_value
-                        ]
-                        self.alert(alertable_matches, rule)
-                        rule['agg_matches'] = [
-                            agg_match
-                            for agg_match
-                            in rule['agg_matches']
-                            if self.get_aggregation_key_value(rule, agg_match) != aggregation_key_value
-                        ]
-
-    def get_aggregated_matches(self, _id):
-        """ Removes and returns all matches from writeback_es that have aggregate_id == _id """
-
-        # XXX if there are more than self.max_aggregation matches, you have big alerts and we will leave entries in ES.
-        query = {'query': {'query_string': {'query': 'aggregate_id:"%s"' % (_id)}}, 'sort': {'@timestamp': 'asc'}}
-        matches = []
-        try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query,
-                                               size=self.max_aggregation)
+        aggregated_matches = self.get_aggregated_matches([pending_alert['_id'] for pending_alert, _, _, _ in due])
+        processed = []
+        for pending_alert, rule, alert_time, match_body in due:
+            _id = pending_alert['_id']
+            # Set current_es for top_count_keys query
+            self.thread_data.current_es = self.es_clients.get(rule, elasticsearch_client)
+
+            agg_matches = aggregated_matches.get(_id, [])
+            if agg_matches:
+                if len(agg_matches) > self.max_aggregation:
+                    elastalert_logger.warning('Dropping %s aggregated matches of alert %s past max_aggregation' %
+                                              (len(agg_matches) - self.max_aggregation, _id))
+                matches = [match_body] + [agg_match['_source']['match_body'] for agg_match in agg_matches[:self.max_aggregation]]
+                self.alert(matches, rule, alert_time=alert_time)
             else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert',
-                                                          body=query, size=self.max_aggregation)
-            for match in res['hits']['hits']:
-                matches.append(match['_source'])
-                if self.writeback_es.is_atleastsixtwo():
-                    self.writeback_es.delete(index=self.writeback_index, id=match['_id'])
-                else:
-                    self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=match['_id'])
+                # If this rule isn't using aggregation, this must be a retry of a failed alert
+                retried = False
+                if not rule.get('aggregation'):
+                    retried = True
+                self.alert([match_body], rule, alert_time=alert_time, retried=retried)
+
+            if rule['current_aggregate_id']:
+                for qk, agg_id in rule['current_aggregate_id'].items():
+                    if agg_id == _id:
+                        rule['current_aggregate_id'].pop(qk)
+                        break
+            processed += [pending_alert] + agg_matches
+
+        # Delete them from the index
+        self.delete_writeback_documents(processed)
+
+    def get_aggregated_matches(self, aggregate_ids):
+        """ Returns all matches from writeback_es which have one of aggregate_ids as aggregate_id,
+        as a dictionary of the hits of each aggregate_id, earliest first. """
+        if not aggregate_ids:
+            return {}
+        self.flush_writeback()
+        query = {'query': {'bool': {'filter': {'terms': {'aggregate_id': aggregate_ids}}}}, 'sort': [{'@timestamp': 'asc'}]}
+        pit = self.open_writeback_point_in_time('elastalert')
+        if self.writeback_es.is_atleastfive():
+            query['sort'].append(self.get_writeback_tiebreaker(pit))
+        matches = {}
+        try:
+            while True:
+                res = self.search_writeback('elastalert', query, self.max_aggregation, pit)
+                hits = res['hits']['hits']
+                for match in hits:
+                    matches.setdefault(match['_source']['aggregate_id'], []).append(match)
+                if len(hits) < self.max_aggregation or not self.writeback_es.is_atleastfive():
+                    break
+                query['search_after'] = hits[-1]['sort']
         except (KeyError, ElasticsearchException) as e:
-            self.handle_error("Error fetching aggregated matches: %s" % (e), {'id': _id})
+            self.handle_error("Error fetching aggregated matches: %s" % (e), {'ids': aggregate_ids})
+        finally:
+            self.close_writeback_point_in_time(pit)
         return matches
 
+    @staticmethod
+    def get_writeback_tiebreaker(pit=None):
+        """ Returns the last sort of writeback documents paged through with search_after. It is unique to each
+        document, so that the documents which share the sort values of the last one of a page are not skipped.
+        In a point in time, that is the _shard_doc of the documents, otherwise their writeback_id. """
+        if pit is not None:
+            return {'_shard_doc': 'asc'}
+        # Documents written before writeback_id are sorted last
+        return {'writeback_id': {'order': 'asc', 'unmapped_type': 'keyword'}}
+
+    def open_writeback_point_in_time(self, doc_type):
+        """ Returns a point in time of the writeback documents of doc_type to page through on ES 7.12+,
+        or None if there is none, see :meth:`search_writeback`. """
+        if not self.writeback_es.is_atleastseventwelve():
+            return None
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+        try:
+            res = self.writeback_es.open_point_in_time(index=index, keep_alive=self.scroll_keepalive)
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Error opening a point in time of %s, paging without it: %s' % (index, e))
+            return None
+        return {'id': res['id'], 'keep_alive': self.scroll_keepalive}
+
+    def close_writeback_point_in_time(self, pit):
+        if pit is None:
+            return
+        try:
+            self.writeback_es.close_point_in_time(body={'id': pit['id']})
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Error closing a point in time of writeback documents: %s' % (e))
+
+    def search_writeback(self, doc_type, query, size, pit=None, **params):
+        """ Searches the writeback documents of doc_type, or the point in time pit if it is not None. """
+        if pit is not None:
+            res = self.writeback_es.point_in_time_search(body=dict(query, pit=pit), size=size, **params)
+            # The id of a point in time may change between searches
+            pit['id'] = res.get('pit_id', pit['id'])
+            return res
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+        if self.writeback_es.is_atleastsixtwo():
+            return self.writeback_es.search(index=index, body=query, size=size, **params)
+        return self.writeback_es.deprecated_search(index=index, doc_type=doc_type, body=query, size=size, **params)
+
+    def delete_writeback_documents(self, hits):
+        """ Deletes the documents of hits from writeback_es in one _bulk request. """
+        if not hits:
+            return
+        actions = []
+        for hit in hits:
+            meta = {'_index': hit.get('_index', self.writeback_index), '_id': hit['_id']}
+            if not self.writeback_es.is_atleastsixtwo():
+                meta['_type'] = 'elastalert'
+            actions.append({'delete': meta})
+        try:
+            res = self.writeback_es.bulk(body=actions)
+            failed = [item['delete']['_id'] for item in res['items']
+                      if 'error' in item['delete'] and item['delete'].get('status') != 404]
+            if failed:
+                self.handle_error("Failed to delete alerts %s" % (', '.join(failed)))
+        except (KeyError, ElasticsearchException) as e:
+            self.handle_error("Failed to delete %s alerts: %s" % (len(hits), e))
+
     def find_pending_aggregate_alert(self, rule, aggregation_key_value=None):
+        self.flush_writeback()
         query = {'filter': {'bool': {'must': [{'term': {'rule_name': rule['name']}},
                                               {'range': {'alert_time': {'gt': ts_now()}}},
                                               {'term': {'alert_sent': 'false'}}],
@@ -1901,7 +2923,7 @@ class ElastAlerter(object):
 
         # Couldn't write the match to ES, save it in memory for now
         if not res:
-            rule['agg_matches'].append(match)
+            rule['agg_matches'].add(aggregation_key_value, match, alert_time)
 
         return res
 
@@ -1934,23 +2956,240 @@ class ElastAlerter(object):
 
         elastalert_logger.info('Success. %s will be silenced until %s' % (silence_cache_key, silence_ts))
 
-    def set_realert(self, silence_cache_key, timestamp, exponent):
-        """ Write a silence to Elasticsearch for silence_cache_key until timestamp. """
+    def set_realert(self, silence_cache_key, timestamp, exponent, pending=None):
+        """ Write a silence to Elasticsearch for silence_cache_key until timestamp.
+
+        If pending is given, the silence is put into it instead, replacing any earlier silence
+        for silence_cache_key, to be written by :meth:`write_silences`. """
         body = {'exponent': exponent,
                 'rule_name': silence_cache_key,
                 '@timestamp': ts_now(),
                 'until': timestamp}
 
         self.silence_cache[silence_cache_key] = (timestamp, exponent)
+        if pending is not None:
+            pending[silence_cache_key] = body
+            return True
         return self.writeback('silence', body)
 
+    def write_silences(self, pending):
+        """ Writes the silences collected by :meth:`set_realert` in one _bulk request. """
+        if not pending:
+            return
+        if len(pending) == 1:
+            self.writeback('silence', next(iter(pending.values())))
+        else:
+            self.writeback_bulk('silence', list(pending.values()))
+        pending.clear()
+
+    def compact_silences(self, page_size=1000):
+        """ Deletes the silence documents which are superseded by a later until for the same rule_name.
+        is_silenced only ever reads the silence with the latest until. Requires Elasticsearch 5 or above. """
+        if self.debug or not self.writeback_es.is_atleastfive() or not self.is_cluster_leader():
+            return
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'silence')
+        query = {'size': 0,
+                 'aggs': {'rule_names': {'terms': {'field': 'rule_name', 'size': page_size, 'min_doc_count': 2},
+                                         'aggs': {'until': {'max': {'field': 'until'}}}}}}
+        try:
+            if self.writeback_es.is_atleastsixtwo():
+                res = self.writeback_es.search(index=index, body=query)
+            else:
+                res = self.writeback_es.deprecated_search(index=index, doc_type='silence', body=query)
+            superseded = [{'bool': {'filter': [{'term': {'rule_name': bucket['key']}},
+                                               {'range': {'until': {'lt': int(bucket['until']['value']),
+                                                                    'format': 'epoch_millis'}}}]}}
+                          for bucket in res['aggregations']['rule_names']['buckets']]
+            if not superseded:
+                return
+            res = self.writeback_es.delete_by_query(index=index, body={'query': {'bool': {'should': superseded}}},
+                                                    conflicts='proceed')
+            elastalert_logger.info('Deleted %s superseded silences of %s keys' % (res.get('deleted'), len(superseded)))
+        except (KeyError, ElasticsearchException) as e:
+            elastalert_logger.warning('Error compacting silences: %s' % (e))
+
+    def cluster_heartbeat(self):
+        """ Records in writeback_index that this instance is alive, and divides the rules again if
+        instances joined or left the cluster. """
+        body = {'rule_name': MEMBER_PREFIX + self.instance_id,
+                'instance_id': self.instance_id,
+                '@timestamp': dt_to_ts(ts_now())}
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_status')
+            # One document per instance, overwritten by each heartbeat
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.index(index=index, id=body['rule_name'], body=body)
+            else:
+                self.writeback_es.index(index=index, doc_type='elastalert_status', id=body['rule_name'], body=body)
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Error writing cluster heartbeat of %s: %s' % (self.instance_id, e))
+        self.refresh_cluster_members()
+
+    def refresh_cluster_members(self, size=1000):
+        """ Loads the instances which sent a heartbeat within cluster_member_timeout. Keeps the current
+        members if the writeback index cannot be searched. """
+        timeout = self.conf.get('cluster_member_timeout',
+                                3 * self.conf.get('cluster_heartbeat_interval', datetime.timedelta(seconds=30)))
+        filters = [{'prefix': {'rule_name': MEMBER_PREFIX}},
+                   {'range': {'@timestamp': {'gt': dt_to_ts(ts_now() - timeout)}}}]
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': {'filter': filters}}}
+        else:
+            query = {'filter': {'bool': {'must': filters}}}
+
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_status')
+            if self.writeback_es.is_atleastsixtwo():
+                if self.writeback_es.is_atleastsixsix():
+                    res = self.writeback_es.search(index=index, size=size, body=query, _source_includes=['instance_id'])
+                else:
+                    res = self.writeback_es.search(index=index, size=size, body=query, _source_include=['instance_id'])
+            else:
+                res = self.writeback_es.deprecated_search(index=index, doc_type='elastalert_status', size=size,
+                                                          body=query, _source_include=['instance_id'])
+            members = set(hit['_source']['instance_id'] for hit in res['hits']['hits'])
+        except (KeyError, ElasticsearchException) as e:
+            elastalert_logger.warning('Error loading cluster members, keeping the current ones: %s' % (e))
+            return
+        members.add(self.instance_id)
+        self.set_cluster_members(members)
+
+    def set_cluster_members(self, members):
+        """ Divides the rules between members by consistent hashing of their names.
+
+        A rule this instance takes over forgets its start time, so that its first run here starts where
+        the last run of its previous owner ended, as recorded in elastalert_status. The aggregated matches
+        held in memory for a rule this instance gives up are written to the writeback index for its new owner.
+        """
+        members = sorted(members)
+        if members == self.cluster_members:
+            return
+        owned = set(rule['name'] for rule in self.rules if self.owns_rule(rule))
+        self.cluster_members = members
+        self.hash_ring = HashRing(members)
+
+        for rule in self.rules:
+            if not self.owns_rule(rule):
+                if rule['name'] in owned:
+                    for match in rule['agg_matches'].drain():
+                        self.add_aggregated_alert(match, rule)
+            elif rule['name'] not in owned:
+                self.reset_rule_start(rule['name'])
+                if self.rule_workers is not None:
+                    # The worker running the rule keeps its own copy of it
+                    self.rule_workers.reset(rule['name'])
+        self.flush_writeback()
+        elastalert_logger.info('Cluster members are %s, %s of %s rules run on %s' %
+                               (', '.join(members), len([rule for rule in self.rules if self.owns_rule(rule)]),
+                                len(self.rules), self.instance_id))
+
+    def reset_rule_start(self, rule_name):
+        """ Has the next run of the rule named rule_name start where its last run ended, as recorded in elastalert_status. """
+        for rule in self.rules:
+            if rule['name'] == rule_name:
+                for prop in ['starttime', 'previous_endtime', 'minimum_starttime']:
+                    rule.pop(prop, None)
+
+    def owns_rule(self, rule):
+        """ Returns whether this instance runs rule. Outside of cluster_mode, every rule is run. """
+        if self.hash_ring is None:
+            return True
+        return self.hash_ring.owner(rule['name']) == self.instance_id
+
+    def is_cluster_leader(self):
+        """ Returns whether this instance runs the jobs which only one instance of the cluster should run. """
+        return self.cluster_members is None or self.cluster_members[0] == self.instance_id
+
+    def leave_cluster(self):
+        """ Deletes the heartbeat of this instance, so that the others take over its rules at their next heartbeat. """
+        if self.instance_id is None or self.cluster_members is None:
+            return
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_status')
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.delete(index=index, id=MEMBER_PREFIX + self.instance_id)
+            else:
+                self.writeback_es.delete(index=index, doc_type='elastalert_status', id=MEMBER_PREFIX + self.instance_id)
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Error leaving the cluster: %s' % (e))
+        self.cluster_members = None
+        self.hash_ring = None
+
+    def get_silence_ttl(self):
+        """ Returns how long an expired silence is kept for next_alert_time to compute the exponential realert from. """
+        return max([rule.get('exponential_realert', rule['realert']) for rule in self.rules] + [self.run_every])
+
+    def refresh_silences(self, page_size=1000):
+        """ Loads the silences written since the last refresh into silence_cache, so that is_silenced
+        answers from memory instead of searching writeback_es for every match. The first refresh loads
+        every silence which has not expired yet. Expired silences are evicted. If a refresh fails,
+        is_silenced searches again until the next refresh loads every silence. """
+        if self.debug:
+            return
+        self.flush_writeback()
+        now = ts_now()
+        ttl = self.get_silence_ttl()
+        refreshed_at = self.silences_refreshed_at
+        if refreshed_at is None:
+            time_filter = {'range': {'until': {'gt': dt_to_ts(now - ttl)}}}
+        else:
+            # Silences written at the same time as the last one loaded are loaded again
+            time_filter = {'range': {'@timestamp': {'gte': refreshed_at}}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': {'filter': time_filter}}}
+        else:
+            query = {'filter': time_filter}
+        source = ['rule_name', 'until', 'exponent', '@timestamp']
+        if self.writeback_es.is_atleastsixsix():
+            params = {'_source_includes': source}
+        else:
+            params = {'_source_include': source}
+
+        loaded = 0
+        pit = self.open_writeback_point_in_time('silence')
+        try:
+            query['sort'] = [{'@timestamp': {'order': 'asc'}}]
+            if self.writeback_es.is_atleastfive():
+                query['sort'].append(self.get_writeback_tiebreaker(pit))
+            while True:
+                hits = self.search_writeback('silence', query, page_size, pit, **params)['hits']['hits']
+                for hit in hits:
+                    self.cache_silence(hit['_source']['rule_name'], ts_to_dt(hit['_source']['until']),
+                                       hit['_source'].get('exponent', 0))
+                loaded += len(hits)
+                if hits:
+                    refreshed_at = hits[-1]['_source']['@timestamp']
+                # Older versions have no search_after, the next refresh picks up the rest
+                if len(hits) < page_size or not self.writeback_es.is_atleastfive():
+                    break
+                query['search_after'] = hits[-1]['sort']
+        except (KeyError, ElasticsearchException) as e:
+            elastalert_logger.warning('Error loading silences, checking them one by one until the next refresh: %s' % (e))
+            self.silences_refreshed_at = None
+            return
+        finally:
+            self.close_writeback_point_in_time(pit)
+
+        self.silences_refreshed_at = refreshed_at or dt_to_ts(now)
+        for name, (until, exponent) in list(self.silence_cache.items()):
+            if until < now - ttl:
+                self.silence_cache.pop(name, None)
+        elastalert_logger.debug('Loaded %s silences, %s are cached' % (loaded, len(self.silence_cache)))
+
+    def cache_silence(self, rule_name, until, exponent):
+        """ Caches the silence of rule_name until until. The silence with the latest until wins, along with its
+        exponent, like the one is_silenced searches for. """
+        if rule_name not in self.silence_cache or until > self.silence_cache[rule_name][0]:
+            self.silence_cache[rule_name] = (until, exponent)
+
     def is_silenced(self, rule_name):
         """ Checks if rule_name is currently silenced. Returns false on exception. """
         if rule_name in self.silence_cache:
             if ts_now() < self.silence_cache[rule_name][0]:
                 return True
 
-        if self.debug:
+        if self.debug or self.silences_refreshed_at is not None:
+            # Silences are refreshed by refresh_silences
             return False
         query = {'term': {'rule_name': rule_name}}
         sort = {'sort': {'until': {'order': 'desc'}}}
@@ -2005,7 +3244,10 @@ class ElastAlerter(object):
         if self.disable_rules_on_error:
             self.rules = [running_rule for running_rule in self.rules if running_rule['name'] != rule['name']]
             self.disabled_rules.append(rule)
-            self.scheduler.pause_job(job_id=rule['name'])
+            if self.rule_scheduler is not None:
+                self.rule_scheduler.remove(rule['name'])
+            else:
+                self.scheduler.pause_job(job_id=rule['name'])
             elastalert_logger.info('Rule %s disabled', rule['name'])
         if self.notify_email:
             self.send_notification_email(exception=exception, rule=rule)
@@ -2103,8 +3345,10 @@ class ElastAlerter(object):
         return timestamp + wait, exponent
 
 
-def handle_signal(signal, frame):
+def handle_signal(signal, frame, client=None):
     elastalert_logger.info('SIGINT received, stopping ElastAlert...')
+    if client is not None:
+        client.close_writeback()
     # use os._exit to exit immediately and avoid someone catching SystemExit
     os._exit(0)
 
@@ -2114,6 +3358,7 @@ def main(args=None):
     if not args:
         args = sys.argv[1:]
     client = ElastAlerter(args)
+    signal.signal(signal.SIGINT, functools.partial(handle_signal, client=client))
 
     if client.prometheus_port and not client.debug:
         p = PrometheusWrapper(client)
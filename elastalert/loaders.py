@@ -137,6 +137,8 @@ class RulesLoader(object):
             yaml.load(open(os.path.join(os.path.dirname(__file__), 'schema.yaml')), Loader=yaml.FullLoader))
 
         self.base_config = copy.deepcopy(conf)
+        # A function of the name of a rule, set to only build the rules it returns true for
+        self.rule_filter = None
 
     def load(self, conf, args=None):
         """
@@ -164,8 +166,10 @@ class RulesLoader(object):
             except EAException as e:
                 raise EAException('Error loading file %s: %s' % (rule_file, e))
 
-            rules.append(rule)
             names.append(rule['name'])
+            if not self.is_included(rule):
+                continue
+            rules.append(rule)
 
         return rules
 
@@ -217,9 +221,15 @@ class RulesLoader(object):
         """
         rule = self.load_yaml(filename)
         self.load_options(rule, conf, filename, args)
-        self.load_modules(rule, args)
+        if self.is_included(rule):
+            self.load_modules(rule, args)
         return rule
 
+    def is_included(self, rule):
+        """ Returns whether rule_filter lets the rule be built. load_configuration does not build the rule type,
+        alerts and enhancements of the other rules, and load skips them. """
+        return self.rule_filter is None or self.rule_filter(rule['name'])
+
     def load_yaml(self, filename):
         """
         Load the rule including all dependency rules.
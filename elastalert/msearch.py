@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from .util import elastalert_logger
+
+
+class PendingMultiSearch(object):
+    """ The searches collected for one _msearch request against a single client. """
+
+    def __init__(self, client):
+        self.client = client
+        self.body = []
+        self.responses = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.body) // 2
+
+    def add(self, header, body):
+        """ Queues a search and returns its position in the batch. """
+        self.body += [header, body]
+        return len(self) - 1
+
+    def send(self):
+        try:
+            self.responses = self.client.msearch(body=self.body)['responses']
+        except ElasticsearchException as e:
+            self.error = e
+        except Exception as e:
+            # Never leave the other rules of the batch waiting forever
+            self.error = ElasticsearchException('Error running multi search: %s' % (e))
+        finally:
+            self.done.set()
+
+    def result(self, slot):
+        """ Waits for the batch to be sent and returns the response to the search at slot.
+        Raises ElasticsearchException if the request or that search failed. """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        response = self.responses[slot]
+        if 'error' in response:
+            raise ElasticsearchException(str(response['error']))
+        return response
+
+
+class MultiSearchCoalescer(object):
+    """ Sends the searches of rules which run at about the same time against the same cluster
+    together in a single _msearch request.
+
+    The first rule to search opens a batch and waits up to window seconds (or until max_batch_size
+    searches are queued) for other rules to join it, then sends the batch and hands every rule its
+    own response. Clients are shared by every rule on a cluster (see :class:`ElasticSearchClientPool`),
+    so batches are keyed by client.
+
+    :param window: Number of seconds to wait for other searches before sending a batch.
+    :param max_batch_size: The maximum number of searches sent in one _msearch request.
+    """
+
+    def __init__(self, window, max_batch_size=100):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.searches = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def search(self, client, index, body, doc_type=None):
+        """ Runs body as part of the next _msearch sent with client and returns its response,
+        in the same format as :meth:`Elasticsearch.search`. """
+        header = {'index': index, 'ignore_unavailable': True}
+        if doc_type:
+            header['type'] = doc_type
+
+        with self._lock:
+            batch = self._pending.get(id(client))
+            leader = batch is None
+            if leader:
+                batch = PendingMultiSearch(client)
+                self._pending[id(client)] = batch
+            slot = batch.add(header, body)
+            if len(batch) >= self.max_batch_size:
+                # Later searches go into a new batch
+                self._pending.pop(id(client))
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(id(client)) is batch:
+                    self._pending.pop(id(client))
+                self.searches += len(batch)
+                self.batches += 1
+            elastalert_logger.debug('Sending %s searches in one multi search request' % (len(batch)))
+            batch.send()
+
+        return batch.result(slot)
@@ -1,5 +1,7 @@
 import prometheus_client
 
+from .ruletypes import NewTermsRule
+
 
 class PrometheusWrapper:
     """ Exposes ElastAlert metrics on a Prometheus metrics endpoint.
@@ -8,6 +10,7 @@ class PrometheusWrapper:
     def __init__(self, client):
         self.prometheus_port = client.prometheus_port
         self.run_rule = client.run_rule
+        self.rule_scheduler = client.rule_scheduler
         self.writeback = client.writeback
 
         client.run_rule = self.metrics_run_rule
@@ -22,16 +25,51 @@ class PrometheusWrapper:
         self.prom_alerts_not_sent = prometheus_client.Counter('elastalert_alerts_not_sent', 'Number of alerts not sent', ['rule_name'])
         self.prom_errors = prometheus_client.Counter('elastalert_errors', 'Number of errors for rule')
         self.prom_alerts_silenced = prometheus_client.Counter('elastalert_alerts_silenced', 'Number of silenced alerts', ['rule_name'])
+        self.prom_es_clients = prometheus_client.Gauge('elastalert_es_clients', 'Number of shared Elasticsearch clients')
+        self.prom_es_clients.set_function(lambda: len(client.es_clients))
+        self.prom_spool_bytes = prometheus_client.Gauge('elastalert_writeback_spool_bytes', 'Size of the writeback spool')
+        self.prom_spool_bytes.set_function(lambda: client.writeback_spool.size if client.writeback_spool is not None else 0)
+        self.prom_spool_replayed = prometheus_client.Gauge('elastalert_writeback_spool_replayed',
+                                                           'Number of documents written from the writeback spool')
+        self.prom_spool_replayed.set_function(lambda: client.writeback_spool.replayed if client.writeback_spool is not None else 0)
+        self.prom_dedup_fill_ratio = prometheus_client.Gauge('elastalert_dedup_fill_ratio',
+                                                             'Fill ratio of the fullest dedup filter of rule', ['rule_name'])
+        self.prom_dedup_false_positive_rate = prometheus_client.Gauge('elastalert_dedup_false_positive_rate',
+                                                                      'Estimated false positive rate of the dedup filters of rule',
+                                                                      ['rule_name'])
+        self.prom_rule_lag = prometheus_client.Gauge('elastalert_rule_lag_seconds',
+                                                     'Seconds after its due time that the last run of rule started', ['rule_name'])
+        self.prom_rule_dropped_runs = prometheus_client.Gauge('elastalert_rule_dropped_runs',
+                                                              'Number of runs of rule dropped by the priority scheduler', ['rule_name'])
+        self.prom_new_terms_seen = prometheus_client.Gauge('elastalert_new_terms_seen', 'Number of terms known to new_term rule',
+                                                           ['rule_name'])
+        self.prom_new_terms_bytes = prometheus_client.Gauge('elastalert_new_terms_bytes',
+                                                            'Estimated memory taken by the terms known to new_term rule', ['rule_name'])
 
     def start(self):
         prometheus_client.start_http_server(self.prometheus_port)
 
-    def metrics_run_rule(self, rule, endtime, starttime=None):
+    def metrics_run_rule(self, rule, endtime, starttime=None, found=None):
         """ Increment counter every time rule is run """
         try:
             self.prom_scrapes.labels(rule['name']).inc()
         finally:
-            return self.run_rule(rule, endtime, starttime)
+            res = self.run_rule(rule, endtime, starttime, found)
+        try:
+            # Only probabilistic dedup (see ProbabilisticProcessedHits) can skip new hits
+            processed_hits = rule.get('processed_hits')
+            if hasattr(processed_hits, 'fill_ratio'):
+                self.prom_dedup_fill_ratio.labels(rule['name']).set(processed_hits.fill_ratio)
+                self.prom_dedup_false_positive_rate.labels(rule['name']).set(processed_hits.false_positive_rate)
+            job = self.rule_scheduler.get_job(rule['name']) if self.rule_scheduler is not None else None
+            if job is not None:
+                self.prom_rule_lag.labels(rule['name']).set(job.lag)
+                self.prom_rule_dropped_runs.labels(rule['name']).set(job.dropped_runs)
+            if isinstance(rule['type'], NewTermsRule):
+                self.prom_new_terms_seen.labels(rule['name']).set(rule['type'].num_seen_terms)
+                self.prom_new_terms_bytes.labels(rule['name']).set(rule['type'].seen_terms_bytes)
+        finally:
+            return res
 
     def metrics_writeback(self, doc_type, body):
         """ Update various prometheus metrics accoording to the doc_type """
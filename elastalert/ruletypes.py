@@ -1,23 +1,32 @@
 # -*- coding: utf-8 -*-
+import collections
 import copy
 import datetime
+import hashlib
+import json
 import sys
 
 from sortedcontainers import SortedKeyList as sortedlist
 
+from .state import dumps_state
+from .state import loads_state
+from .state import TermsBaselineStore
 from .util import add_raw_postfix
+from .util import compile_es_key
 from .util import dt_to_ts
+from .util import dt_to_unix
 from .util import EAException
 from .util import elastalert_logger
 from .util import elasticsearch_client
+from .util import es_client_pool
 from .util import format_index
 from .util import hashable
-from .util import lookup_es_key
 from .util import new_get_event_ts
 from .util import pretty_ts
 from .util import total_seconds
 from .util import ts_now
 from .util import ts_to_dt
+from .util import unix_to_dt
 
 
 class RuleType(object):
@@ -27,6 +36,8 @@ class RuleType(object):
     :param rules: A rule configuration.
     """
     required_options = frozenset()
+    # Whether each event is matched on its own, so that the hits of separate time ranges can be fetched at once
+    stateless = False
 
     def __init__(self, rules, args=None):
         self.matches = []
@@ -76,6 +87,21 @@ class RuleType(object):
         """
         pass
 
+    def get_state(self):
+        """ Returns the state which the rule type keeps between runs, such as its event windows, so that ElastAlert
+        can snapshot it and restore it with set_state after a restart. Rule types keeping no such state return None.
+
+        :return: An object made of dicts with string keys, lists, strings, numbers, booleans, None and datetimes.
+        """
+        return None
+
+    def set_state(self, state):
+        """ Restores a state returned by get_state.
+
+        :param state: The state, with tuples turned into lists.
+        """
+        pass
+
     def add_count_data(self, counts):
         """ Gets called when a rule has use_count_query set to True. Called to add data from querying to the rule.
 
@@ -128,13 +154,15 @@ class CompareRule(RuleType):
 class BlacklistRule(CompareRule):
     """ A CompareRule where the compare function checks a given key against a blacklist """
     required_options = frozenset(['compare_key', 'blacklist'])
+    stateless = True
 
     def __init__(self, rules, args=None):
         super(BlacklistRule, self).__init__(rules, args=None)
         self.expand_entries('blacklist')
+        self.get_compare_key = compile_es_key(self.rules['compare_key'])
 
     def compare(self, event):
-        term = lookup_es_key(event, self.rules['compare_key'])
+        term = self.get_compare_key(event)
         if term in self.rules['blacklist']:
             return True
         return False
@@ -143,13 +171,15 @@ class BlacklistRule(CompareRule):
 class WhitelistRule(CompareRule):
     """ A CompareRule where the compare function checks a given term against a whitelist """
     required_options = frozenset(['compare_key', 'whitelist', 'ignore_null'])
+    stateless = True
 
     def __init__(self, rules, args=None):
         super(WhitelistRule, self).__init__(rules, args=None)
         self.expand_entries('whitelist')
+        self.get_compare_key = compile_es_key(self.rules['compare_key'])
 
     def compare(self, event):
-        term = lookup_es_key(event, self.rules['compare_key'])
+        term = self.get_compare_key(event)
         if term is None:
             return not self.rules['ignore_null']
         if term not in self.rules['whitelist']:
@@ -163,12 +193,17 @@ class ChangeRule(CompareRule):
     change_map = {}
     occurrence_time = {}
 
+    def __init__(self, *args):
+        super(ChangeRule, self).__init__(*args)
+        self.get_query_key = compile_es_key(self.rules['query_key'])
+        self.get_compare_keys = [compile_es_key(val) for val in self.rules['compound_compare_key']]
+
     def compare(self, event):
-        key = hashable(lookup_es_key(event, self.rules['query_key']))
+        key = hashable(self.get_query_key(event))
         values = []
         elastalert_logger.debug(" Previous Values of compare keys  " + str(self.occurrences))
-        for val in self.rules['compound_compare_key']:
-            lookup_value = lookup_es_key(event, val)
+        for get_compare_key in self.get_compare_keys:
+            lookup_value = get_compare_key(event)
             values.append(lookup_value)
         elastalert_logger.debug(" Current Values of compare keys   " + str(values))
 
@@ -201,7 +236,7 @@ class ChangeRule(CompareRule):
         # TODO this is not technically correct
         # if the term changes multiple times before an alert is sent
         # this data will be overwritten with the most recent change
-        change = self.change_map.get(hashable(lookup_es_key(match, self.rules['query_key'])))
+        change = self.change_map.get(hashable(self.get_query_key(match)))
         extra = {}
         if change:
             extra = {'old_value': change[0],
@@ -218,6 +253,7 @@ class FrequencyRule(RuleType):
         super(FrequencyRule, self).__init__(*args)
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
         self.get_ts = new_get_event_ts(self.ts_field)
+        self.lookup_ts = compile_es_key(self.ts_field)
         self.attach_related = self.rules.get('attach_related', False)
 
     def add_count_data(self, data):
@@ -242,12 +278,13 @@ class FrequencyRule(RuleType):
     def add_data(self, data):
         if 'query_key' in self.rules:
             qk = self.rules['query_key']
+            get_query_key = compile_es_key(qk)
         else:
             qk = None
 
         for event in data:
             if qk:
-                key = hashable(lookup_es_key(event, qk))
+                key = hashable(get_query_key(event))
             else:
                 # If no query_key, we use the key 'all' for all events
                 key = 'all'
@@ -276,13 +313,22 @@ class FrequencyRule(RuleType):
         """ Remove all occurrence data that is beyond the timeframe away """
         stale_keys = []
         for key, window in self.occurrences.items():
-            if timestamp - lookup_es_key(window.data[-1][0], self.ts_field) > self.rules['timeframe']:
+            if timestamp - self.lookup_ts(window.data[-1][0]) > self.rules['timeframe']:
                 stale_keys.append(key)
         list(map(self.occurrences.pop, stale_keys))
 
+    def get_state(self):
+        return {'occurrences': [[key, window.get_state()] for key, window in self.occurrences.items()]}
+
+    def set_state(self, state):
+        self.occurrences = {}
+        for key, events in state['occurrences']:
+            self.occurrences[key] = EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)
+            self.occurrences[key].set_state(events)
+
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
-        match_ts = lookup_es_key(match, self.ts_field)
+        match_ts = self.lookup_ts(match)
         starttime = pretty_ts(dt_to_ts(ts_to_dt(match_ts) - self.rules['timeframe']), lt)
         endtime = pretty_ts(match_ts, lt)
         message = 'At least %d events occurred between %s and %s\n\n' % (self.rules['num_events'],
@@ -293,6 +339,7 @@ class FrequencyRule(RuleType):
 
 class AnyRule(RuleType):
     """ A rule that will match on any input data """
+    stateless = True
 
     def add_data(self, data):
         for datum in data:
@@ -313,6 +360,17 @@ class EventWindow(object):
         self.data = sortedlist(key=self.get_ts)
         self.running_count = 0
 
+    def get_state(self):
+        return [[event, count] for event, count in self.data]
+
+    def set_state(self, state):
+        """ Restores the events returned by get_state, without removing old events or calling onRemoved. """
+        self.clear()
+        for event, count in state:
+            self.data.add((event, count))
+            if count:
+                self.running_count += count
+
     def append(self, event):
         """ Add an event to the window. Event should be of the form (dict, count).
         This will also pop the oldest events and call onRemoved on them until the
@@ -409,6 +467,7 @@ class SpikeRule(RuleType):
 
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
         self.get_ts = new_get_event_ts(self.ts_field)
+        self.lookup_ts = compile_es_key(self.ts_field)
         self.first_event = {}
         self.skip_checks = {}
 
@@ -433,15 +492,17 @@ class SpikeRule(RuleType):
                 self.handle_event(event, count, key)
 
     def add_data(self, data):
+        get_query_key = compile_es_key(self.rules.get('query_key', 'all'))
+        get_field_value = compile_es_key(self.field_value)
         for event in data:
             qk = self.rules.get('query_key', 'all')
             if qk != 'all':
-                qk = hashable(lookup_es_key(event, qk))
+                qk = hashable(get_query_key(event))
                 if qk is None:
                     qk = 'other'
             if self.field_value is not None:
                 if self.field_value in event:
-                    count = lookup_es_key(event, self.field_value)
+                    count = get_field_value(event)
                     if count is not None:
                         try:
                             count = int(count)
@@ -452,6 +513,26 @@ class SpikeRule(RuleType):
             else:
                 self.handle_event(event, 1, qk)
 
+    def get_state(self):
+        return {'ref_windows': [[qk, window.get_state()] for qk, window in self.ref_windows.items()],
+                'cur_windows': [[qk, window.get_state()] for qk, window in self.cur_windows.items()],
+                'first_event': [[qk, event] for qk, event in self.first_event.items()],
+                'skip_checks': [[qk, ts] for qk, ts in self.skip_checks.items()],
+                'ref_window_filled_once': self.ref_window_filled_once}
+
+    def set_state(self, state):
+        self.ref_windows = {}
+        self.cur_windows = {}
+        for qk, events in state['ref_windows']:
+            self.ref_windows[qk] = EventWindow(self.timeframe, getTimestamp=self.get_ts)
+            self.ref_windows[qk].set_state(events)
+        for qk, events in state['cur_windows']:
+            self.cur_windows[qk] = EventWindow(self.timeframe, self.ref_windows[qk].append, self.get_ts)
+            self.cur_windows[qk].set_state(events)
+        self.first_event = dict((qk, event) for qk, event in state['first_event'])
+        self.skip_checks = dict((qk, ts) for qk, ts in state['skip_checks'])
+        self.ref_window_filled_once = state['ref_window_filled_once']
+
     def get_spike_values(self, qk):
         """
         extending ref/cur value retrieval logic for spike aggregations
@@ -471,7 +552,7 @@ class SpikeRule(RuleType):
         # Reset the state and prevent alerts until windows filled again
         self.ref_windows[qk].clear()
         self.first_event.pop(qk)
-        self.skip_checks[qk] = lookup_es_key(event, self.ts_field) + self.rules['timeframe'] * 2
+        self.skip_checks[qk] = self.lookup_ts(event) + self.rules['timeframe'] * 2
 
     def handle_event(self, event, count, qk='all'):
         self.first_event.setdefault(qk, event)
@@ -482,7 +563,7 @@ class SpikeRule(RuleType):
         self.cur_windows[qk].append((event, count))
 
         # Don't alert if ref window has not yet been filled for this key AND
-        if lookup_es_key(event, self.ts_field) - self.first_event[qk][self.ts_field] < self.rules['timeframe'] * 2:
+        if self.lookup_ts(event) - self.first_event[qk][self.ts_field] < self.rules['timeframe'] * 2:
             # ElastAlert has not been running long enough for any alerts OR
             if not self.ref_window_filled_once:
                 return
@@ -490,7 +571,7 @@ class SpikeRule(RuleType):
             if not (self.rules.get('query_key') and self.rules.get('alert_on_new_data')):
                 return
             # An alert for this qk has recently fired
-            if qk in self.skip_checks and lookup_es_key(event, self.ts_field) < self.skip_checks[qk]:
+            if qk in self.skip_checks and self.lookup_ts(event) < self.skip_checks[qk]:
                 return
         else:
             self.ref_window_filled_once = True
@@ -628,6 +709,15 @@ class FlatlineRule(FrequencyRule):
                 self.first_event.pop(key)
                 self.occurrences.pop(key)
 
+    def get_state(self):
+        state = super(FlatlineRule, self).get_state()
+        state['first_event'] = [[key, ts] for key, ts in self.first_event.items()]
+        return state
+
+    def set_state(self, state):
+        super(FlatlineRule, self).set_state(state)
+        self.first_event = dict((key, ts) for key, ts in state['first_event'])
+
     def get_match_str(self, match):
         ts = match[self.rules['timestamp_field']]
         lt = self.rules.get('use_local_time')
@@ -660,6 +750,12 @@ class NewTermsRule(RuleType):
     def __init__(self, rule, args=None):
         super(NewTermsRule, self).__init__(rule, args)
         self.seen_values = {}
+        self.window_size = datetime.timedelta(**self.rules.get('terms_window_size', {'days': 30}))
+        self.max_seen_terms = self.rules.get('max_seen_terms')
+        self.get_ts = compile_es_key(self.rules['timestamp_field'])
+        # The size of the terms themselves, in bytes, see seen_terms_bytes
+        self.seen_terms_size = 0
+        self.evicted_terms = 0
         # Allow the use of query_key or fields
         if 'fields' not in self.rules:
             if 'query_key' not in self.rules:
@@ -681,6 +777,13 @@ class NewTermsRule(RuleType):
                 if self.rules.get('use_keyword_postfix', True):
                     elastalert_logger.warn('Warning: If query_key is a non-keyword field, you must set '
                                            'use_keyword_postfix to false, or add .keyword/.raw to your query_key.')
+        if self.rules.get('terms_baseline_path'):
+            self.baseline_store = TermsBaselineStore(self.rules['terms_baseline_path'])
+        else:
+            self.baseline_store = None
+        # The terms of each field are then kept with the time they were last seen, least recently seen first, to
+        # forget the terms not seen within terms_window_size
+        self.track_last_seen = bool(self.max_seen_terms or self.baseline_store)
         try:
             self.get_all_terms(args)
         except Exception as e:
@@ -689,8 +792,7 @@ class NewTermsRule(RuleType):
 
     def get_all_terms(self, args):
         """ Performs a terms aggregation for each field to get every existing term. """
-        self.es = elasticsearch_client(self.rules)
-        window_size = datetime.timedelta(**self.rules.get('terms_window_size', {'days': 30}))
+        self.es = es_client_pool.get(self.rules, elasticsearch_client)
         field_name = {"field": "", "size": 2147483647}  # Integer.MAX_VALUE
         query_template = {"aggs": {"values": {"terms": field_name}}}
         if args and hasattr(args, 'start') and args.start:
@@ -699,8 +801,14 @@ class NewTermsRule(RuleType):
             end = ts_to_dt(self.rules['start_date'])
         else:
             end = ts_now()
-        start = end - window_size
+        start = end - self.window_size
+        baseline_end = self.load_terms_baseline(start, end)
+        if baseline_end is not None:
+            # Only query the terms which occurred since the baseline was saved
+            start = baseline_end
         step = datetime.timedelta(**self.rules.get('window_step_size', {'days': 1}))
+        # Composite aggregations page through the terms, which older versions have to get in a single bucket list
+        use_composite = self.es.is_atleastsixtwo()
 
         for field in self.fields:
             tmp_start = start
@@ -716,7 +824,7 @@ class NewTermsRule(RuleType):
 
             # For composite keys, we will need to perform sub-aggregations
             if type(field) == list:
-                self.seen_values.setdefault(tuple(field), [])
+                self.seen_values.setdefault(tuple(field), self.new_seen_values())
                 level = query_template['aggs']
                 # Iterate on each part of the composite key and add a sub aggs clause to the elastic search query
                 for i, sub_field in enumerate(field):
@@ -729,7 +837,7 @@ class NewTermsRule(RuleType):
                         level['values']['aggs'] = {'values': {'terms': copy.deepcopy(field_name)}}
                         level = level['values']['aggs']
             else:
-                self.seen_values.setdefault(field, [])
+                self.seen_values.setdefault(field, self.new_seen_values())
                 # For non-composite keys, only a single agg is needed
                 if self.rules.get('use_keyword_postfix', True):
                     field_name['field'] = add_raw_postfix(field, self.is_five_or_above())
@@ -742,23 +850,21 @@ class NewTermsRule(RuleType):
                     index = format_index(self.rules['index'], tmp_start, tmp_end)
                 else:
                     index = self.rules['index']
-                res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
-                if 'aggregations' in res:
-                    buckets = res['aggregations']['filtered']['values']['buckets']
-                    if type(field) == list:
-                        # For composite keys, make the lookup based on all fields
-                        # Make it a tuple since it can be hashed and used in dictionary lookups
-                        for bucket in buckets:
-                            # We need to walk down the hierarchy and obtain the value at each level
-                            self.seen_values[tuple(field)] += self.flatten_aggregation_hierarchy(bucket)
-                    else:
-                        keys = [bucket['key'] for bucket in buckets]
-                        self.seen_values[field] += keys
+                if use_composite:
+                    key = tuple(field) if type(field) == list else field
+                    self.add_seen_values(key, self.get_composite_terms(field, index, tmp_start, tmp_end), tmp_end)
                 else:
-                    if type(field) == list:
-                        self.seen_values.setdefault(tuple(field), [])
-                    else:
-                        self.seen_values.setdefault(field, [])
+                    res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
+                    if 'aggregations' in res:
+                        buckets = res['aggregations']['filtered']['values']['buckets']
+                        if type(field) == list:
+                            # For composite keys, make the lookup based on all fields
+                            # Make it a tuple since it can be hashed and used in dictionary lookups
+                            for bucket in buckets:
+                                # We need to walk down the hierarchy and obtain the value at each level
+                                self.add_seen_values(tuple(field), self.flatten_aggregation_hierarchy(bucket), tmp_end)
+                        else:
+                            self.add_seen_values(field, (bucket['key'] for bucket in buckets), tmp_end)
                 if tmp_start == tmp_end:
                     break
                 tmp_start = tmp_end
@@ -779,8 +885,103 @@ class NewTermsRule(RuleType):
                     else:
                         elastalert_logger.info('Found no values for %s' % (field))
                     continue
-                self.seen_values[key] = list(set(values))
-                elastalert_logger.info('Found %s unique values for %s' % (len(set(values)), key))
+                elastalert_logger.info('Found %s unique values for %s' % (len(values), key))
+
+        self.save_terms_baseline(end)
+
+    def get_composite_terms(self, field, index, start, end):
+        """ Yields every term of field between start and end, paging through a composite aggregation
+        terms_page_size terms at a time. The terms of a composite field are tuples of the values of its fields. """
+        sub_fields = field if type(field) == list else [field]
+        sources = []
+        for sub_field in sub_fields:
+            if self.rules.get('use_keyword_postfix', True):
+                sources.append({sub_field: {'terms': {'field': add_raw_postfix(sub_field, self.is_five_or_above())}}})
+            else:
+                sources.append({sub_field: {'terms': {'field': sub_field}}})
+        composite = {'sources': sources, 'size': self.rules.get('terms_page_size', 1000)}
+        time_filter = {self.rules['timestamp_field']: {'lt': self.rules['dt_to_ts'](end), 'gte': self.rules['dt_to_ts'](start)}}
+        # A composite aggregation cannot be nested in a filter aggregation, so the query filters the documents
+        query = {'query': {'bool': {'filter': [{'range': time_filter}] + self.rules.get('filter', [])}},
+                 'aggs': {'values': {'composite': composite}},
+                 'size': 0}
+
+        while True:
+            res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
+            if 'aggregations' not in res:
+                return
+            buckets = res['aggregations']['values']['buckets']
+            for bucket in buckets:
+                if type(field) == list:
+                    yield tuple(bucket['key'][sub_field] for sub_field in sub_fields)
+                else:
+                    yield bucket['key'][field]
+            if len(buckets) < composite['size']:
+                return
+            # Versions before 6.3 do not return after_key, which is the key of the last bucket there
+            composite['after'] = res['aggregations']['values'].get('after_key', buckets[-1]['key'])
+
+    def terms_baseline_hash(self):
+        """ A hash of the options the terms depend on, so that a baseline saved for other fields or filters
+        is not used. """
+        query = {'fields': self.fields,
+                 'index': self.rules['index'],
+                 'filter': self.rules.get('filter', []),
+                 'use_keyword_postfix': self.rules.get('use_keyword_postfix', True)}
+        return hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def load_terms_baseline(self, start, end):
+        """ Loads the terms saved by save_terms_baseline into seen_values, and returns the time they were
+        collected up to. Returns None if there is no baseline between start and end. """
+        if self.baseline_store is None:
+            return None
+        try:
+            data = self.baseline_store.load(self.rules['name'])
+            if data is None:
+                return None
+            baseline = loads_state(data)
+            if baseline['query'] != self.terms_baseline_hash():
+                elastalert_logger.info('Not using the terms baseline of %s, its fields or filters changed' % (self.rules['name']))
+                return None
+            if not start <= baseline['end'] <= end:
+                return None
+            fields = []
+            for entry in baseline['values']:
+                if len(entry) != 3:
+                    raise ValueError('the time each term was last seen is missing')
+                key, values, last_seen = entry
+                last_seen = [unix_to_dt(ts) for ts in last_seen]
+                if type(key) == list:
+                    # JSON turned the composite keys and their values into lists
+                    fields.append((tuple(key), [tuple(value) for value in values], last_seen))
+                else:
+                    fields.append((key, values, last_seen))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            elastalert_logger.warning('Error loading the terms baseline of %s: %s' % (self.rules['name'], e))
+            return None
+        self.seen_values = {}
+        self.seen_terms_size = 0
+        for key, values, last_seen in fields:
+            self.seen_values[key] = self.new_seen_values()
+            for value, timestamp in zip(values, last_seen):
+                # Like a baseline queried now, forget the terms not seen within terms_window_size
+                if timestamp >= start:
+                    self.add_seen_value(key, value, timestamp)
+        elastalert_logger.info('Loaded %s terms of %s collected up to %s' %
+                               (self.num_seen_terms, self.rules['name'], pretty_ts(baseline['end'])))
+        return baseline['end']
+
+    def save_terms_baseline(self, end):
+        """ Saves the terms in seen_values, which were collected up to end, to terms_baseline_path. """
+        if self.baseline_store is None:
+            return
+        # The terms least recently seen first, with the time they were last seen
+        values = [[key, list(values), [dt_to_unix(ts) for ts in values.values()]] for key, values in self.seen_values.items()]
+        try:
+            data = dumps_state({'query': self.terms_baseline_hash(), 'end': end, 'values': values})
+            self.baseline_store.save(self.rules['name'], data)
+        except (OSError, TypeError) as e:
+            elastalert_logger.warning('Error saving the terms baseline of %s: %s' % (self.rules['name'], e))
 
     def flatten_aggregation_hierarchy(self, root, hierarchy_tuple=()):
         """ For nested aggregations, the results come back in the following format:
@@ -886,22 +1087,24 @@ class NewTermsRule(RuleType):
         return results
 
     def add_data(self, data):
+        getters = [[compile_es_key(sub_field) for sub_field in field] if type(field) == list else compile_es_key(field)
+                   for field in self.fields]
         for document in data:
-            for field in self.fields:
+            for field, get_field in zip(self.fields, getters):
                 value = ()
                 lookup_field = field
                 if type(field) == list:
                     # For composite keys, make the lookup based on all fields
                     # Make it a tuple since it can be hashed and used in dictionary lookups
                     lookup_field = tuple(field)
-                    for sub_field in field:
-                        lookup_result = lookup_es_key(document, sub_field)
+                    for get_sub_field in get_field:
+                        lookup_result = get_sub_field(document)
                         if not lookup_result:
                             value = None
                             break
                         value += (lookup_result,)
                 else:
-                    value = lookup_es_key(document, field)
+                    value = get_field(document)
                 if not value and self.rules.get('alert_on_missing_field'):
                     document['missing_field'] = lookup_field
                     self.add_match(copy.deepcopy(document))
@@ -909,7 +1112,9 @@ class NewTermsRule(RuleType):
                     if value not in self.seen_values[lookup_field]:
                         document['new_field'] = lookup_field
                         self.add_match(copy.deepcopy(document))
-                        self.seen_values[lookup_field].append(value)
+                        self.add_seen_value(lookup_field, value, self.get_ts(document) or ts_now())
+                    elif self.track_last_seen:
+                        self.add_seen_value(lookup_field, value, self.get_ts(document) or ts_now())
 
     def add_terms_data(self, terms):
         # With terms query, len(self.fields) is always 1 and the 0'th entry is always a string
@@ -922,11 +1127,75 @@ class NewTermsRule(RuleType):
                                  self.rules['timestamp_field']: timestamp,
                                  'new_field': field}
                         self.add_match(match)
-                        self.seen_values[field].append(bucket['key'])
+                        self.add_seen_value(field, bucket['key'], timestamp)
+                    elif self.track_last_seen:
+                        self.add_seen_value(field, bucket['key'], timestamp)
+
+    def new_seen_values(self):
+        """ Returns an empty container for the terms of a field: a set, or with max_seen_terms or terms_baseline_path
+        an OrderedDict of the time each term was last seen. """
+        return collections.OrderedDict() if self.track_last_seen else set()
+
+    def add_seen_value(self, key, value, timestamp):
+        """ Records that value of the field key was seen at timestamp. """
+        values = self.seen_values[key]
+        if value in values:
+            if self.track_last_seen:
+                values[value] = timestamp
+                values.move_to_end(value)
+            return
+        if type(value) == tuple:
+            # The values of composite terms repeat a lot, share them between the terms
+            value = tuple(sys.intern(sub_value) if type(sub_value) == str else sub_value for sub_value in value)
+        self.seen_terms_size += self.get_term_size(value)
+        if not self.track_last_seen:
+            values.add(value)
+            return
+        values[value] = timestamp
+        if self.max_seen_terms and len(values) > self.max_seen_terms:
+            self.forget_term(values)
+
+    def add_seen_values(self, key, values, timestamp):
+        for value in values:
+            self.add_seen_value(key, value, timestamp)
+
+    def forget_term(self, values):
+        """ Forgets the least recently seen of values. """
+        value, _ = values.popitem(last=False)
+        self.seen_terms_size -= self.get_term_size(value)
+        self.evicted_terms += 1
+
+    @staticmethod
+    def get_term_size(value):
+        if type(value) == tuple:
+            return sys.getsizeof(value) + sum(sys.getsizeof(sub_value) for sub_value in value)
+        return sys.getsizeof(value)
+
+    @property
+    def num_seen_terms(self):
+        return sum(len(values) for values in self.seen_values.values())
+
+    @property
+    def seen_terms_bytes(self):
+        """ An estimate of the memory taken by the terms of all fields, in bytes. The values shared by composite
+        terms are counted once per term. """
+        return self.seen_terms_size + sum(sys.getsizeof(values) for values in self.seen_values.values())
+
+    def garbage_collect(self, timestamp):
+        if not self.max_seen_terms:
+            return
+        # Forget the terms which a baseline queried now would not find
+        horizon = timestamp - self.window_size
+        evicted_terms = self.evicted_terms
+        for values in self.seen_values.values():
+            while values and next(iter(values.values())) < horizon:
+                self.forget_term(values)
+        if self.evicted_terms > evicted_terms:
+            elastalert_logger.info('Forgot %s terms of %s not seen since %s' %
+                                   (self.evicted_terms - evicted_terms, self.rules['name'], pretty_ts(horizon)))
 
     def is_five_or_above(self):
-        version = self.es.info()['version']['number']
-        return int(version[0]) >= 5
+        return self.es.is_atleastfive()
 
 
 class CardinalityRule(RuleType):
@@ -938,37 +1207,48 @@ class CardinalityRule(RuleType):
         if 'max_cardinality' not in self.rules and 'min_cardinality' not in self.rules:
             raise EAException("CardinalityRule must have one of either max_cardinality or min_cardinality")
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
+        self.lookup_ts = compile_es_key(self.ts_field)
         self.cardinality_field = self.rules['cardinality_field']
+        self.get_cardinality_field = compile_es_key(self.cardinality_field)
         self.cardinality_cache = {}
         self.first_event = {}
         self.timeframe = self.rules['timeframe']
 
     def add_data(self, data):
         qk = self.rules.get('query_key')
+        get_query_key = compile_es_key(qk)
         for event in data:
             if qk:
-                key = hashable(lookup_es_key(event, qk))
+                key = hashable(get_query_key(event))
             else:
                 # If no query_key, we use the key 'all' for all events
                 key = 'all'
             self.cardinality_cache.setdefault(key, {})
-            self.first_event.setdefault(key, lookup_es_key(event, self.ts_field))
-            value = hashable(lookup_es_key(event, self.cardinality_field))
+            self.first_event.setdefault(key, self.lookup_ts(event))
+            value = hashable(self.get_cardinality_field(event))
             if value is not None:
                 # Store this timestamp as most recent occurence of the term
-                self.cardinality_cache[key][value] = lookup_es_key(event, self.ts_field)
+                self.cardinality_cache[key][value] = self.lookup_ts(event)
                 self.check_for_match(key, event)
 
+    def get_state(self):
+        return {'cardinality_cache': [[key, list(map(list, terms.items()))] for key, terms in self.cardinality_cache.items()],
+                'first_event': [[key, ts] for key, ts in self.first_event.items()]}
+
+    def set_state(self, state):
+        self.cardinality_cache = dict((key, dict((term, ts) for term, ts in terms)) for key, terms in state['cardinality_cache'])
+        self.first_event = dict((key, ts) for key, ts in state['first_event'])
+
     def check_for_match(self, key, event, gc=True):
         # Check to see if we are past max/min_cardinality for a given key
-        time_elapsed = lookup_es_key(event, self.ts_field) - self.first_event.get(key, lookup_es_key(event, self.ts_field))
+        time_elapsed = self.lookup_ts(event) - self.first_event.get(key, self.lookup_ts(event))
         timeframe_elapsed = time_elapsed > self.timeframe
         if (len(self.cardinality_cache[key]) > self.rules.get('max_cardinality', float('inf')) or
                 (len(self.cardinality_cache[key]) < self.rules.get('min_cardinality', float('-inf')) and timeframe_elapsed)):
             # If there might be a match, run garbage collect first, as outdated terms are only removed in GC
             # Only run it if there might be a match so it doesn't impact performance
             if gc:
-                self.garbage_collect(lookup_es_key(event, self.ts_field))
+                self.garbage_collect(self.lookup_ts(event))
                 self.check_for_match(key, event, False)
             else:
                 self.first_event.pop(key, None)
@@ -990,8 +1270,8 @@ class CardinalityRule(RuleType):
 
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
-        starttime = pretty_ts(dt_to_ts(ts_to_dt(lookup_es_key(match, self.ts_field)) - self.rules['timeframe']), lt)
-        endtime = pretty_ts(lookup_es_key(match, self.ts_field), lt)
+        starttime = pretty_ts(dt_to_ts(ts_to_dt(self.lookup_ts(match)) - self.rules['timeframe']), lt)
+        endtime = pretty_ts(self.lookup_ts(match), lt)
         if 'max_cardinality' in self.rules:
             message = ('A maximum of %d unique %s(s) occurred since last alert or between %s and %s\n\n' % (self.rules['max_cardinality'],
                                                                                                             self.rules['cardinality_field'],
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import threading
+import time
+
+from .util import elastalert_logger
+
+
+class RuleJob(object):
+    """ A rule run every interval seconds by a :class:`RuleScheduler`.
+
+    :param lag: How many seconds after its due time the last run of the rule started.
+    :param dropped_runs: How many runs of the rule were dropped because its previous run was late or still running.
+    :param runs: How many times the rule was run.
+    """
+
+    def __init__(self, name, func, args, interval, priority, slack, due):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.priority = priority
+        self.slack = slack
+        self.due = due
+        self.lag = 0
+        self.dropped_runs = 0
+        self.runs = 0
+        self.running = False
+        self.removed = False
+        # Set by reschedule while the rule is running, the due time of its next run
+        self.next_due = None
+        # Bumped whenever the job is rescheduled, which invalidates the entries of the job in the heaps
+        self.version = 0
+
+    @property
+    def deadline(self):
+        """ The run is late once the next one is due. Rules with a query_delay already wait for their data,
+        which gives them that much more slack. """
+        return self.due + self.interval + self.slack
+
+
+class RuleScheduler(object):
+    """ Runs rules every run_every on a pool of threads, starting the most urgent of the rules which are due first.
+
+    Due rules are ordered by priority class, then by deadline, so that under load the rules of a higher
+    class do not wait behind others. A rule is never queued twice: if its run is late or still running
+    when the next one is due, the runs in between are dropped and counted in dropped_runs.
+
+    :param max_threads: The number of threads running rules.
+    :param reserved_threads: The number of threads kept idle for the rules of the highest priority class (0),
+        so that they do not wait for long running rules of other classes.
+    :param clock: Returns the current time in seconds since the epoch.
+    """
+
+    def __init__(self, max_threads=10, reserved_threads=0, clock=time.time):
+        self.max_threads = max_threads
+        self.reserved_threads = max(0, min(reserved_threads, max_threads - 1))
+        self.clock = clock
+        self.jobs = {}
+        self.running = False
+        self._busy = 0
+        # (due, seq, version, job) of the jobs waiting for their due time
+        self._waiting = []
+        # (priority, deadline, seq, version, job) of the due jobs
+        self._ready = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def add(self, name, func, args, interval, priority=0, slack=0, next_run=None):
+        """ Runs func(*args) every interval seconds from next_run, replacing any job with the same name. """
+        with self._cond:
+            self._remove(name)
+            job = RuleJob(name, func, args, interval, priority, slack, next_run if next_run is not None else self.clock())
+            self.jobs[name] = job
+            self._push(job)
+            self._cond.notify_all()
+        return job
+
+    def get_job(self, name):
+        return self.jobs.get(name)
+
+    def remove(self, name):
+        """ Stops running the job name. A run in progress is not interrupted. """
+        with self._cond:
+            self._remove(name)
+
+    def reschedule(self, name, next_run):
+        """ Sets the due time of the next run of name, in seconds since the epoch. """
+        with self._cond:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            if job.running:
+                job.next_due = next_run
+                return
+            job.due = next_run
+            job.version += 1
+            self._push(job)
+            self._cond.notify_all()
+
+    def _remove(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.removed = True
+            job.version += 1
+
+    def _push(self, job):
+        heapq.heappush(self._waiting, (job.due, next(self._seq), job.version, job))
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.max_threads):
+            thread = threading.Thread(target=self._work, name='elastalert-rule-scheduler-%s' % (i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, timeout=None):
+        """ Stops starting rules, and waits up to timeout seconds for the running ones. """
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if not self.running:
+                        return
+                    self._cond.wait(self._timeout())
+                    job = self._next_job() if self.running else None
+                self._busy += 1
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                elastalert_logger.error('Error running rule %s: %s' % (job.name, e))
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._finish(job)
+                    self._cond.notify_all()
+
+    def _next_job(self):
+        """ Takes the most urgent due job, or returns None if none can start now. """
+        now = self.clock()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, seq, version, job = heapq.heappop(self._waiting)
+            if version == job.version:
+                heapq.heappush(self._ready, (job.priority, job.deadline, seq, version, job))
+
+        while self._ready:
+            priority, _, _, version, job = self._ready[0]
+            if version != job.version:
+                heapq.heappop(self._ready)
+                continue
+            if priority > 0 and self.max_threads - self._busy <= self.reserved_threads:
+                # Keep the last threads for the highest priority class
+                return None
+            heapq.heappop(self._ready)
+            job.running = True
+            job.lag = max(0, now - job.due)
+            job.runs += 1
+            return job
+        return None
+
+    def _timeout(self):
+        """ The number of seconds until the next job is due, or None if there are no waiting jobs. """
+        if not self._waiting:
+            return None
+        return max(0, self._waiting[0][0] - self.clock())
+
+    def _finish(self, job):
+        job.running = False
+        if job.removed:
+            return
+        if job.next_due is not None:
+            job.due, job.next_due = job.next_due, None
+        else:
+            job.due += job.interval
+            # Coalesce the runs overtaken by the one which is due now
+            now = self.clock()
+            dropped = 0
+            while job.due + job.interval <= now:
+                job.due += job.interval
+                dropped += 1
+            if dropped:
+                job.dropped_runs += dropped
+                elastalert_logger.warning('Dropped %s runs of %s, which is running behind by %s seconds' %
+                                          (dropped, job.name, int(now - job.due)))
+        job.version += 1
+        self._push(job)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+import uuid
+
+from elasticsearch.serializer import JSONSerializer
+
+from .util import elastalert_logger
+
+
+class WritebackSpool(object):
+    """ An append-only spool on disk for the writeback documents which could not be written to Elasticsearch,
+    so that they survive until the writeback cluster is reachable again, even across restarts.
+
+    Documents are appended as JSON lines to numbered segment files in directory. A segment is closed once it
+    reaches segment_size bytes, and the oldest segments are deleted (and their documents lost) when the spool
+    grows beyond max_size bytes. Each call to :meth:`append` is synced to disk once.
+
+    :meth:`replay` hands the spooled documents to a send function, oldest segment first, and deletes each
+    segment once all of its documents have been sent.
+
+    :param directory: The directory holding the segment files. It is created if needed.
+    :param max_size: The maximum number of bytes taken by the spool.
+    :param segment_size: The number of bytes after which a new segment is started.
+    """
+
+    segment_suffix = '.spool'
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024, segment_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size or max(1, max_size // 10)
+        self.spooled = 0
+        self.dropped = 0
+        self.replayed = 0
+        self._serializer = JSONSerializer()
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._current = None
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(int(name[:-len(self.segment_suffix)]) for name in os.listdir(directory)
+                                if name.endswith(self.segment_suffix) and name[:-len(self.segment_suffix)].isdigit())
+        self._sizes = {segment: os.path.getsize(self._path(segment)) for segment in self._segments}
+        if self._segments:
+            elastalert_logger.info('Found %s bytes of spooled writeback documents in %s' % (self.size, directory))
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%020d%s' % (segment, self.segment_suffix))
+
+    @property
+    def size(self):
+        return sum(list(self._sizes.values()))
+
+    def __bool__(self):
+        return bool(self._segments)
+
+    def _open_segment(self):
+        segment = self._segments[-1] + 1 if self._segments else 0
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._current = open(self._path(segment), 'ab')
+        return segment
+
+    def _close_segment(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+    def _drop_oldest(self):
+        segment = self._segments.pop(0)
+        with open(self._path(segment), 'rb') as f:
+            lost = sum(1 for _ in f)
+        os.remove(self._path(segment))
+        del self._sizes[segment]
+        self.dropped += lost
+        elastalert_logger.warning('Writeback spool is full, dropped %s spooled documents' % (lost))
+
+    def append(self, documents):
+        """ Spools a list of (index, doc_type, _id, body) tuples. The index is resolved from the doc_type
+        when it is replayed if index is None, and an _id is generated if _id is None.
+        Returns the _id each document will be written with. """
+        ids = []
+        lines = []
+        for index, doc_type, _id, body in documents:
+            _id = _id or uuid.uuid4().hex
+            ids.append(_id)
+            document = {'index': index, 'doc_type': doc_type, '_id': _id, 'body': body}
+            lines.append(self._serializer.dumps(document).encode('utf-8') + b'\n')
+        data = b''.join(lines)
+
+        with self._lock:
+            if self._current is None or self._sizes[self._segments[-1]] >= self.segment_size:
+                self._close_segment()
+                self._open_segment()
+            self._current.write(data)
+            self._current.flush()
+            os.fsync(self._current.fileno())
+            self._sizes[self._segments[-1]] += len(data)
+            self.spooled += len(lines)
+            while self.size > self.max_size and len(self._segments) > 1:
+                self._drop_oldest()
+        return ids
+
+    def replay(self, send, batch_size=500):
+        """ Sends the spooled documents, oldest first, in lists of up to batch_size (index, doc_type, _id, body) tuples.
+
+        send must raise an exception if the documents could not be written, which stops the replay and keeps
+        the documents of that segment spooled. Returns the number of documents sent.
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._replay(send, batch_size)
+        finally:
+            self._replay_lock.release()
+
+    def _replay(self, send, batch_size):
+        start = time.time()
+        sent = 0
+        while True:
+            with self._lock:
+                if not self._segments:
+                    break
+                segment = self._segments[0]
+                if len(self._segments) == 1:
+                    # New documents go to a new segment while this one is replayed
+                    self._close_segment()
+            documents = []
+            try:
+                with open(self._path(segment), 'rb') as f:
+                    for line in f:
+                        try:
+                            document = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            # The last line of a segment may be cut short by a crash
+                            elastalert_logger.warning('Skipping unreadable line in writeback spool segment %s' % (segment))
+                            continue
+                        documents.append((document['index'], document['doc_type'], document['_id'], document['body']))
+            except FileNotFoundError:
+                # Dropped by append() to stay below max_size
+                pass
+
+            # Documents keep their _id, so sending a segment again after a failure does not duplicate them
+            for i in range(0, len(documents), batch_size):
+                send(documents[i:i + batch_size])
+                sent += len(documents[i:i + batch_size])
+                self.replayed += len(documents[i:i + batch_size])
+
+            with self._lock:
+                if segment in self._sizes:
+                    self._segments.remove(segment)
+                    del self._sizes[segment]
+                    if os.path.exists(self._path(segment)):
+                        os.remove(self._path(segment))
+
+        if sent:
+            elapsed = time.time() - start
+            elastalert_logger.info('Replayed %s spooled writeback documents in %.2f seconds (%.0f documents/s)' %
+                                   (sent, elapsed, sent / elapsed if elapsed else sent))
+        return sent
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import json
+import os
+import zlib
+from urllib.parse import quote
+
+from elasticsearch.exceptions import NotFoundError
+
+from .util import dt_to_ts
+from .util import ts_now
+from .util import ts_to_dt
+
+STATE_PREFIX = '_elastalert_state.'
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'$dt': dt_to_ts(obj)}
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('%s is not serializable' % (type(obj).__name__))
+
+
+def _decode(obj):
+    if len(obj) == 1 and '$dt' in obj:
+        return ts_to_dt(obj['$dt'])
+    return obj
+
+
+def dumps_state(state):
+    """ Encodes the state of a rule, as returned by RuleType.get_state, to compressed JSON. Datetimes are kept,
+    and tuples become lists. Raises TypeError if state holds other objects than those of JSON. """
+    return zlib.compress(json.dumps(state, default=_encode, separators=(',', ':')).encode('utf-8'))
+
+
+def loads_state(data):
+    """ Decodes a state encoded by :func:`dumps_state`. Raises ValueError if data is not such a state. """
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError('Invalid rule state: %s' % (e))
+    return json.loads(data.decode('utf-8'), object_hook=_decode)
+
+
+class FileRuleStateStore(object):
+    """ Keeps a snapshot of the state of each rule as a file in directory.
+
+    :param directory: The directory holding the snapshots. It is created if needed.
+    """
+
+    suffix = '.state'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, rule_name):
+        return os.path.join(self.directory, quote(rule_name, safe='') + self.suffix)
+
+    def save(self, rule_name, data):
+        # Replace the previous snapshot at once, so that a crash never leaves half of one
+        path = self._path(rule_name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def load(self, rule_name):
+        """ Returns the last snapshot saved for rule_name, or None if there is none. """
+        try:
+            with open(self._path(rule_name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class WritebackRuleStateStore(object):
+    """ Keeps a snapshot of the state of each rule in writeback_index, as one elastalert_status document
+    per rule whose rule_name is the name of the rule prefixed with STATE_PREFIX.
+
+    :param writeback_es: The client of the writeback index.
+    :param writeback_index: The name of the writeback index.
+    """
+
+    def __init__(self, writeback_es, writeback_index):
+        self.writeback_es = writeback_es
+        self.writeback_index = writeback_index
+
+    def _index(self):
+        return self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_status')
+
+    def _doc_type(self):
+        return {} if self.writeback_es.is_atleastsixtwo() else {'doc_type': 'elastalert_status'}
+
+    def save(self, rule_name, data):
+        body = {'rule_name': STATE_PREFIX + rule_name,
+                'state': base64.b64encode(data).decode('ascii'),
+                '@timestamp': dt_to_ts(ts_now())}
+        self.writeback_es.index(index=self._index(), id=STATE_PREFIX + rule_name, body=body, **self._doc_type())
+
+    def load(self, rule_name):
+        """ Returns the last snapshot saved for rule_name, or None if there is none. """
+        try:
+            res = self.writeback_es.get(index=self._index(), id=STATE_PREFIX + rule_name, **self._doc_type())
+        except NotFoundError:
+            return None
+        return base64.b64decode(res['_source']['state'])
+
+
+class TermsBaselineStore(FileRuleStateStore):
+    """ Keeps the terms known to each new_term rule as a file in directory, so that they are not queried again
+    when the rule restarts.
+
+    :param directory: The directory holding the baselines. It is created if needed.
+    """
+
+    suffix = '.terms'
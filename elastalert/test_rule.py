@@ -16,6 +16,7 @@ from elastalert.config import load_conf
 from elastalert.elastalert import ElastAlerter
 from elastalert.util import EAException
 from elastalert.util import elasticsearch_client
+from elastalert.util import es_client_pool
 from elastalert.util import lookup_es_key
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
@@ -53,7 +54,7 @@ class MockElastAlerter(object):
             return []
 
         # Set up Elasticsearch client and query
-        es_client = elasticsearch_client(conf)
+        es_client = es_client_pool.get(conf, elasticsearch_client)
 
         try:
             ElastAlerter.modify_rule_for_ES5(conf)
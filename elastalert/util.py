@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 import collections
 import datetime
+import functools
 import logging
 import os
 import re
 import sys
+import threading
 
 import dateutil.parser
+import dateutil.tz
 import pytz
+from elasticsearch.exceptions import TransportError
 from six import string_types
 
 from . import ElasticSearchClient
@@ -38,7 +42,8 @@ def new_get_event_ts(ts_field):
     :returns: A callable function that takes an event and outputs that event's
     timestamp field.
     """
-    return lambda event: lookup_es_key(event[0], ts_field)
+    get_ts = compile_es_key(ts_field)
+    return lambda event: get_ts(event[0])
 
 
 def _find_es_dict_by_key(lookup_dict, term):
@@ -75,8 +80,19 @@ def _find_es_dict_by_key(lookup_dict, term):
     #
     # For example:
     #  {'foo.bar': {'bar': 'ray'}} to look up foo.bar will return {'bar': 'ray'}, not 'ray'
-    dict_cursor = lookup_dict
+    if not isinstance(term, string_types) or not term:
+        return {}, None
+    return _walk_es_key_path(lookup_dict, _parse_es_key(term))
+
 
+@functools.lru_cache(maxsize=4096)
+def _parse_es_key(term):
+    """ Splits a search term into the segments walked by :func:`_walk_es_key_path`.
+
+    Each segment is a tuple of the full stop separated subkeys before an array index, the index (or None)
+    and whether more of the term follows the index.
+    """
+    segments = []
     while term:
         split_results = re.split(r'\[(\d)\]', term, maxsplit=1)
         if len(split_results) == 3:
@@ -84,23 +100,31 @@ def _find_es_dict_by_key(lookup_dict, term):
             index = int(index)
         else:
             sub_term, index, term = split_results + [None, '']
+        segments.append((tuple(sub_term.split('.')), index, bool(term)))
+    return tuple(segments)
 
-        subkeys = sub_term.split('.')
 
+def _walk_es_key_path(lookup_dict, path):
+    """ The iterative lookup of :func:`_find_es_dict_by_key` along a path from :func:`_parse_es_key`. """
+    dict_cursor = lookup_dict
+    subkey = None
+
+    for subkeys, index, more in path:
         subkey = ''
+        last = len(subkeys) - 1
 
-        while len(subkeys) > 0:
+        for i, token in enumerate(subkeys):
             if not dict_cursor:
                 return {}, None
 
-            subkey += subkeys.pop(0)
+            subkey += token
 
             if subkey in dict_cursor:
-                if len(subkeys) == 0:
+                if i == last:
                     break
                 dict_cursor = dict_cursor[subkey]
                 subkey = ''
-            elif len(subkeys) == 0:
+            elif i == last:
                 # If there are no keys left to match, return None values
                 dict_cursor = None
                 subkey = None
@@ -111,7 +135,7 @@ def _find_es_dict_by_key(lookup_dict, term):
             dict_cursor = dict_cursor[subkey]
             if type(dict_cursor) == list and len(dict_cursor) > index:
                 subkey = index
-                if term:
+                if more:
                     dict_cursor = dict_cursor[subkey]
             else:
                 return {}, None
@@ -140,10 +164,67 @@ def lookup_es_key(lookup_dict, term):
     return None if value_key is None else value_dict[value_key]
 
 
+def compile_es_key(term):
+    """ Returns a function which looks up term in a dictionary exactly like :func:`lookup_es_key`,
+    but splits term into its subkeys only once. Use it when the same term is looked up in many events.
+
+    >>> get_name = compile_es_key('user.name')
+    >>> get_name({'user': {'name': 'bob'}}), get_name({'user.name': 'alice'})
+    ('bob', 'alice')
+    """
+    if not isinstance(term, string_types) or not term:
+        return lambda lookup_dict: lookup_es_key(lookup_dict, term)
+    path = _parse_es_key(term)
+
+    def lookup(lookup_dict):
+        if term in lookup_dict:
+            return lookup_dict[term]
+        value_dict, value_key = _walk_es_key_path(lookup_dict, path)
+        return None if value_key is None else value_dict[value_key]
+    return lookup
+
+
+# The timestamp formats Elasticsearch returns, such as 2014-09-26T12:34:45.123Z or 2014-09-26T12:34:45+02:00
+_iso8601_timestamp = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?$')
+
+
+@functools.lru_cache(maxsize=64)
+def _tzoffset(seconds):
+    return dateutil.tz.tzutc() if seconds == 0 else dateutil.tz.tzoffset(None, seconds)
+
+
+def _parse_iso8601(timestamp):
+    """ Parses the common ISO 8601 timestamps much faster than dateutil does.
+    :returns: A datetime, or None if timestamp is in any other format.
+    """
+    match = _iso8601_timestamp.match(timestamp)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tz = None
+    if offset == 'Z':
+        tz = _tzoffset(0)
+    elif offset:
+        offset = offset.replace(':', '')
+        seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        tz = _tzoffset(-seconds if offset[0] == '-' else seconds)
+    # Like dateutil, keep microsecond precision and drop the rest
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tz)
+
+
 def ts_to_dt(timestamp):
     if isinstance(timestamp, datetime.datetime):
         return timestamp
-    dt = dateutil.parser.parse(timestamp)
+    dt = None
+    if isinstance(timestamp, str):
+        try:
+            dt = _parse_iso8601(timestamp)
+        except ValueError:
+            # Out of range values, let dateutil decide
+            pass
+    if dt is None:
+        dt = dateutil.parser.parse(timestamp)
     # Implicitly convert local timestamps to UTC
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=pytz.utc)
@@ -334,6 +415,122 @@ def elasticsearch_client(conf):
     return ElasticSearchClient(es_conn_conf)
 
 
+class ElasticSearchClientPool(object):
+    """ A thread-safe registry of :class:`ElasticSearchClient` instances keyed by connection settings.
+
+    Rules whose :func:`build_es_conn_config` output is identical (host, port, auth, TLS, url prefix...)
+    share a single client, and with it a single HTTP connection pool and a single cached es_version.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._names = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def conn_key(conf):
+        """ Returns a hashable key identifying the connection settings of conf """
+        es_conn_conf = build_es_conn_config(conf)
+        return tuple((key, hashable(value)) for key, value in sorted(es_conn_conf.items()))
+
+    def get(self, conf, factory=None):
+        """ Returns the shared client for conf's connection settings, creating it with factory
+        (default :func:`elasticsearch_client`) the first time those settings are seen. """
+        key = self.conn_key(conf)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self.misses += 1
+                client = (factory or elasticsearch_client)(conf)
+                self._clients[key] = client
+            else:
+                self.hits += 1
+            if 'name' in conf:
+                self._names.setdefault(key, set()).add(conf['name'])
+        return client
+
+    def probe(self, confs, factory=None):
+        """ Resolves the es_version of every distinct cluster referenced by confs so that each of them
+        is asked exactly once, and later callers of :meth:`get` receive an already versioned client.
+
+        :return: A dictionary mapping (es_host, es_port) to the version, or None if it could not be resolved.
+        """
+        versions = {}
+        probed = set()
+        for conf in confs:
+            key = self.conn_key(conf)
+            client = self.get(conf, factory)
+            if key in probed:
+                continue
+            probed.add(key)
+            es_conn_conf = dict(key)
+            try:
+                version = client.es_version
+            except TransportError as e:
+                elastalert_logger.warning('Could not get the version of Elasticsearch at %s:%s: %s' % (
+                    es_conn_conf['es_host'], es_conn_conf['es_port'], e))
+                version = None
+            versions[(es_conn_conf['es_host'], es_conn_conf['es_port'])] = version
+        return versions
+
+    def release_unused(self, confs):
+        """ Drops the clients which none of confs uses, such as those of rules which were removed or now connect
+        with other settings, and closes their connections.
+
+        :return: The released clients.
+        """
+        names = {}
+        for conf in confs:
+            names.setdefault(self.conn_key(conf), set())
+            if 'name' in conf:
+                names[self.conn_key(conf)].add(conf['name'])
+        with self._lock:
+            released = [self._clients.pop(key) for key in list(self._clients) if key not in names]
+            self._names = dict((key, rule_names) for key, rule_names in names.items() if key in self._clients)
+        for client in released:
+            transport = getattr(client, 'transport', None)
+            try:
+                transport.close()
+            except Exception as e:
+                elastalert_logger.warning('Error closing the connections of an unused Elasticsearch client: %s' % (e))
+        return released
+
+    def clear(self):
+        """ Drops every shared client """
+        with self._lock:
+            self._clients = {}
+            self._names = {}
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._clients)
+
+    def stats(self):
+        """ Returns the number of shared clients, lookup hit/miss counts and, for each client,
+        the rules using it and the size of its connection pool. """
+        with self._lock:
+            clients = []
+            for key, client in self._clients.items():
+                es_conn_conf = dict(key)
+                transport = getattr(client, 'transport', None)
+                connection_pool = getattr(transport, 'connection_pool', None)
+                clients.append({'es_host': es_conn_conf['es_host'],
+                                'es_port': es_conn_conf['es_port'],
+                                'rules': len(self._names.get(key, ())),
+                                'connections': len(getattr(connection_pool, 'connections', ()))})
+            return {'clients': len(self._clients),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'pools': clients}
+
+
+# Process-wide pool of clients shared by every rule
+es_client_pool = ElasticSearchClientPool()
+
+
 def build_es_conn_config(conf):
     """ Given a conf dictionary w/ raw config properties 'use_ssl', 'es_host', 'es_port'
     'es_username' and 'es_password', this will return a new dictionary
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import itertools
+import multiprocessing
+import threading
+import time
+import traceback
+import zlib
+
+from .util import EAException
+from .util import elastalert_logger
+
+
+def rule_partition(rule_name, count):
+    """ Returns the index of the worker process, out of count, which runs the rule named rule_name. """
+    return zlib.crc32(rule_name.encode('utf-8')) % count
+
+
+def run_rule_worker(args, index, count, tasks, results):
+    """ The main loop of a worker process. Loads the rules like ElastAlert does from args and runs
+    the queries and rule types of the rules in its partition, sending the matches back to the
+    process which started it. """
+    # Imported here, as elastalert.elastalert imports this module
+    from .elastalert import ElastAlerter
+
+    # The other rules are run by the other workers, which also load them and build their rule types
+    client = ElastAlerter(args, rule_filter=lambda rule_name: rule_partition(rule_name, count) == index)
+    # Only the process which started the workers spools writeback documents to disk
+    client.writeback_spool = None
+    elastalert_logger.info('Rule worker %s runs %s rules' % (index, len(client.rules)))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == 'reload':
+            client.load_rule_changes()
+            continue
+        if task[0] == 'reset':
+            client.reset_rule_start(task[1])
+            continue
+
+        _, request_id, rule_name, endtime, starttime = task
+        # The timeout of the request runs from here, not from when it was queued behind the others
+        results.put(('started', request_id))
+        try:
+            results.put((request_id, client.find_matches_for_coordinator(rule_name, endtime, starttime), None))
+        except EAException as e:
+            results.put((request_id, None, ('EAException', str(e))))
+        except Exception:
+            results.put((request_id, None, ('Exception', traceback.format_exc())))
+
+
+class RuleWorkerPool(object):
+    """ Runs the queries and rule types of the rules in worker processes, so that hits are processed
+    on more than one core.
+
+    Rules are divided between the processes by a hash of their name, so each process keeps the
+    state of its rules (the RuleType and the processed hits) from one run to the next. The process
+    which started the pool keeps scheduling the rules and silences, aggregates and sends the matches
+    the workers find (see :meth:`ElastAlerter.run_rule`).
+
+    A worker which exits, or does not answer a request within its timeout from when it started running
+    it, fails the requests it was sent and is started again, loading its rules anew.
+
+    :param args: The command line arguments of ElastAlert, which each worker loads the rules with.
+    :param processes: The number of worker processes.
+    :param worker: The main loop of a worker process.
+    :param watch_interval: The seconds between two checks of the workers.
+    """
+
+    def __init__(self, args, processes, worker=run_rule_worker, watch_interval=1):
+        self.args = args
+        self.worker = worker
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = [None] * processes
+        self.tasks = [None] * processes
+        self.results = self.context.Queue()
+        for index in range(processes):
+            self._start_worker(index)
+
+        self._lock = threading.Lock()
+        # The future, worker index, timeout and deadline of each request, by request id. The deadline
+        # is set once the worker starts running the request
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._closed = threading.Event()
+        self._reader = threading.Thread(target=self._read_results, name='elastalert-worker-results', daemon=True)
+        self._reader.start()
+        self._watch_interval = watch_interval
+        self._watchdog = threading.Thread(target=self._watch_workers, name='elastalert-worker-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def _start_worker(self, index):
+        # A new queue, so that the tasks sent to a dead worker are not run by the next one
+        tasks = self.context.Queue()
+        process = self.context.Process(target=self.worker, args=(self.args, index, len(self.processes), tasks, self.results),
+                                       name='elastalert-worker-%s' % (index), daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.tasks[index] = tasks
+
+    def _read_results(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            if result[0] == 'started':
+                with self._lock:
+                    if result[1] in self._pending:
+                        future, index, timeout, _ = self._pending[result[1]]
+                        if timeout is not None:
+                            self._pending[result[1]] = (future, index, timeout, time.monotonic() + timeout)
+                continue
+            request_id, value, error = result
+            with self._lock:
+                future, _, _, _ = self._pending.pop(request_id, (None, None, None, None))
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(value)
+            elif error[0] == 'EAException':
+                future.set_exception(EAException(error[1]))
+            else:
+                future.set_exception(Exception('Error in rule worker process:\n%s' % (error[1])))
+
+    def _watch_workers(self):
+        while not self._closed.wait(self._watch_interval):
+            self.check_workers()
+
+    def check_workers(self):
+        """ Fails the requests of the workers which exited or are late answering, and starts them again. """
+        now = time.monotonic()
+        with self._lock:
+            late = set(index for _, index, _, deadline in self._pending.values() if deadline is not None and deadline < now)
+        for index, process in enumerate(self.processes):
+            if self._closed.is_set():
+                return
+            if not process.is_alive():
+                reason = 'exited with code %s' % (process.exitcode)
+            elif index in late:
+                reason = 'did not answer in time'
+                process.terminate()
+                process.join(5)
+            else:
+                continue
+            elastalert_logger.error('Rule worker %s %s, starting it again' % (index, reason))
+            with self._lock:
+                failed = [request_id for request_id, (_, worker, _, _) in self._pending.items() if worker == index]
+                futures = [self._pending.pop(request_id)[0] for request_id in failed]
+                # Under the lock, so that no request is sent to the queue of the dead worker
+                self._start_worker(index)
+            for future in futures:
+                future.set_exception(EAException('Rule worker %s %s' % (index, reason)))
+
+    def submit(self, rule_name, endtime, starttime=None, timeout=None):
+        """ Has the worker of rule_name find its matches between starttime and endtime. Returns a
+        concurrent.futures.Future of the result of :meth:`ElastAlerter.find_matches_for_coordinator`.
+        If the worker does not answer within timeout seconds of starting the request, it is restarted and
+        the future fails. """
+        future = concurrent.futures.Future()
+        index = rule_partition(rule_name, len(self.tasks))
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._pending[request_id] = (future, index, timeout, None)
+            tasks = self.tasks[index]
+        tasks.put(('run', request_id, rule_name, endtime, starttime))
+        return future
+
+    def run(self, rule_name, endtime, starttime=None, timeout=None):
+        """ Like :meth:`submit`, but waits for and returns the result. """
+        return self.submit(rule_name, endtime, starttime, timeout).result()
+
+    def reset(self, rule_name):
+        """ Has the worker of rule_name forget the start time of the rule, before its next run. """
+        with self._lock:
+            tasks = self.tasks[rule_partition(rule_name, len(self.tasks))]
+        tasks.put(('reset', rule_name))
+
+    def reload(self):
+        """ Has every worker load the rules which changed. """
+        for tasks in self.tasks:
+            tasks.put(('reload',))
+
+    def close(self):
+        self._closed.set()
+        self._watchdog.join()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(5)
+        self.results.put(None)
+        with self._lock:
+            for future, _, _, _ in self._pending.values():
+                future.set_exception(EAException('Rule worker pool was closed'))
+            self._pending.clear()
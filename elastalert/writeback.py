@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import threading
+import uuid
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from .util import elastalert_logger
+
+
+def is_retryable(item):
+    """ Returns whether a failed _bulk item may succeed when it is sent again. """
+    return item.get('status', 500) == 429 or item.get('status', 500) >= 500
+
+
+class WritebackQueue(object):
+    """ Collects the documents ElastAlert writes to its writeback index and sends them in _bulk
+    requests from a background thread, so rules do not wait for each write.
+
+    Queued documents are sent once bulk_size of them are waiting, every flush_interval seconds
+    and on :meth:`close`. Ids are generated when a document is queued, so callers get the _id
+    of a document (to aggregate alerts under it, for example) before it is written.
+
+    :param client: The Elasticsearch client of the writeback index.
+    :param bulk_size: The number of queued documents which triggers a _bulk request.
+    :param flush_interval: The maximum number of seconds a document waits in the queue.
+    :param on_error: Called with the (action, body) pairs of documents which could not be written
+        because Elasticsearch was unavailable or overloaded, and may be written later.
+    """
+
+    def __init__(self, client, bulk_size=500, flush_interval=1.0, on_error=None):
+        self.client = client
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.documents = 0
+        self.requests = 0
+        # Guards the queued actions, while _flush_lock keeps bulk requests in order
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._actions = []
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='elastalert-writeback', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._actions) // 2
+
+    def add(self, index, body, doc_type=None):
+        """ Queues body to be indexed into index and returns an index style response with its _id. """
+        _id = uuid.uuid4().hex
+        meta = {'_index': index, '_id': _id}
+        if doc_type:
+            meta['_type'] = doc_type
+        with self._lock:
+            self._actions += [{'index': meta}, body]
+            if len(self) >= self.bulk_size:
+                self._wakeup.set()
+        return {'_index': index, '_id': _id, 'result': 'queued'}
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep flushing later documents
+                elastalert_logger.exception('Error flushing writeback queue: %s' % (e))
+
+    def flush(self):
+        """ Sends every queued document in one _bulk request.
+
+        :return: A list of (action, body) pairs of the documents which could not be written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                actions, self._actions = self._actions, []
+            if not actions:
+                return []
+
+            pairs = [(actions[i], actions[i + 1]) for i in range(0, len(actions), 2)]
+            self.requests += 1
+            try:
+                res = self.client.bulk(body=actions)
+            except ElasticsearchException as e:
+                elastalert_logger.exception('Error writing %s documents to Elasticsearch: %s' % (len(pairs), e))
+                if self.on_error is not None:
+                    self.on_error(pairs)
+                return pairs
+
+            failed = []
+            retry = []
+            for pair, item in zip(pairs, res['items']):
+                if 'error' in item['index']:
+                    elastalert_logger.error('Error writing document %s to Elasticsearch: %s' %
+                                            (item['index'].get('_id'), item['index']['error']))
+                    failed.append(pair)
+                    if is_retryable(item['index']):
+                        retry.append(pair)
+            self.documents += len(pairs) - len(failed)
+            if retry and self.on_error is not None:
+                self.on_error(retry)
+            return failed
+
+    def close(self):
+        """ Stops the background thread and sends the documents still queued. """
+        self._closed.set()
+        self._wakeup.set()
+        self._thread.join(self.flush_interval + 1)
+        return self.flush()
@@ -49,5 +49,9 @@ setup(
         'cffi>=1.11.5',
         'statsd-tags==3.2.1.post1',
         'tzlocal<3.0'
-    ]
+    ],
+    extras_require={
+        # The asyncio query engine
+        'async': ['aiohttp>=3.6.0'],
+    }
 )
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from elastalert.aggregation import AggregationBuffer
+from elastalert.util import ts_to_dt
+
+START = ts_to_dt('2014-09-26T12:00:00Z')
+MINUTE = datetime.timedelta(minutes=1)
+
+
+def test_aggregation_buffer_pop_due():
+    buffer = AggregationBuffer()
+    assert not buffer
+    buffer.add('a', {'n': 1}, START + MINUTE * 10)
+    buffer.add(None, {'n': 2}, START + MINUTE * 5)
+    buffer.add('a', {'n': 3}, START + MINUTE * 10)
+    buffer.add('b', {'n': 4}, START + MINUTE * 20)
+    assert len(buffer) == 4
+    assert list(buffer) == [{'n': 1}, {'n': 3}, {'n': 2}, {'n': 4}]
+
+    alert_times = {'a': START + MINUTE * 10, None: START + MINUTE * 5, 'b': START + MINUTE * 20}
+    assert buffer.pop_due(START, alert_times) == []
+    assert buffer.pop_due(START + MINUTE * 11, alert_times) == [(None, [{'n': 2}]), ('a', [{'n': 1}, {'n': 3}])]
+    assert len(buffer) == 1
+
+    # A new aggregation for the same key gets its own alert time
+    buffer.add('a', {'n': 5}, START + MINUTE * 30)
+    alert_times['a'] = START + MINUTE * 30
+    assert buffer.pop_due(START + MINUTE * 21, alert_times) == [('b', [{'n': 4}])]
+    assert buffer.pop_due(START + MINUTE * 31, alert_times) == [('a', [{'n': 5}])]
+    assert not buffer
+
+
+def test_aggregation_buffer_moved_alert_time():
+    buffer = AggregationBuffer()
+    buffer.add('a', {'n': 1}, START + MINUTE * 10)
+    # The aggregation was found pending in the writeback index with a later alert time
+    alert_times = {'a': START + MINUTE * 15}
+    assert buffer.pop_due(START + MINUTE * 11, alert_times) == []
+    assert buffer.pop_due(START + MINUTE * 16, alert_times) == [('a', [{'n': 1}])]
+
+
+def test_aggregation_buffer_drain():
+    buffer = AggregationBuffer()
+    buffer.add('a', {'n': 1}, START)
+    buffer.add('b', {'n': 2}, START)
+    assert buffer.drain() == [{'n': 1}, {'n': 2}]
+    assert not buffer
+    assert buffer.pop_due(START + MINUTE, {}) == []
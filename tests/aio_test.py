@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+import mock
+import pytest
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import NotFoundError
+
+from elastalert.aio import AsyncElasticsearch
+from elastalert.aio import QueryEngine
+
+
+def client_conf(max_retries=0, **kwargs):
+    conf = {'es_host': '127.0.0.1', 'es_port': 9200, 'es_url_prefix': '', 'es_conn_timeout': 5, 'http_auth': None,
+            'headers': None, 'use_ssl': False, 'verify_certs': True, 'ca_certs': None, 'client_cert': None, 'client_key': None,
+            'send_get_body_as': 'GET', 'ssl_show_warn': True}
+    conf.update(kwargs)
+    client = mock.Mock()
+    client.conf = conf
+    client.transport.max_retries = max_retries
+    client.transport.retry_on_status = (502, 503, 504)
+    client.transport.retry_on_timeout = False
+    return client
+
+
+async def serve(responses, requests, connections):
+    """ Starts an HTTP server which answers each request with the next of responses, a (status, body, chunked) tuple. """
+    async def handle(reader, writer):
+        connections.append(writer)
+        while responses:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            requests.append((request_line.decode('latin-1').split()[:2], headers, json.loads(body) if body else None))
+
+            status, payload, chunked = responses.pop(0)
+            data = json.dumps(payload).encode('utf-8')
+            if chunked:
+                half = len(data) // 2
+                writer.write(b'HTTP/1.1 %d OK\r\ntransfer-encoding: chunked\r\n\r\n' % (status))
+                writer.write(b'%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n' % (half, data[:half], len(data) - half, data[half:]))
+            else:
+                writer.write(b'HTTP/1.1 %d OK\r\ncontent-length: %d\r\n\r\n%s' % (status, len(data), data))
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def test_async_elasticsearch_requests():
+    requests = []
+    connections = []
+    responses = [(200, {'hits': {'hits': [{'_id': '1'}]}}, False),
+                 (200, {'count': 3}, True),
+                 (404, {'error': {'type': 'search_context_missing_exception'}, 'status': 404}, False)]
+
+    async def run():
+        server = await serve(responses, requests, connections)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncElasticsearch(client_conf(es_port=port, http_auth='user:pass', es_url_prefix='es'))
+        try:
+            res = await client.search(index='logstash-*', body={'query': {'match_all': {}}}, size=10,
+                                      ignore_unavailable=True, _source_includes=['a', 'b'])
+            assert res == {'hits': {'hits': [{'_id': '1'}]}}
+            res = await client.count(index='logstash-*', doc_type='doc', body={})
+            assert res == {'count': 3}
+            with pytest.raises(NotFoundError):
+                await client.clear_scroll(scroll_id='abc')
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+    assert requests[0][0] == ['GET', '/es/logstash-*/_search?size=10&ignore_unavailable=true&_source_includes=a,b']
+    assert requests[0][1]['authorization'] == 'Basic dXNlcjpwYXNz'
+    assert requests[0][2] == {'query': {'match_all': {}}}
+    assert requests[1][0] == ['GET', '/es/logstash-*/doc/_count']
+    assert requests[2][0] == ['DELETE', '/es/_search/scroll']
+    assert requests[2][2] == {'scroll_id': ['abc']}
+    # Every request was sent on the same connection
+    assert len(connections) == 1
+
+
+@pytest.mark.parametrize('send_get_body_as, request_line', [
+    ('POST', ['POST', '/_search']),
+    ('source', ['GET', '/_search?source=%7B%22size%22:1%7D']),
+])
+def test_async_elasticsearch_send_get_body_as(send_get_body_as, request_line):
+    requests = []
+    responses = [(200, {}, False)]
+
+    async def run():
+        server = await serve(responses, requests, [])
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncElasticsearch(client_conf(es_port=port, send_get_body_as=send_get_body_as))
+        try:
+            await client.search(body={'size': 1})
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+    assert requests[0][0] == request_line
+
+
+def test_async_elasticsearch_retries():
+    requests = []
+    responses = [(503, {'error': 'unavailable'}, False), (200, {'count': 1}, False)]
+
+    async def run():
+        server = await serve(responses, requests, [])
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncElasticsearch(client_conf(max_retries=1, es_port=port))
+        try:
+            assert await client.count(body={}) == {'count': 1}
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    with mock.patch('asyncio.sleep', new=mock.AsyncMock()):
+        asyncio.run(run())
+    assert len(requests) == 2
+
+
+def test_async_elasticsearch_connection_error():
+    async def run():
+        # Nothing listens on port 1
+        client = AsyncElasticsearch(client_conf(es_port=1))
+        try:
+            with pytest.raises(ConnectionError):
+                await client.search(index='logstash-*', body={})
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_async_elasticsearch_supports():
+    assert AsyncElasticsearch.supports(client_conf())
+    assert AsyncElasticsearch.supports(client_conf(http_auth='user:pass'))
+    # Requests signed for AWS
+    assert not AsyncElasticsearch.supports(client_conf(http_auth=object()))
+    # Rules query on threads without aiohttp
+    with mock.patch('elastalert.aio.aiohttp', None):
+        assert not AsyncElasticsearch.supports(client_conf())
+        assert not QueryEngine.available()
+
+
+def test_query_engine_submit():
+    engine = QueryEngine(threads=1)
+    release = []
+
+    async def run(value):
+        while not release:
+            await asyncio.sleep(0.01)
+        return value
+
+    try:
+        future = engine.submit('rule', run(1))
+        # A rule only runs once at a time
+        assert engine.submit('rule', run(2)) is None
+        assert engine.submit('other rule', run(3)) is not None
+        release.append(True)
+        assert future.result(5) == 1
+        assert engine.submit('rule', run(4)).result(5) == 4
+
+        sync_client = client_conf()
+        assert engine.client(sync_client) is engine.client(sync_client)
+        # Attributes other than requests are those of the synchronous client
+        assert engine.client(sync_client).is_atleastseven is sync_client.is_atleastseven
+
+        # The client of a released synchronous client is replaced
+        client = engine.client(sync_client)
+        engine.release([sync_client])
+        assert engine.client(sync_client) is not client
+    finally:
+        engine.close()
@@ -10,16 +10,29 @@ import pytest
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.exceptions import ElasticsearchException
 
+from elastalert import ElasticSearchClient
+from elastalert.aio import QueryEngine
+from elastalert.cluster import HashRing
+from elastalert.dedup import ProbabilisticProcessedHits
+from elastalert.dedup import ProcessedHits
 from elastalert.enhancements import BaseEnhancement
 from elastalert.enhancements import DropMatchException
 from elastalert.kibana import dashboard_temp
+from elastalert.msearch import MultiSearchCoalescer
+from elastalert.ruletypes import FlatlineRule
+from elastalert.scheduling import RuleScheduler
+from elastalert.spool import WritebackSpool
+from elastalert.state import FileRuleStateStore
+from elastalert.util import build_es_conn_config
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_unix
 from elastalert.util import dt_to_unixms
 from elastalert.util import EAException
+from elastalert.util import pretty_ts
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
 from elastalert.util import unix_to_dt
+from elastalert.writeback import WritebackQueue
 
 START_TIMESTAMP = '2014-09-26T12:34:45Z'
 END_TIMESTAMP = '2014-09-27T12:34:45Z'
@@ -90,6 +103,126 @@ def test_init_rule(ea):
     assert new_rule['run_every'] == datetime.timedelta(seconds=17)
 
 
+def test_init_rule_processed_hits_options(ea):
+    new_rule = copy.copy(ea.rules[0])
+    new_rule['max_processed_hits'] = 1000
+    new_rule['dedup_mode'] = 'compact'
+    new_rule = ea.init_rule(new_rule, True)
+    assert new_rule['processed_hits'].max_size == 1000
+    assert new_rule['processed_hits'].compact
+
+
+def test_init_rule_reload_processed_hits_options(ea):
+    rule = ea.rules[0]
+    for i in range(3):
+        rule['processed_hits']['id%s' % (i)] = START + datetime.timedelta(seconds=i)
+    processed_hits = rule['processed_hits']
+
+    # The same options keep the same store
+    new_rule = ea.init_rule(copy.copy(rule), False)
+    assert new_rule['processed_hits'] is processed_hits
+
+    # The ids are copied into a store with the new options, oldest first
+    ea.rules[0] = new_rule
+    new_rule = copy.copy(new_rule)
+    new_rule['max_processed_hits'] = 2
+    new_rule['dedup_mode'] = 'compact'
+    new_rule = ea.init_rule(new_rule, False)
+    assert new_rule['processed_hits'].max_size == 2
+    assert new_rule['processed_hits'].compact
+    assert 'id0' not in new_rule['processed_hits']
+    assert new_rule['processed_hits']['id2'] == START + datetime.timedelta(seconds=2)
+    assert new_rule['processed_hits'].evicted == 1
+
+    # Only the hashes of the ids are known in compact mode, so they are forgotten
+    ea.rules[0] = new_rule
+    new_rule = copy.copy(new_rule)
+    new_rule['dedup_mode'] = 'probabilistic'
+    new_rule = ea.init_rule(new_rule, False)
+    assert isinstance(new_rule['processed_hits'], ProbabilisticProcessedHits)
+    assert len(new_rule['processed_hits']) == 0
+
+
+def test_init_rule_probabilistic_dedup(ea):
+    new_rule = copy.copy(ea.rules[0])
+    new_rule['dedup_mode'] = 'probabilistic'
+    new_rule['dedup_capacity'] = 5000
+    new_rule['dedup_false_positive_rate'] = 0.01
+    new_rule['buffer_time'] = datetime.timedelta(minutes=10)
+    new_rule['query_delay'] = datetime.timedelta(minutes=2)
+    new_rule = ea.init_rule(new_rule, True)
+    assert isinstance(new_rule['processed_hits'], ProbabilisticProcessedHits)
+    assert new_rule['processed_hits'].capacity == 5000
+    assert new_rule['processed_hits'].error_rate == 0.01
+    assert new_rule['processed_hits'].slice_seconds == 180
+
+
+def test_init_rule_priority_scheduler(ea):
+    ea.scheduler.reset_mock()
+    ea.rule_scheduler = RuleScheduler()
+    ea.priority_classes = ['page', 'default', 'report']
+    new_rule = copy.copy(ea.rules[0])
+    new_rule['priority_class'] = 'report'
+    new_rule['query_delay'] = datetime.timedelta(minutes=2)
+    new_rule = ea.init_rule(new_rule, True)
+    job = ea.rule_scheduler.get_job('anytest')
+    assert job.args == [new_rule]
+    assert job.interval == 15
+    assert job.priority == 2
+    assert job.slack == 120
+    assert not ea.scheduler.add_job.called
+
+    # Unknown classes are the default class
+    new_rule['priority_class'] = 'unknown'
+    assert ea.get_rule_priority(new_rule) == 1
+    ea.priority_classes = ['page']
+    assert ea.get_rule_priority(new_rule) == 1
+
+    # Reloading the rule replaces its job
+    new_rule = ea.init_rule(copy.copy(new_rule), False)
+    assert ea.rule_scheduler.get_job('anytest') is not job
+    ea.handle_uncaught_exception(Exception('error'), new_rule)
+    assert ea.rule_scheduler.get_job('anytest') is not None
+    ea.disable_rules_on_error = True
+    ea.handle_uncaught_exception(Exception('error'), new_rule)
+    assert ea.rule_scheduler.get_job('anytest') is None
+
+
+def test_rule_state_snapshot_and_restore(ea, tmpdir):
+    ea.rule_state_store = FileRuleStateStore(str(tmpdir))
+    rule = ea.rules[0]
+    rule['type'].get_state = mock.Mock(return_value={'occurrences': [['all', [[{'@timestamp': START}, 1]]]]})
+    ea.snapshot_rule_state(rule, END)
+    # At most one snapshot per rule_state_interval
+    ea.rule_state_interval = datetime.timedelta(hours=1)
+    rule['type'].get_state.return_value = {}
+    ea.snapshot_rule_state(rule, END + datetime.timedelta(minutes=1))
+
+    new_rule = copy.copy(rule)
+    new_rule['type'] = type(rule['type'])()
+    new_rule['type'].set_state = mock.Mock()
+    with mock.patch('elastalert.elastalert.ts_now', return_value=END + datetime.timedelta(hours=1)):
+        ea.restore_rule_state(new_rule)
+    new_rule['type'].set_state.assert_called_with({'occurrences': [['all', [[{'@timestamp': START}, 1]]]]})
+    # The rule queries on from the end of the run of the snapshot
+    assert new_rule['starttime'] == new_rule['previous_endtime'] == new_rule['minimum_starttime'] == END
+
+    # Snapshots of another type of rule or older than old_query_limit are not restored
+    new_rule['type'].set_state.reset_mock()
+    new_rule['query_key'] = 'user'
+    ea.restore_rule_state(new_rule)
+    new_rule.pop('query_key')
+    ea.restore_rule_state(new_rule)
+    assert not new_rule['type'].set_state.called
+
+    # A reloaded rule keeps its state
+    reloaded = copy.copy(new_rule)
+    reloaded['type'] = type(rule['type'])()
+    reloaded['type'].set_state = mock.Mock()
+    ea.copy_rule_state(rule, reloaded)
+    reloaded['type'].set_state.assert_called_with({})
+
+
 def test_query(ea):
     ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
     ea.run_query(ea.rules[0], START, END)
@@ -135,6 +268,117 @@ def test_query_sixsix_with_fields(ea_sixsix):
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
+def test_query_scroll(ea):
+    ea.rules[0]['max_query_size'] = 2
+    ea.rules[0]['max_scrolling_count'] = 0
+    first_page = generate_hits([START_TIMESTAMP, START_TIMESTAMP])
+    first_page['hits']['total'] = 3
+    first_page['_scroll_id'] = 'scroll1'
+    second_page = generate_hits([END_TIMESTAMP])
+    second_page['hits']['hits'][0]['_id'] = 'id2'
+    ea.thread_data.current_es.search.return_value = first_page
+    ea.thread_data.current_es.scroll = mock.Mock(return_value=second_page)
+    ea.thread_data.current_es.clear_scroll = mock.Mock()
+    assert ea.run_query(ea.rules[0], START, END)
+
+    ea.thread_data.current_es.scroll.assert_called_once_with(scroll_id='scroll1', scroll=ea.conf['scroll_keepalive'])
+    ea.thread_data.current_es.clear_scroll.assert_called_once_with(scroll_id='scroll1')
+    assert ea.rules[0]['type'].add_data.call_count == 2
+    assert 'scroll_id' not in ea.rules[0]
+
+
+def test_query_scroll_max_scrolling_count(ea):
+    ea.rules[0]['max_query_size'] = 1
+    ea.rules[0]['max_scrolling_count'] = 2
+    pages = []
+    for i in range(5):
+        page = generate_hits([START_TIMESTAMP])
+        page['hits']['hits'][0]['_id'] = 'id%s' % (i)
+        page['hits']['total'] = 5
+        page['_scroll_id'] = 'scroll1'
+        pages.append(page)
+    ea.thread_data.current_es.search.return_value = pages[0]
+    ea.thread_data.current_es.scroll = mock.Mock(side_effect=pages[1:])
+    ea.thread_data.current_es.clear_scroll = mock.Mock()
+    assert ea.run_query(ea.rules[0], START, END)
+
+    assert ea.thread_data.current_es.scroll.call_count == 1
+    assert ea.rules[0]['type'].add_data.call_count == 2
+    ea.thread_data.current_es.clear_scroll.assert_called_once_with(scroll_id='scroll1')
+
+
+def test_query_point_in_time(ea_sixsix):
+    es = ea_sixsix.thread_data.current_es = ea_sixsix.current_es
+    es.is_atleastseven.return_value = True
+    es.is_atleastseventwelve.return_value = True
+    es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    es.close_point_in_time = mock.Mock()
+    ea_sixsix.rules[0]['max_query_size'] = 2
+    ea_sixsix.rules[0]['max_scrolling_count'] = 0
+    first_page = generate_hits([START_TIMESTAMP, START_TIMESTAMP])
+    first_page['hits']['total'] = {'value': 3}
+    first_page['hits']['hits'][1]['sort'] = [1, 7]
+    first_page['pit_id'] = 'pit2'
+    second_page = generate_hits([END_TIMESTAMP])
+    second_page['hits']['hits'][0]['_id'] = 'id2'
+    second_page['pit_id'] = 'pit3'
+    es.point_in_time_search = mock.Mock(side_effect=[first_page, second_page])
+    assert ea_sixsix.run_query(ea_sixsix.rules[0], START, END)
+
+    es.open_point_in_time.assert_called_once_with(index='idx', keep_alive=ea_sixsix.conf['scroll_keepalive'],
+                                                  ignore_unavailable=True)
+    assert es.search.call_count == 0
+    calls = es.point_in_time_search.call_args_list
+    assert len(calls) == 2
+    assert calls[0][1]['body']['pit'] == {'id': 'pit1', 'keep_alive': ea_sixsix.conf['scroll_keepalive']}
+    assert 'search_after' not in calls[0][1]['body']
+    assert calls[0][1]['size'] == 2
+    assert calls[1][1]['body']['pit']['id'] == 'pit2'
+    assert calls[1][1]['body']['search_after'] == [1, 7]
+    assert calls[1][1]['track_total_hits'] is False
+    es.close_point_in_time.assert_called_once_with(body={'id': 'pit3'})
+    assert ea_sixsix.rules[0]['type'].add_data.call_count == 2
+    assert ea_sixsix.thread_data.total_hits == 3
+    assert 'pit_id' not in ea_sixsix.rules[0]
+    assert 'search_after' not in ea_sixsix.rules[0]
+
+
+def test_query_point_in_time_error(ea_sixsix):
+    es = ea_sixsix.thread_data.current_es = ea_sixsix.current_es
+    es.is_atleastseventwelve.return_value = True
+    es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    es.close_point_in_time = mock.Mock()
+    es.point_in_time_search = mock.Mock(side_effect=ElasticsearchException('boom'))
+    with mock.patch.object(ea_sixsix, 'handle_error') as mock_error:
+        assert not ea_sixsix.run_query(ea_sixsix.rules[0], START, END)
+    assert 'boom' in mock_error.call_args[0][0]
+    es.close_point_in_time.assert_called_once_with(body={'id': 'pit1'})
+
+
+def test_query_point_in_time_disabled(ea_sixsix):
+    es = ea_sixsix.thread_data.current_es = ea_sixsix.current_es
+    es.is_atleastseventwelve.return_value = True
+    es.open_point_in_time = mock.Mock()
+    ea_sixsix.rules[0]['use_point_in_time'] = False
+    es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    assert ea_sixsix.run_query(ea_sixsix.rules[0], START, END)
+    assert es.open_point_in_time.call_count == 0
+    assert es.search.call_args[1]['scroll'] == ea_sixsix.conf['scroll_keepalive']
+
+
+def test_query_hits_chunk_size(ea):
+    ea.rules[0]['hits_chunk_size'] = 2
+    hits = generate_hits([START_TIMESTAMP] * 5)
+    ea.rules[0]['processed_hits'] = {'id3': START}
+    ea.thread_data.current_es.search.return_value = hits
+    ea.thread_data.num_dupes = 0
+    assert ea.run_query(ea.rules[0], START, END)
+
+    chunks = [call[0][0] for call in ea.rules[0]['type'].add_data.call_args_list]
+    assert [[event['_id'] for event in chunk] for chunk in chunks] == [['id0', 'id1'], ['id2', 'id4']]
+    assert ea.thread_data.num_dupes == 1
+
+
 def test_query_with_unix(ea):
     ea.rules[0]['timestamp_type'] = 'unix'
     ea.rules[0]['dt_to_ts'] = dt_to_unix
@@ -261,6 +505,107 @@ def test_match(ea):
     assert ea.rules[0]['alert'][0].alert.call_count == 1
 
 
+def test_find_matches_for_coordinator(ea):
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    ea.thread_data.current_es.search.return_value = hits
+    ea.rules[0]['type'].matches = [{'@timestamp': END}]
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        result = ea.find_matches_for_coordinator('anytest', END, START)
+
+    assert result['matches'] == [{'@timestamp': END}]
+    assert result['endtime'] == END
+    assert result['original_starttime'] == START
+    assert ea.rules[0]['type'].matches == []
+    assert ea.rules[0]['previous_endtime'] == END
+    # Matches are handled by the process which started the worker
+    assert not ea.rules[0]['alert'][0].alert.called
+
+    with pytest.raises(EAException):
+        ea.find_matches_for_coordinator('notloaded', END, START)
+
+
+def test_run_rule_with_rule_workers(ea):
+    ea.rule_workers = mock.Mock()
+    ea.rule_workers.submit.return_value.result.return_value = {'endtime': END,
+                                                               'matches': [{'@timestamp': END}],
+                                                               'starttime': START,
+                                                               'original_starttime': START,
+                                                               'num_hits': 0,
+                                                               'num_dupes': 1,
+                                                               'cumulative_hits': 5}
+    with mock.patch.object(ea, 'run_query') as mock_query:
+        assert ea.run_rule(ea.rules[0], END, START) == 1
+
+    assert not mock_query.called
+    # The worker may run the rule for ten times its run_every
+    ea.rule_workers.submit.assert_called_with('anytest', END, START, 150)
+    assert ea.rules[0]['alert'][0].alert.call_count == 1
+    assert ea.rules[0]['alert'][0].alert.call_args[0][0][0]['num_hits'] == 5
+    assert ea.rules[0]['previous_endtime'] == END
+
+    # The rule did not run in its worker
+    found = ea.rule_workers.submit.return_value
+    found.result.return_value = dict(found.result.return_value, endtime=None)
+    assert ea.run_rule(ea.rules[0], END, START) == 0
+
+    # The pool fails the run when the worker exits or is late
+    found.result.side_effect = EAException('Rule worker 0 did not answer in time')
+    with pytest.raises(EAException):
+        ea.run_rule(ea.rules[0], END, START)
+
+    ea.stop()
+    assert ea.rule_workers is None
+
+
+def test_find_matches_async(ea):
+    ea.query_engine = QueryEngine(threads=1)
+    client = mock.Mock()
+    client.is_atleastseven.return_value = False
+    client.is_atleastseventwelve.return_value = False
+    client.search = mock.AsyncMock(return_value=generate_hits([START_TIMESTAMP, END_TIMESTAMP]))
+    client.clear_scroll = mock.AsyncMock()
+    ea.rules[0]['type'].matches = [{'@timestamp': END}]
+    ea.rules[0]['type'].add_data.side_effect = lambda data: threads.append(threading.current_thread())
+    threads = []
+    loop_thread = ea.query_engine._thread
+    try:
+        with mock.patch.object(ea.query_engine, 'client', return_value=client), \
+                mock.patch('elastalert.elastalert.elasticsearch_client'):
+            found = ea.query_engine.submit('anytest', ea.find_matches_async(ea.rules[0], END, START)).result(5)
+    finally:
+        ea.stop()
+
+    assert client.search.call_args[1]['index'] == 'idx'
+    assert ea.rules[0]['type'].add_data.call_count == 1
+    # The rule type processes the hits off the event loop
+    assert threads[0] is not loop_thread
+    assert found['matches'] == [{'@timestamp': END}]
+    assert found['endtime'] == END
+    # The run is split into segments of buffer_time, each returning both hits
+    assert found['cumulative_hits'] == 2 * client.search.call_count
+    assert ea.rules[0]['type'].matches == []
+
+
+def test_handle_rule_execution_query_engine(ea):
+    ea.query_engine = mock.Mock()
+    ea.query_engine.supports.return_value = True
+    with mock.patch.object(ea, 'run_rule_async', new=mock.Mock()) as mock_run, \
+            mock.patch.object(ea, 'run_rule') as mock_run_rule, \
+            mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.handle_rule_execution(ea.rules[0])
+    # The rule runs on the event loop of the engine instead of in this thread
+    assert not mock_run_rule.called
+    assert ea.query_engine.submit.call_args[0] == ('anytest', mock_run.return_value)
+
+    # The matches found on the event loop are handled like those of run_rule
+    found = mock.Mock()
+    found.result.return_value = {'endtime': END, 'matches': [{'@timestamp': END}], 'starttime': START,
+                                 'original_starttime': START, 'num_hits': 2, 'num_dupes': 0, 'cumulative_hits': 2}
+    ea.execute_rule(ea.rules[0], END, datetime.datetime.utcnow(), found)
+    assert ea.rules[0]['alert'][0].alert.call_count == 1
+    assert ea.rules[0]['previous_endtime'] == END
+
+
 def test_run_rule_calls_garbage_collect(ea):
     start_time = '2014-09-26T00:00:00Z'
     end_time = '2014-09-26T12:00:00Z'
@@ -294,6 +639,7 @@ def run_rule_query_exception(ea, mock_es):
 
 def test_query_exception(ea):
     mock_es = mock.Mock()
+    mock_es.is_atleastseventwelve.return_value = False
     mock_es.search.side_effect = ElasticsearchException
     run_rule_query_exception(ea, mock_es)
 
@@ -306,6 +652,36 @@ def test_query_exception_count_query(ea):
     run_rule_query_exception(ea, mock_es)
 
 
+def test_count_query_msearch(ea):
+    ea.rules[0]['use_count_query'] = True
+    ea.rules[0]['doc_type'] = 'doctype'
+    ea.rules[0]['five'] = True
+    ea.query_coalescer = MultiSearchCoalescer(0.01)
+    ea.thread_data.current_es.count = mock.Mock(return_value={'count': 3})
+    ea.thread_data.current_es.msearch = mock.Mock(return_value={'responses': [{'hits': {'total': 5, 'hits': []}}]})
+    assert ea.get_hits_count(ea.rules[0], START, END, 'idx') == {END: 5}
+    assert ea.thread_data.current_es.count.call_count == 0
+    header, body = ea.thread_data.current_es.msearch.call_args[1]['body']
+    assert header == {'index': 'idx', 'ignore_unavailable': True, 'type': 'doctype'}
+    assert body['size'] == 0
+
+    # Rules can opt out of batching
+    ea.rules[0]['use_msearch'] = False
+    assert ea.get_hits_count(ea.rules[0], START, END, 'idx') == {END: 3}
+    assert ea.thread_data.current_es.msearch.call_count == 1
+
+
+def test_count_query_msearch_error(ea):
+    ea.rules[0]['use_count_query'] = True
+    ea.rules[0]['doc_type'] = 'doctype'
+    ea.rules[0]['five'] = True
+    ea.query_coalescer = MultiSearchCoalescer(0.01)
+    ea.thread_data.current_es.msearch = mock.Mock(return_value={'responses': [{'error': 'index_not_found_exception'}]})
+    with mock.patch.object(ea, 'handle_error') as mock_error:
+        assert ea.get_hits_count(ea.rules[0], START, END, 'idx') is None
+    assert 'index_not_found_exception' in mock_error.call_args[0][0]
+
+
 def test_match_with_module(ea):
     mod = BaseEnhancement(ea.rules[0])
     mod.process = mock.Mock()
@@ -407,28 +783,28 @@ def test_agg_matchtime(ea):
     assert 'aggregate_id' not in call3
 
     # First call - Find all pending alerts (only entries without agg_id)
-    # Second call - Find matches with agg_id == 'ABCD'
-    # Third call - Find matches with agg_id == 'CDEF'
+    # Second call - Find matches with agg_id == 'ABCD' or 'CDEF'
     ea.writeback_es.deprecated_search.side_effect = [{'hits': {'hits': [{'_id': 'ABCD', '_index': 'wb', '_source': call1},
                                                                         {'_id': 'CDEF', '_index': 'wb', '_source': call3}]}},
-                                                     {'hits': {'hits': [{'_id': 'BCDE', '_index': 'wb', '_source': call2}]}},
-                                                     {'hits': {'total': 0, 'hits': []}}]
+                                                     {'hits': {'hits': [{'_id': 'BCDE', '_index': 'wb', '_source': call2}]}}]
 
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was taken from the shared clients instead of creating new ones
+        assert mock_es.call_count == 0
     assert_alerts(ea, [hits_timestamps[:2], hits_timestamps[2:]])
 
     call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
     call2 = ea.writeback_es.deprecated_search.call_args_list[8][1]['body']
     call3 = ea.writeback_es.deprecated_search.call_args_list[9][1]['body']
-    call4 = ea.writeback_es.deprecated_search.call_args_list[10][1]['body']
 
     assert 'alert_time' in call2['filter']['range']
-    assert call3['query']['query_string']['query'] == 'aggregate_id:"ABCD"'
-    assert call4['query']['query_string']['query'] == 'aggregate_id:"CDEF"'
+    assert call3['query']['bool']['filter']['terms']['aggregate_id'] == ['ABCD', 'CDEF']
+    assert len(ea.writeback_es.deprecated_search.call_args_list) == 10
+
+    # The alerts and their aggregated matches are deleted together
+    assert ea.writeback_es.bulk.call_args[1]['body'] == [{'delete': {'_index': 'wb', '_id': _id, '_type': 'elastalert'}}
+                                                         for _id in ['ABCD', 'BCDE', 'CDEF']]
     assert ea.writeback_es.deprecated_search.call_args_list[9][1]['size'] == 1337
 
 
@@ -514,9 +890,9 @@ def test_agg_no_writeback_connectivity(ea):
         with mock.patch.object(ea, 'find_pending_aggregate_alert', return_value=None):
             ea.run_rule(ea.rules[0], END, START)
 
-    assert ea.rules[0]['agg_matches'] == [{'@timestamp': hit1, 'num_hits': 0, 'num_matches': 3},
-                                          {'@timestamp': hit2, 'num_hits': 0, 'num_matches': 3},
-                                          {'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}]
+    assert list(ea.rules[0]['agg_matches']) == [{'@timestamp': hit1, 'num_hits': 0, 'num_matches': 3},
+                                                {'@timestamp': hit2, 'num_hits': 0, 'num_matches': 3},
+                                                {'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}]
 
     ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
     ea.add_aggregated_alert = mock.Mock()
@@ -529,6 +905,94 @@ def test_agg_no_writeback_connectivity(ea):
     ea.add_aggregated_alert.assert_any_call({'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}, ea.rules[0])
 
 
+@pytest.mark.parametrize('version', ['6.8.0', '7.12.0'])
+def test_send_pending_alerts_requests(ea, version):
+    """ The requests the Elasticsearch client sends to page through pending alerts and their aggregated matches. """
+    client = ElasticSearchClient(build_es_conn_config({'es_host': 'es', 'es_port': 9200}))
+    client._es_version = version
+    requests = []
+    pending_alert = {'_id': 'a', '_index': 'wb', 'sort': ['s'],
+                     '_source': {'rule_name': ea.rules[0]['name'], 'alert_time': START_TIMESTAMP, 'match_body': {}}}
+
+    def perform_request(method, url, params=None, body=None, headers=None):
+        requests.append((method, url, copy.deepcopy(body)))
+        if url.endswith('_pit') and method == 'POST':
+            return {'id': 'pit'}
+        if url.endswith('_search') and 'terms' not in body['query']['bool']['filter']:
+            return {'hits': {'hits': [pending_alert]}, 'pit_id': 'pit2'}
+        return {'hits': {'hits': []}, 'items': [], '_id': 'b'}
+
+    ea.writeback_es = client
+    with mock.patch.object(client.transport, 'perform_request', side_effect=perform_request):
+        ea.send_pending_alerts()
+
+    searches = [body for method, url, body in requests if url.endswith('_search')]
+    if version == '6.8.0':
+        assert [url for method, url, body in requests if url.endswith('_search')] == ['/wb/_search', '/wb/_search']
+        tiebreaker = {'writeback_id': {'order': 'asc', 'unmapped_type': 'keyword'}}
+    else:
+        # Both are paged in a point in time of their own, sorted on _shard_doc, which is closed with its last id
+        pits = [(method, url, body) for method, url, body in requests if url.endswith('_pit')]
+        assert pits == [('POST', '/wb/_pit', None), ('POST', '/wb/_pit', None),
+                        ('DELETE', '/_pit', {'id': 'pit'}), ('DELETE', '/_pit', {'id': 'pit2'})]
+        assert [url for method, url, body in requests if url.endswith('_search')] == ['/_search', '/_search']
+        assert searches[0]['pit'] == {'id': 'pit', 'keep_alive': '30s'}
+        tiebreaker = {'_shard_doc': 'asc'}
+    assert searches[0]['sort'][-1] == tiebreaker
+    assert searches[1]['sort'][-1] == tiebreaker
+
+
+def test_send_pending_alerts_pages(ea_sixsix):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    ea_sixsix.max_aggregation = 2
+    ea_sixsix.rules[0]['aggregation'] = datetime.timedelta(minutes=10)
+
+    def pending_alert(_id):
+        return {'_id': _id, '_index': 'wb', 'sort': [_id],
+                '_source': {'rule_name': ea_sixsix.rules[0]['name'], 'alert_time': START_TIMESTAMP, 'match_body': {'n': _id}}}
+
+    def agg_match(_id, aggregate_id):
+        return {'_id': _id, '_index': 'wb', 'sort': [_id], '_source': {'aggregate_id': aggregate_id, 'match_body': {'n': _id}}}
+
+    ea_sixsix.writeback_es.search.side_effect = [
+        {'hits': {'hits': [pending_alert('a'), pending_alert('b')]}},
+        {'hits': {'hits': [agg_match('a1', 'a'), agg_match('a2', 'a')]}},
+        {'hits': {'hits': [agg_match('b1', 'b')]}},
+        {'hits': {'hits': [pending_alert('c')]}},
+        {'hits': {'hits': []}}]
+    ea_sixsix.send_pending_alerts(page_size=2)
+
+    calls = [call[1]['body'] for call in ea_sixsix.writeback_es.search.call_args_list]
+    assert 'search_after' not in calls[0]
+    assert calls[0]['sort'][-1] == {'writeback_id': {'order': 'asc', 'unmapped_type': 'keyword'}}
+    assert calls[1]['query']['bool']['filter']['terms']['aggregate_id'] == ['a', 'b']
+    # Matches which share the @timestamp of the last one of a page are on the next page
+    assert calls[1]['sort'] == [{'@timestamp': 'asc'}, {'writeback_id': {'order': 'asc', 'unmapped_type': 'keyword'}}]
+    assert calls[2]['search_after'] == ['a2']
+    assert calls[3]['search_after'] == ['b']
+    assert calls[4]['query']['bool']['filter']['terms']['aggregate_id'] == ['c']
+
+    alerts = [call[0][0] for call in ea_sixsix.rules[0]['alert'][0].alert.call_args_list]
+    assert alerts == [[{'n': 'a'}, {'n': 'a1'}, {'n': 'a2'}], [{'n': 'b'}, {'n': 'b1'}], [{'n': 'c'}]]
+    deletes = [call[1]['body'] for call in ea_sixsix.writeback_es.bulk.call_args_list]
+    assert deletes == [[{'delete': {'_index': 'wb', '_id': _id}} for _id in ['a', 'a1', 'a2', 'b', 'b1']],
+                       [{'delete': {'_index': 'wb', '_id': 'c'}}]]
+
+
+def test_send_pending_alerts_in_memory(ea):
+    ea.rules[0]['aggregation_key'] = 'key'
+    ea.rules[0]['aggregate_alert_time'] = {'a': START, 'b': END}
+    ea.rules[0]['agg_matches'].add('a', {'key': 'a', 'n': 1}, START)
+    ea.rules[0]['agg_matches'].add('b', {'key': 'b', 'n': 2}, END)
+    ea.rules[0]['agg_matches'].add('a', {'key': 'a', 'n': 3}, START)
+    with mock.patch('elastalert.elastalert.ts_now', return_value=START + datetime.timedelta(hours=1)):
+        ea.send_pending_alerts()
+
+    assert ea.rules[0]['alert'][0].alert.call_count == 1
+    assert ea.rules[0]['alert'][0].alert.call_args[0][0] == [{'key': 'a', 'n': 1}, {'key': 'a', 'n': 3}]
+    assert list(ea.rules[0]['agg_matches']) == [{'key': 'b', 'n': 2}]
+
+
 def test_agg_with_aggregation_key(ea):
     ea.max_aggregation = 1337
     hits_timestamps = ['2014-09-26T12:34:45', '2014-09-26T12:40:45', '2014-09-26T12:43:45']
@@ -575,29 +1039,29 @@ def test_agg_with_aggregation_key(ea):
     assert call3['alert_time'] == dt_to_ts(match_time + datetime.timedelta(minutes=10))
 
     # First call - Find all pending alerts (only entries without agg_id)
-    # Second call - Find matches with agg_id == 'ABCD'
-    # Third call - Find matches with agg_id == 'CDEF'
+    # Second call - Find matches with agg_id == 'ABCD' or 'CDEF'
     ea.writeback_es.deprecated_search.side_effect = [{'hits': {'hits': [{'_id': 'ABCD', '_index': 'wb', '_source': call1},
                                                                         {'_id': 'CDEF', '_index': 'wb', '_source': call2}]}},
-                                                     {'hits': {'hits': [{'_id': 'BCDE', '_index': 'wb', '_source': call3}]}},
-                                                     {'hits': {'total': 0, 'hits': []}}]
+                                                     {'hits': {'hits': [{'_id': 'BCDE', '_index': 'wb', '_source': call3}]}}]
 
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         mock_es.return_value = ea.thread_data.current_es
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was taken from the shared clients instead of creating new ones
+        assert mock_es.call_count == 0
     assert_alerts(ea, [[hits_timestamps[0], hits_timestamps[2]], [hits_timestamps[1]]])
 
     call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
     call2 = ea.writeback_es.deprecated_search.call_args_list[8][1]['body']
     call3 = ea.writeback_es.deprecated_search.call_args_list[9][1]['body']
-    call4 = ea.writeback_es.deprecated_search.call_args_list[10][1]['body']
 
     assert 'alert_time' in call2['filter']['range']
-    assert call3['query']['query_string']['query'] == 'aggregate_id:"ABCD"'
-    assert call4['query']['query_string']['query'] == 'aggregate_id:"CDEF"'
+    assert call3['query']['bool']['filter']['terms']['aggregate_id'] == ['ABCD', 'CDEF']
+    assert len(ea.writeback_es.deprecated_search.call_args_list) == 10
+
+    # The alerts and their aggregated matches are deleted together
+    assert ea.writeback_es.bulk.call_args[1]['body'] == [{'delete': {'_index': 'wb', '_id': _id, '_type': 'elastalert'}}
+                                                         for _id in ['ABCD', 'BCDE', 'CDEF']]
     assert ea.writeback_es.deprecated_search.call_args_list[9][1]['size'] == 1337
 
 
@@ -625,6 +1089,90 @@ def test_silence(ea):
     assert ea.rules[0]['alert'][0].alert.call_count == 1
 
 
+def test_refresh_silences(ea_sixsix):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    now = ts_now()
+    ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': [
+        {'_source': {'rule_name': 'anytest.qlo', 'until': dt_to_ts(now + datetime.timedelta(hours=1)), 'exponent': 2,
+                     '@timestamp': dt_to_ts(now - datetime.timedelta(minutes=5))}},
+        {'_source': {'rule_name': 'anytest._silence', 'until': dt_to_ts(now + datetime.timedelta(hours=4)),
+                     '@timestamp': dt_to_ts(now - datetime.timedelta(minutes=1))}}]}}
+    ea_sixsix.refresh_silences()
+    query = ea_sixsix.writeback_es.search.call_args[1]['body']
+    assert list(query['query']['bool']['filter']['range']) == ['until']
+    assert ea_sixsix.silence_cache['anytest.qlo'][1] == 2
+    assert ea_sixsix.silence_cache['anytest._silence'][1] == 0
+    assert ea_sixsix.silences_refreshed_at == dt_to_ts(now - datetime.timedelta(minutes=1))
+
+    # Answered from memory
+    ea_sixsix.writeback_es.search.reset_mock()
+    assert ea_sixsix.is_silenced('anytest.qlo')
+    assert not ea_sixsix.is_silenced('anytest.dpopes')
+    assert not ea_sixsix.writeback_es.search.called
+
+    # Later refreshes only load new silences, and expired ones are evicted
+    ea_sixsix.silence_cache['anytest.old'] = (now - datetime.timedelta(days=1), 0)
+    ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': []}}
+    ea_sixsix.refresh_silences()
+    query = ea_sixsix.writeback_es.search.call_args[1]['body']
+    assert query['query']['bool']['filter'] == {'range': {'@timestamp': {'gte': ea_sixsix.silences_refreshed_at}}}
+    assert sorted(ea_sixsix.silence_cache) == ['anytest._silence', 'anytest.qlo']
+
+
+def test_refresh_silences_paging(ea_sixsix):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    now = ts_now()
+    # More silences than fit in a page share the same @timestamp
+    timestamp = dt_to_ts(now - datetime.timedelta(minutes=8))
+    silences = [{'_source': {'rule_name': 'anytest.%s' % (i), 'until': dt_to_ts(now + datetime.timedelta(hours=1)),
+                             '@timestamp': timestamp}, 'sort': [timestamp, 'id%s' % (i)]} for i in range(3)]
+    ea_sixsix.writeback_es.search.side_effect = [{'hits': {'hits': silences[:2]}}, {'hits': {'hits': silences[2:]}}]
+    ea_sixsix.refresh_silences(page_size=2)
+    queries = [call[1]['body'] for call in ea_sixsix.writeback_es.search.call_args_list]
+    assert len(queries) == 2
+    assert queries[0]['sort'] == [{'@timestamp': {'order': 'asc'}}, {'writeback_id': {'order': 'asc', 'unmapped_type': 'keyword'}}]
+    assert queries[1]['search_after'] == [timestamp, 'id1']
+    assert sorted(ea_sixsix.silence_cache) == ['anytest.0', 'anytest.1', 'anytest.2']
+    assert ea_sixsix.silences_refreshed_at == timestamp
+
+
+def test_refresh_silences_latest_exponent(ea_sixsix):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    now = ts_now()
+    silences = [(1, 1, 10), (4, 3, 8), (2, 2, 6)]
+    ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': [
+        {'_source': {'rule_name': 'anytest.qlo', 'until': dt_to_ts(now + datetime.timedelta(hours=hours)), 'exponent': exponent,
+                     '@timestamp': dt_to_ts(now - datetime.timedelta(minutes=minutes))}} for hours, exponent, minutes in silences]}}
+    ea_sixsix.refresh_silences()
+    # The exponent is the one of the silence with the latest until, not of the oldest silence
+    until, exponent = ea_sixsix.silence_cache['anytest.qlo']
+    assert until == ts_to_dt(dt_to_ts(now + datetime.timedelta(hours=4)))
+    assert exponent == 3
+
+
+@pytest.mark.parametrize('refreshed', [False, True])
+def test_refresh_silences_error(ea_sixsix, refreshed):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    if refreshed:
+        ea_sixsix.refresh_silences()
+        assert ea_sixsix.silences_refreshed_at is not None
+    ea_sixsix.writeback_es.search.side_effect = ElasticsearchException('Nope')
+    ea_sixsix.refresh_silences()
+    assert ea_sixsix.silences_refreshed_at is None
+
+    # Falls back to searching for each silence, even after a refresh succeeded
+    ea_sixsix.writeback_es.search.reset_mock()
+    ea_sixsix.writeback_es.search.side_effect = None
+    ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': []}}
+    assert not ea_sixsix.is_silenced('anytest.qlo')
+    assert ea_sixsix.writeback_es.search.called
+
+    # The next refresh loads every silence again
+    ea_sixsix.refresh_silences()
+    query = ea_sixsix.writeback_es.search.call_args[1]['body']
+    assert list(query['query']['bool']['filter']['range']) == ['until']
+
+
 def test_compound_query_key(ea):
     ea.rules[0]['query_key'] = 'this,that,those'
     ea.rules[0]['compound_query_key'] = ['this', 'that', 'those']
@@ -736,6 +1284,134 @@ def test_realert_with_query_key(ea):
     assert ea.rules[0]['alert'][0].alert.call_count == 4
 
 
+def test_realert_silences_written_together(ea):
+    ea.rules[0]['query_key'] = 'username'
+    ea.rules[0]['realert'] = datetime.timedelta(minutes=10)
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': False, 'items': [{'index': {'status': 201}}] * 3})
+    ea.rules[0]['type'].matches = [{'@timestamp': '2014-11-17T00:00:00', 'username': name} for name in ['qlo', 'dpopes', 'qlo', 'mrk']]
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.run_rule(ea.rules[0], END, START)
+    assert ea.rules[0]['alert'][0].alert.call_count == 3
+
+    assert ea.writeback_es.bulk.call_count == 1
+    body = ea.writeback_es.bulk.call_args[1]['body']
+    assert body[::2] == [{'index': {'_index': 'wb', '_type': 'silence'}}] * 3
+    assert [doc['rule_name'] for doc in body[1::2]] == ['anytest.qlo', 'anytest.dpopes', 'anytest.mrk']
+    assert all(isinstance(doc['until'], str) for doc in body[1::2])
+    assert not [call for call in ea.writeback_es.index.call_args_list if call[1]['doc_type'] == 'silence']
+
+
+def test_writeback_bulk_spools_errors(ea, tmpdir):
+    ea.writeback_spool = WritebackSpool(str(tmpdir))
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': True, 'items': [
+        {'index': {'status': 201}},
+        {'index': {'status': 503, 'error': {'type': 'unavailable_shards_exception'}}}]})
+    ea.writeback_bulk('silence', [{'rule_name': 'a'}, {'rule_name': 'b'}])
+    sent = []
+    ea.writeback_spool.replay(sent.extend)
+    assert [document[3]['rule_name'] for document in sent] == ['b']
+
+    ea.writeback_es.bulk.side_effect = ElasticsearchException('Nope')
+    ea.writeback_bulk('silence', [{'rule_name': 'c'}, {'rule_name': 'd'}])
+    sent = []
+    ea.writeback_spool.replay(sent.extend)
+    assert [document[3]['rule_name'] for document in sent] == ['c', 'd']
+
+
+def test_compact_silences(ea_sixsix):
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    ea_sixsix.writeback_es.search.return_value = {'aggregations': {'rule_names': {'buckets': [
+        {'key': 'anytest.qlo', 'doc_count': 3, 'until': {'value': 1416182400000.0}}]}}}
+    ea_sixsix.writeback_es.delete_by_query = mock.Mock(return_value={'deleted': 2})
+    ea_sixsix.compact_silences()
+
+    assert ea_sixsix.writeback_es.search.call_args[1]['index'] == 'wb_silence'
+    assert ea_sixsix.writeback_es.delete_by_query.call_args[1]['body'] == {'query': {'bool': {'should': [
+        {'bool': {'filter': [{'term': {'rule_name': 'anytest.qlo'}},
+                             {'range': {'until': {'lt': 1416182400000, 'format': 'epoch_millis'}}}]}}]}}}
+
+    # Nothing superseded
+    ea_sixsix.writeback_es.search.return_value = {'aggregations': {'rule_names': {'buckets': []}}}
+    ea_sixsix.compact_silences()
+    assert ea_sixsix.writeback_es.delete_by_query.call_count == 1
+
+
+def test_cluster_heartbeat(ea_sixsix):
+    ea_sixsix.instance_id = 'a'
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': [{'_source': {'instance_id': 'b'}}]}}
+    ea_sixsix.cluster_heartbeat()
+
+    index_args = ea_sixsix.writeback_es.index.call_args[1]
+    assert index_args['id'] == '_elastalert_instance.a'
+    assert index_args['body']['instance_id'] == 'a'
+    assert ea_sixsix.cluster_members == ['a', 'b']
+    assert ea_sixsix.owns_rule(ea_sixsix.rules[0]) == (HashRing(['a', 'b']).owner('anytest') == 'a')
+    assert ea_sixsix.is_cluster_leader()
+
+    # Members are kept when the writeback index cannot be searched
+    ea_sixsix.writeback_es.search.side_effect = ElasticsearchException('Nope')
+    ea_sixsix.cluster_heartbeat()
+    assert ea_sixsix.cluster_members == ['a', 'b']
+
+    ea_sixsix.writeback_es.delete = mock.Mock()
+    ea_sixsix.leave_cluster()
+    assert ea_sixsix.writeback_es.delete.call_args[1]['id'] == '_elastalert_instance.a'
+    assert ea_sixsix.owns_rule(ea_sixsix.rules[0])
+
+
+def test_cluster_rebalance(ea):
+    rule = ea.rules[0]
+    # Pick instance ids such that the rule moves from a to b when b joins
+    ea.instance_id = 'a'
+    other = next(name for name in ('b%s' % (i) for i in range(100)) if HashRing(['a', name]).owner('anytest') == name)
+    ea.set_cluster_members(['a'])
+    assert ea.owns_rule(rule)
+    assert ea.is_cluster_leader()
+    rule['starttime'] = START
+    rule['previous_endtime'] = END
+
+    ea.rules[0]['agg_matches'].add(None, {'@timestamp': END}, END)
+    with mock.patch.object(ea, 'add_aggregated_alert') as mock_add:
+        ea.set_cluster_members(['a', other])
+    assert not ea.owns_rule(rule)
+    mock_add.assert_called_with({'@timestamp': END}, rule)
+
+    # The rule is not run and its pending alerts are left to its owner
+    with mock.patch.object(ea, 'run_rule') as mock_run:
+        ea.handle_rule_execution(rule)
+    assert not mock_run.called
+    pending = [{'_id': 'ABCD', '_source': {'rule_name': 'anytest', 'alert_time': START_TIMESTAMP, 'match_body': {}}}]
+    with mock.patch.object(ea, 'alert') as mock_alert:
+        ea.send_pending_alert_page(pending)
+    assert not mock_alert.called
+
+    # Taking the rule back starts it from its last run in elastalert_status
+    ea.set_cluster_members(['a'])
+    assert ea.owns_rule(rule)
+    assert 'starttime' not in rule
+    assert 'previous_endtime' not in rule
+
+    ea.instance_id = other
+    ea.set_cluster_members(['a', other])
+    assert not ea.is_cluster_leader()
+
+
+def test_cluster_rebalance_rule_workers(ea):
+    rule = ea.rules[0]
+    ea.rule_workers = mock.Mock()
+    ea.instance_id = 'a'
+    other = next(name for name in ('b%s' % (i) for i in range(100)) if HashRing(['a', name]).owner('anytest') == name)
+    ea.set_cluster_members(['a', other])
+    assert not ea.owns_rule(rule)
+    assert not ea.rule_workers.reset.called
+
+    # The worker running the rule also forgets where its last run here ended
+    ea.set_cluster_members(['a'])
+    assert ea.owns_rule(rule)
+    ea.rule_workers.reset.assert_called_once_with('anytest')
+
+
 def test_realert_with_nested_query_key(ea):
     ea.rules[0]['query_key'] = 'user.name'
     ea.rules[0]['realert'] = datetime.timedelta(minutes=10)
@@ -840,6 +1516,112 @@ def test_query_segmenting(ea):
         run_and_assert_segmented_queries(ea, START, END, ea.run_every)
 
 
+def test_adaptive_query_segmenting(ea):
+    rule = ea.rules[0]
+    rule['segment_target_hits'] = 100
+    rule['starttime'] = START
+    hour = datetime.timedelta(hours=1)
+    buckets = [(START, 60), (START + hour, 60), (START + 2 * hour, 0), (START + 3 * hour, 500), (START + 4 * hour, 10)]
+    finer = [(START + 3 * hour + i * datetime.timedelta(minutes=10), 100) for i in range(6)]
+    with mock.patch.object(ea, 'probe_hit_density') as mock_probe:
+        mock_probe.side_effect = [(buckets, hour), (finer, datetime.timedelta(minutes=10))]
+        segments, endtime = ea.get_query_segments(rule, END)
+
+    # The bucket of 500 hits is probed again, and the quiet hours become one segment
+    assert mock_probe.call_args_list[1][0][1:3] == (START + 3 * hour, START + 4 * hour)
+    cuts = [START + hour] + [START + 3 * hour + i * datetime.timedelta(minutes=10) for i in range(7)]
+    assert segments == list(zip([START] + cuts, cuts + [END], [False] * len(cuts) + [True]))
+    assert endtime == END
+
+    # Fixed size segments if the probe failed
+    with mock.patch.object(ea, 'probe_hit_density', return_value=None):
+        segments, endtime = ea.get_query_segments(rule, END)
+    assert segments[1][0] - segments[0][0] == rule.get('buffer_time', ea.buffer_time)
+
+    # Flatline rules check for missing data at the end of every fixed size segment
+    rule_type = rule['type']
+    rule['type'] = FlatlineRule({'timeframe': datetime.timedelta(hours=1), 'threshold': 1, 'timestamp_field': '@timestamp'})
+    with mock.patch.object(ea, 'probe_hit_density') as mock_probe:
+        segments, endtime = ea.get_query_segments(rule, END)
+    assert not mock_probe.called
+    assert segments[1][0] - segments[0][0] == rule.get('buffer_time', ea.buffer_time)
+    rule['type'] = rule_type
+
+    # Count queries keep their fixed size segments
+    rule['use_count_query'] = True
+    with mock.patch.object(ea, 'probe_hit_density') as mock_probe:
+        ea.get_query_segments(rule, END)
+    assert not mock_probe.called
+
+
+def test_probe_hit_density(ea):
+    rule = ea.rules[0]
+    rule['five'] = True
+    client = ea.thread_data.current_es
+    key = dt_to_unixms(START)
+    client.search.return_value = {'aggregations': {'hit_density': {'buckets': [{'key': key, 'doc_count': 3}]}}}
+    buckets, width = ea.probe_hit_density(rule, START, END, client)
+    assert buckets == [(START, 3)]
+    assert width == datetime.timedelta(seconds=87)
+    body = client.search.call_args[1]['body']
+    assert body['aggs'] == {'hit_density': {'date_histogram': {'field': '@timestamp', 'interval': '87s'}}}
+    assert 'sort' not in body
+    assert client.search.call_args[1]['size'] == 0
+
+    rule['timestamp_type'] = 'unix'
+    client.search.return_value = {'aggregations': {'hit_density': {'buckets': [{'key': key / 1000, 'doc_count': 3}]}}}
+    assert ea.probe_hit_density(rule, START, END, client)[0] == [(START, 3)]
+    assert client.search.call_args[1]['body']['aggs']['hit_density'] == {'histogram': {'field': '@timestamp', 'interval': 87}}
+
+    client.search.side_effect = ElasticsearchException('error')
+    assert ea.probe_hit_density(rule, START, END, client) is None
+
+
+@pytest.mark.parametrize('stateless, prefetch', [(True, 0), (False, 3), (False, 1)])
+def test_find_matches_concurrently(ea, stateless, prefetch):
+    rule = ea.rules[0]
+    if stateless:
+        rule['segment_concurrency'] = 3
+        rule['type'].stateless = True
+    else:
+        # Any rule type can be backfilled with prefetching, as segments are still passed in order
+        ea.backfill_prefetch_segments = prefetch
+    segment_starts = [START + i * datetime.timedelta(hours=4) for i in range(6)]
+
+    def search(**kwargs):
+        starttime = kwargs['body']['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['gt']
+        hits = generate_hits([starttime, starttime])
+        # Both hits are the same event
+        for hit in hits['hits']['hits']:
+            hit['_id'] = starttime
+        return hits
+
+    def get_query_segments(rule, endtime):
+        ends = segment_starts[1:] + [endtime]
+        return list(zip(segment_starts, ends, [False] * 5 + [True])), endtime
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client') as es_client_factory:
+        client = es_client_factory.return_value
+        client.is_atleastseven.return_value = False
+        client.is_atleastseventwelve.return_value = False
+        client.search.side_effect = search
+        with mock.patch.object(ea, 'get_query_segments', side_effect=get_query_segments):
+            with mock.patch('elastalert.elastalert.elastalert_logger') as mock_logger, \
+                    mock.patch.object(ea, 'find_matches_concurrently', wraps=ea.find_matches_concurrently) as concurrently:
+                assert ea.find_matches(rule, END, START) == END
+    assert concurrently.call_count == 1
+
+    # The hits are passed in the order of the segments, each new event once
+    added = [call_args[0][0] for call_args in rule['type'].add_data.call_args_list]
+    assert [[event['@timestamp'] for event in data] for data in added] == [[start] for start in segment_starts]
+    assert ea.thread_data.cumulative_hits == 12
+    assert ea.thread_data.num_dupes == 6
+    assert client.search.call_count == 6
+    assert rule['starttime'] == segment_starts[-1]
+    progress = mock_logger.info.call_args_list[-1][0][0]
+    assert progress.startswith('Backfilled anytest up to %s: 6/6 segments, 12 hits' % (pretty_ts(END, True)))
+
+
 def test_get_starttime(ea):
     endtime = '2015-01-01T00:00:00Z'
     mock_es = mock.Mock()
@@ -996,9 +1778,9 @@ def test_rule_changes(ea):
                       'rules/rule2.yaml': 'DEF'}
     run_every = datetime.timedelta(seconds=1)
     ea.rules = [ea.init_rule(rule, True) for rule in [{'rule_file': 'rules/rule1.yaml', 'name': 'rule1', 'filter': [],
-                                                       'run_every': run_every},
+                                                       'run_every': run_every, 'es_host': 'es', 'es_port': 14900},
                                                       {'rule_file': 'rules/rule2.yaml', 'name': 'rule2', 'filter': [],
-                                                       'run_every': run_every}]]
+                                                       'run_every': run_every, 'es_host': 'es', 'es_port': 14900}]]
     ea.rules[1]['processed_hits'] = ['save me']
     new_hashes = {'rules/rule1.yaml': 'ABC',
                   'rules/rule3.yaml': 'XXX',
@@ -1006,8 +1788,10 @@ def test_rule_changes(ea):
 
     with mock.patch.object(ea.conf['rules_loader'], 'get_hashes') as mock_hashes:
         with mock.patch.object(ea.conf['rules_loader'], 'load_configuration') as mock_load:
-            mock_load.side_effect = [{'filter': [], 'name': 'rule2', 'rule_file': 'rules/rule2.yaml', 'run_every': run_every},
-                                     {'filter': [], 'name': 'rule3', 'rule_file': 'rules/rule3.yaml', 'run_every': run_every}]
+            mock_load.side_effect = [{'filter': [], 'name': 'rule2', 'rule_file': 'rules/rule2.yaml', 'run_every': run_every,
+                                      'es_host': 'es', 'es_port': 14900},
+                                     {'filter': [], 'name': 'rule3', 'rule_file': 'rules/rule3.yaml', 'run_every': run_every,
+                                      'es_host': 'es', 'es_port': 14900}]
             mock_hashes.return_value = new_hashes
             ea.load_rule_changes()
 
@@ -1029,7 +1813,7 @@ def test_rule_changes(ea):
         with mock.patch.object(ea.conf['rules_loader'], 'load_configuration') as mock_load:
             with mock.patch.object(ea, 'send_notification_email') as mock_send:
                 mock_load.return_value = {'filter': [], 'name': 'rule3', 'new': 'stuff',
-                                          'rule_file': 'rules/rule4.yaml', 'run_every': run_every}
+                                          'rule_file': 'rules/rule4.yaml', 'run_every': run_every, 'es_host': 'es', 'es_port': 14900}
                 mock_hashes.return_value = new_hashes
                 ea.load_rule_changes()
                 mock_send.assert_called_once_with(exception=mock.ANY, rule_file='rules/rule4.yaml')
@@ -1042,7 +1826,7 @@ def test_rule_changes(ea):
     with mock.patch.object(ea.conf['rules_loader'], 'get_hashes') as mock_hashes:
         with mock.patch.object(ea.conf['rules_loader'], 'load_configuration') as mock_load:
             mock_load.return_value = {'filter': [], 'name': 'rule4', 'new': 'stuff', 'is_enabled': False,
-                                      'rule_file': 'rules/rule4.yaml', 'run_every': run_every}
+                                      'rule_file': 'rules/rule4.yaml', 'run_every': run_every, 'es_host': 'es', 'es_port': 14900}
             mock_hashes.return_value = new_hashes
             ea.load_rule_changes()
     assert len(ea.rules) == 3
@@ -1054,7 +1838,7 @@ def test_rule_changes(ea):
     with mock.patch.object(ea.conf['rules_loader'], 'get_hashes') as mock_hashes:
         with mock.patch.object(ea.conf['rules_loader'], 'load_configuration') as mock_load:
             mock_load.return_value = {'filter': [], 'name': 'rule4', 'new': 'stuff', 'rule_file': 'rules/rule4.yaml',
-                                      'run_every': run_every}
+                                      'run_every': run_every, 'es_host': 'es', 'es_port': 14900}
             mock_hashes.return_value = new_hashes
             ea.load_rule_changes()
     assert len(ea.rules) == 4
@@ -1064,7 +1848,7 @@ def test_rule_changes(ea):
     with mock.patch.object(ea.conf['rules_loader'], 'get_hashes') as mock_hashes:
         with mock.patch.object(ea.conf['rules_loader'], 'load_configuration') as mock_load:
             mock_load.return_value = {'filter': [], 'name': 'rule4', 'new': 'stuff', 'rule_file': 'rules/rule4.yaml',
-                                      'run_every': run_every}
+                                      'run_every': run_every, 'es_host': 'es', 'es_port': 14900}
             mock_hashes.return_value = new_hashes
             ea.load_rule_changes()
     ea.scheduler.remove_job.assert_called_with(job_id='rule4')
@@ -1242,6 +2026,70 @@ def test_stop(ea):
             assert mock_run.call_count == 4
 
 
+def test_writeback_queue(ea):
+    ea.conf['writeback_bulk_size'] = 100
+    with mock.patch('elastalert.elastalert.WritebackQueue') as mock_queue:
+        with mock.patch.object(ea, 'sleep_for') as mock_sleep:
+            mock_sleep.side_effect = lambda duration: ea.stop()
+            ea.start()
+    mock_queue.assert_called_with(ea.writeback_es, 100, 1.0, None)
+    assert mock_queue.return_value.close.called
+    assert ea.writeback_queue is None
+
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': False, 'items': [{'index': {'status': 201}}]})
+    ea.writeback_queue = WritebackQueue(ea.writeback_es, 100, 60)
+    res = ea.writeback('elastalert', {'rule_name': 'test_rule'})
+    assert not ea.writeback_es.index.called
+    assert not ea.writeback_es.bulk.called
+
+    # Queued documents are written before the writeback index is searched
+    ea.writeback_es.search.return_value = {'hits': {'hits': []}}
+    ea.find_recent_pending_alerts(datetime.timedelta(minutes=10))
+    body = ea.writeback_es.bulk.call_args[1]['body']
+    assert body[0] == {'index': {'_index': 'wb', '_id': res['_id'], '_type': 'elastalert'}}
+    assert body[1]['rule_name'] == 'test_rule'
+
+    ea.writeback('elastalert_status', {'rule_name': 'test_rule'})
+    ea.stop()
+    assert ea.writeback_es.bulk.call_count == 2
+    assert ea.writeback_queue is None
+
+
+def test_writeback_spool(ea, tmpdir):
+    ea.writeback_spool = WritebackSpool(str(tmpdir))
+    ea.writeback_es.index.side_effect = ElasticsearchException('Nope')
+    res = ea.writeback('silence', {'rule_name': 'test_rule', 'until': END})
+    assert res['result'] == 'spooled'
+    assert ea.writeback_spool
+
+    # Still unavailable
+    ea.writeback_es.bulk = mock.Mock(side_effect=ElasticsearchException('Nope'))
+    ea.replay_writeback_spool()
+    assert ea.writeback_spool
+
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': False, 'items': [{'index': {'status': 201}}]})
+    ea.replay_writeback_spool()
+    assert not ea.writeback_spool
+    body = ea.writeback_es.bulk.call_args[1]['body']
+    assert body == [{'index': {'_index': 'wb', '_id': res['_id'], '_type': 'silence'}},
+                    {'rule_name': 'test_rule', 'until': END_TIMESTAMP, '@timestamp': body[1]['@timestamp'],
+                     'writeback_id': body[1]['writeback_id']}]
+
+
+def test_writeback_spool_retryable_errors(ea, tmpdir):
+    ea.writeback_spool = WritebackSpool(str(tmpdir))
+    ea.writeback_spool.append([('wb', None, 'id1', {'n': 1}), ('wb', None, 'id2', {'n': 2})])
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': True, 'items': [
+        {'index': {'_id': 'id1', 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}},
+        {'index': {'_id': 'id2', 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}}]})
+    ea.replay_writeback_spool()
+    assert ea.writeback_spool
+
+    ea.writeback_es.bulk = mock.Mock(return_value={'errors': False, 'items': [{'index': {'status': 201}}] * 2})
+    ea.replay_writeback_spool()
+    assert not ea.writeback_spool
+
+
 def test_notify_email(ea):
     mock_smtp = mock.Mock()
     ea.rules[0]['notify_email'] = ['foo@foo.foo', 'bar@bar.bar']
@@ -1317,9 +2165,9 @@ def test_get_top_counts_handles_no_hits_returned(ea):
 def test_remove_old_events(ea):
     now = ts_now()
     minute = datetime.timedelta(minutes=1)
-    ea.rules[0]['processed_hits'] = {'foo': now - minute,
-                                     'bar': now - minute * 5,
-                                     'baz': now - minute * 15}
+    ea.rules[0]['processed_hits'] = ProcessedHits()
+    for _id, timestamp in [('foo', now - minute), ('bar', now - minute * 5), ('baz', now - minute * 15)]:
+        ea.rules[0]['processed_hits'][_id] = timestamp
     ea.rules[0]['buffer_time'] = datetime.timedelta(minutes=10)
 
     # With a query delay, only events older than 20 minutes will be removed (none)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from elastalert.cluster import HashRing
+
+
+def test_hash_ring_owner():
+    ring = HashRing(['b', 'a', 'a'])
+    assert ring.members == ['a', 'b']
+    assert ring.owner('rule') == HashRing(['a', 'b']).owner('rule')
+    owners = [ring.owner('rule %s' % (i)) for i in range(1000)]
+    # Both members get a fair share
+    assert 300 < owners.count('a') < 700
+
+    assert HashRing([]).owner('rule') is None
+
+
+def test_hash_ring_rebalance():
+    rules = ['rule %s' % (i) for i in range(1000)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [rule for rule in rules if before.owner(rule) != after.owner(rule)]
+    # Only the rules taken by the new member move
+    assert all(after.owner(rule) == 'd' for rule in moved)
+    assert 100 < len(moved) < 400
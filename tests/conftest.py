@@ -52,6 +52,12 @@ def reset_loggers():
         logger.removeHandler(handler)
 
 
+@pytest.fixture(scope='function', autouse=True)
+def reset_es_client_pool():
+    """Don't let clients created (and mocked) by one test be shared with the next one."""
+    elastalert.util.es_client_pool.clear()
+
+
 class mock_es_indices_client(object):
     def __init__(self):
         self.exists = mock.Mock(return_value=True)
@@ -67,6 +73,7 @@ class mock_es_client(object):
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'errors': False, 'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '2.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -76,6 +83,7 @@ class mock_es_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=False)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
         self.resolve_writeback_index = mock.Mock(return_value=writeback_index)
 
 
@@ -89,6 +97,7 @@ class mock_es_sixsix_client(object):
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'errors': False, 'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '6.6.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -98,6 +107,7 @@ class mock_es_sixsix_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=True)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
 
         def writeback_index_side_effect(index, doc_type):
             if doc_type == 'silence':
@@ -119,6 +129,7 @@ class mock_rule_loader(object):
         self.load = mock.Mock()
         self.get_hashes = mock.Mock()
         self.load_configuration = mock.Mock()
+        self.is_included = mock.Mock(return_value=True)
 
 
 class mock_ruletype(object):
@@ -180,6 +191,8 @@ def ea():
             conf['rules_loader'].load.return_value = rules
             conf['rules_loader'].get_hashes.return_value = {}
             ea = elastalert.elastalert.ElastAlerter(['--pin_rules'])
+    # Let each test decide which client its rules get
+    ea.es_clients.clear()
     ea.rules[0]['type'] = mock_ruletype()
     ea.rules[0]['alert'] = [mock_alert()]
     ea.writeback_es = mock_es_client()
@@ -233,6 +246,8 @@ def ea_sixsix():
             conf['rules_loader'].load.return_value = rules
             conf['rules_loader'].get_hashes.return_value = {}
             ea_sixsix = elastalert.elastalert.ElastAlerter(['--pin_rules'])
+    # Let each test decide which client its rules get
+    ea_sixsix.es_clients.clear()
     ea_sixsix.rules[0]['type'] = mock_ruletype()
     ea_sixsix.rules[0]['alert'] = [mock_alert()]
     ea_sixsix.writeback_es = mock_es_sixsix_client()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import copy
+import datetime
+import pickle
+
+import mock
+import pytest
+
+from elastalert.dedup import BloomFilter
+from elastalert.dedup import ProbabilisticProcessedHits
+from elastalert.dedup import ProcessedHits
+from elastalert.util import ts_to_dt
+
+START = ts_to_dt('2014-09-26T12:00:00Z')
+SECOND = datetime.timedelta(seconds=1)
+
+
+def test_processed_hits_remove_older_than():
+    hits = ProcessedHits()
+    # Ids are not necessarily added in time order
+    for i in [50, 5, 30, 0, 12, 11]:
+        hits['id%s' % (i)] = START + SECOND * i
+    assert hits == {'id%s' % (i): START + SECOND * i for i in [50, 5, 30, 0, 12, 11]}
+
+    hits.remove_older_than(START + SECOND * 12)
+    assert sorted(hits) == ['id12', 'id30', 'id50']
+
+    hits.remove_older_than(START + SECOND * 12)
+    assert sorted(hits) == ['id12', 'id30', 'id50']
+
+    hits.remove_older_than(START + SECOND * 51)
+    assert hits == {}
+    assert hits._buckets == {}
+    assert hits._bucket_heap == []
+
+
+def test_processed_hits_only_visits_old_buckets():
+    hits = ProcessedHits()
+    for i in range(100):
+        hits['id%s' % (i)] = START + SECOND * i
+    with mock.patch.object(hits, '_filed_under', wraps=hits._filed_under) as mock_filed_under:
+        hits.remove_older_than(START + SECOND * 25)
+    # Ids of buckets [0, 10) and [10, 20) are dropped, the bucket [20, 30) is checked one by one
+    assert mock_filed_under.call_count == 30
+    assert len(hits) == 75
+
+
+def test_processed_hits_removed_and_reset_ids():
+    hits = ProcessedHits()
+    hits['foo'] = START
+    hits['bar'] = START
+    hits.pop('foo')
+    hits['bar'] = START + SECOND * 100
+    hits.remove_older_than(START + SECOND * 50)
+    assert hits == {'bar': START + SECOND * 100}
+
+
+def test_processed_hits_max_size():
+    hits = ProcessedHits(max_size=3)
+    for i in range(5):
+        hits['id%s' % (i)] = START + SECOND * i * 10
+    assert sorted(hits) == ['id2', 'id3', 'id4']
+    assert hits.evicted == 2
+
+
+def test_processed_hits_compact():
+    hits = ProcessedHits(compact=True)
+    hits['AXabc123'] = START
+    assert 'AXabc123' in hits
+    assert 'AXabc124' not in hits
+    assert hits['AXabc123'] == START
+    assert hits.get('AXabc124') is None
+    key, = list(hits.keys())
+    assert isinstance(key, int) and key < 2 ** 64
+    hits.remove_older_than(START + SECOND)
+    assert 'AXabc123' not in hits
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_processed_hits_copy(compact):
+    hits = ProcessedHits(max_size=3, compact=compact)
+    for i in range(4):
+        hits['id%s' % (i)] = START + SECOND * 10 * i
+
+    for restored in [pickle.loads(pickle.dumps(hits)), copy.deepcopy(hits), copy.copy(hits)]:
+        assert (restored.max_size, restored.compact, restored.evicted) == (3, compact, 1)
+        assert 'id0' not in restored
+        assert [restored.get('id%s' % (i)) for i in range(1, 4)] == [START + SECOND * 10 * i for i in range(1, 4)]
+
+        # The copy keeps its buckets apart from those of the original
+        restored.remove_older_than(START + SECOND * 30)
+        assert 'id2' not in restored
+        assert 'id3' in restored
+        assert 'id2' in hits
+
+        restored['id4'] = START + SECOND * 40
+        restored['id5'] = START + SECOND * 50
+        restored['id6'] = START + SECOND * 60
+        assert 'id3' not in restored
+        assert len(hits) == 3
+
+
+def test_probabilistic_processed_hits_copy():
+    hits = ProbabilisticProcessedHits(capacity=10, error_rate=0.01)
+    hits['id'] = START
+    restored = pickle.loads(pickle.dumps(hits))
+    assert 'id' in restored
+    assert len(restored) == 1
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom_filter = BloomFilter(1000, 0.01)
+    positions = [BloomFilter.positions('id%s' % (i), bloom_filter.num_bits, bloom_filter.num_hashes) for i in range(2000)]
+    for item in positions[:1000]:
+        bloom_filter.add(item)
+
+    assert all(item in bloom_filter for item in positions[:1000])
+    false_positives = sum(item in bloom_filter for item in positions[1000:])
+    assert false_positives < 50
+    assert 0.4 < bloom_filter.fill_ratio < 0.6
+
+
+def test_probabilistic_processed_hits():
+    hits = ProbabilisticProcessedHits(capacity=10, error_rate=0.01, slice_seconds=10)
+    for i in range(25):
+        hits['id%s' % (i)] = START + SECOND * i
+    assert all('id%s' % (i) in hits for i in range(25))
+    assert len(hits) == 25
+    # One filter for each 10 ids in a slice
+    assert [len(hits._slices[time_slice]) for time_slice in sorted(hits._slices)] == [1, 1, 1]
+    assert hits.fill_ratio > 0
+    assert 0 < hits.false_positive_rate < 0.1
+
+    # The slice of the cutoff is kept whole
+    hits.remove_older_than(START + SECOND * 15)
+    assert len(hits) == 15
+    assert 'id10' in hits
+
+    hits.remove_older_than(START + SECOND * 30)
+    assert len(hits) == 0
+    assert 'id24' not in hits
+    assert hits.fill_ratio == 0.0
+    assert hits.false_positive_rate == 0.0
+    assert hits.evicted == 0
+
+
+def test_probabilistic_processed_hits_grows_filters():
+    hits = ProbabilisticProcessedHits(capacity=100, error_rate=0.001, slice_seconds=60)
+    for i in range(1000):
+        hits['id%s' % (i)] = START
+    assert len(hits._slices[hits._slice(START)]) == 10
+    assert all(bloom_filter.count == 100 for bloom_filter in hits._filters())
+    assert sum('new%s' % (i) in hits for i in range(1000)) < 20
+    assert hits.memory_size() == 10 * len(next(hits._filters()).bits)
@@ -329,6 +329,28 @@ def test_load_disabled_rules():
                 assert len(rules['rules']) == 0
 
 
+def test_load_filtered_rules():
+    test_config_copy = copy.deepcopy(test_config)
+    with mock.patch('elastalert.config.read_yaml') as mock_conf_open:
+        mock_conf_open.return_value = test_config_copy
+        with mock.patch('elastalert.loaders.read_yaml') as mock_rule_open:
+            mock_rule_open.side_effect = lambda filename: copy.deepcopy(test_rule)
+
+            with mock.patch('os.walk') as mock_ls:
+                mock_ls.return_value = [('', [], ['testrule.yaml'])]
+                conf = load_conf(test_args)
+                rules_loader = conf['rules_loader']
+                rules_loader.rule_filter = lambda rule_name: rule_name != 'testrule'
+                assert rules_loader.load(conf) == []
+                # The rule type of a rule run elsewhere is not built
+                rule = rules_loader.load_configuration('testrule.yaml', conf)
+                assert not rules_loader.is_included(rule)
+                assert rule['type'] == 'spike'
+
+                rules_loader.rule_filter = lambda rule_name: rule_name == 'testrule'
+                assert isinstance(rules_loader.load(conf)[0]['type'], elastalert.ruletypes.RuleType)
+
+
 def test_raises_on_missing_config():
     optional_keys = ('aggregation', 'use_count_query', 'query_key', 'compare_key', 'filter', 'include', 'es_host', 'es_port', 'name')
     test_rule_copy = copy.deepcopy(test_rule)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+import pytest
+from elasticsearch.exceptions import ElasticsearchException
+
+from elastalert.msearch import MultiSearchCoalescer
+
+
+def run_searches(coalescer, client, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def search(i):
+        try:
+            results[i] = coalescer.search(client, 'index%s' % (i), {'query': {'term': {'n': i}}, 'size': 0})
+        except ElasticsearchException as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=search, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def msearch_echo(body):
+    return {'responses': [{'hits': {'total': body[i + 1]['query']['term']['n']}} for i in range(0, len(body), 2)]}
+
+
+def test_msearch_batches_concurrent_searches():
+    client = mock.Mock()
+    client.msearch.side_effect = msearch_echo
+    coalescer = MultiSearchCoalescer(window=5, max_batch_size=3)
+
+    results, errors = run_searches(coalescer, client, 3)
+
+    assert client.msearch.call_count == 1
+    assert [res['hits']['total'] for res in results] == [0, 1, 2]
+    assert errors == [None] * 3
+    body = client.msearch.call_args[1]['body']
+    assert sorted(header['index'] for header in body[::2]) == ['index0', 'index1', 'index2']
+    assert all(header['ignore_unavailable'] for header in body[::2])
+    assert coalescer.searches == 3
+    assert coalescer.batches == 1
+
+
+def test_msearch_max_batch_size():
+    client = mock.Mock()
+    client.msearch.side_effect = msearch_echo
+    coalescer = MultiSearchCoalescer(window=0.1, max_batch_size=2)
+
+    results, errors = run_searches(coalescer, client, 5)
+
+    assert [res['hits']['total'] for res in results] == list(range(5))
+    assert all(len(call[1]['body']) <= 4 for call in client.msearch.call_args_list)
+    assert coalescer.searches == 5
+    assert coalescer.batches >= 3
+
+
+def test_msearch_window_sends_partial_batch():
+    client = mock.Mock()
+    client.msearch.side_effect = msearch_echo
+    coalescer = MultiSearchCoalescer(window=0.01, max_batch_size=100)
+
+    res = coalescer.search(client, 'index', {'query': {'term': {'n': 7}}, 'size': 0}, doc_type='doc')
+
+    assert res == {'hits': {'total': 7}}
+    assert client.msearch.call_args[1]['body'][0] == {'index': 'index', 'ignore_unavailable': True, 'type': 'doc'}
+
+
+def test_msearch_error_in_one_search():
+    client = mock.Mock()
+
+    def msearch(body):
+        responses = msearch_echo(body)['responses']
+        for i, header in enumerate(body[::2]):
+            if header['index'] == 'index1':
+                responses[i] = {'error': {'type': 'index_not_found_exception'}}
+        return {'responses': responses}
+
+    client.msearch.side_effect = msearch
+    coalescer = MultiSearchCoalescer(window=5, max_batch_size=2)
+
+    results, errors = run_searches(coalescer, client, 2)
+
+    assert results[0] == {'hits': {'total': 0}}
+    assert errors[0] is None
+    assert results[1] is None
+    assert 'index_not_found_exception' in str(errors[1])
+
+
+def test_msearch_request_error_raised_for_every_search():
+    client = mock.Mock()
+    client.msearch.side_effect = ElasticsearchException('connection refused')
+    coalescer = MultiSearchCoalescer(window=5, max_batch_size=2)
+
+    results, errors = run_searches(coalescer, client, 2)
+
+    assert results == [None, None]
+    assert all('connection refused' in str(e) for e in errors)
+
+
+def test_msearch_unexpected_error_does_not_block_batch():
+    client = mock.Mock()
+    client.msearch.side_effect = ValueError('bad response')
+    coalescer = MultiSearchCoalescer(window=0.01)
+
+    with pytest.raises(ElasticsearchException):
+        coalescer.search(client, 'index', {'size': 0})
+
+
+def test_msearch_batches_per_client():
+    client1 = mock.Mock()
+    client1.msearch.side_effect = msearch_echo
+    client2 = mock.Mock()
+    client2.msearch.side_effect = msearch_echo
+    coalescer = MultiSearchCoalescer(window=0.01)
+
+    coalescer.search(client1, 'index', {'query': {'term': {'n': 1}}, 'size': 0})
+    coalescer.search(client2, 'index', {'query': {'term': {'n': 2}}, 'size': 0})
+
+    assert client1.msearch.call_count == 1
+    assert client2.msearch.call_count == 1
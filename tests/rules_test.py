@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import os
 
 import mock
 import pytest
@@ -18,6 +19,8 @@ from elastalert.ruletypes import NewTermsRule
 from elastalert.ruletypes import PercentageMatchRule
 from elastalert.ruletypes import SpikeRule
 from elastalert.ruletypes import WhitelistRule
+from elastalert.state import dumps_state
+from elastalert.state import loads_state
 from elastalert.util import dt_to_ts
 from elastalert.util import EAException
 from elastalert.util import ts_now
@@ -559,6 +562,7 @@ def test_new_term():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         call_args = []
 
         # search is called with a mutable dict containing timestamps, this is required to test
@@ -611,12 +615,159 @@ def test_new_term():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         rule = NewTermsRule(rules)
     rule.add_data([{'@timestamp': ts_now(), 'a': 'key2'}])
     assert len(rule.matches) == 1
     assert rule.matches[0]['missing_field'] == 'b'
 
 
+def test_new_term_baseline(tmpdir):
+    rules = {'name': 'new_term_rule', 'fields': ['a', ['b', 'c']],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'terms_baseline_path': str(tmpdir),
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts}
+    terms = [{'key': 'key1', 'doc_count': 1, 'values': {'buckets': [{'key': 'key2', 'doc_count': 1}]}}]
+
+    # The rules share their client
+    mock_es = mock.Mock()
+    mock_es.info.return_value = {'version': {'number': '2.x.x'}}
+    mock_es.is_atleastsixtwo.return_value = False
+
+    queries = []
+
+    def new_term_rule(buckets, now):
+        mock_res = {'aggregations': {'filtered': {'values': {'buckets': buckets}}}}
+        # search is called with a mutable dict containing timestamps
+        mock_es.search.reset_mock()
+        mock_es.search.side_effect = lambda body, **kwargs: queries.append(copy.deepcopy(body)) or mock_res
+        del queries[:]
+        with mock.patch('elastalert.ruletypes.elasticsearch_client', return_value=mock_es), \
+                mock.patch('elastalert.ruletypes.ts_now', return_value=ts_to_dt(now)):
+            return NewTermsRule(rules)
+
+    rule = new_term_rule(terms, '2021-01-31T00:00:00Z')
+    assert rule.es.search.call_count == 60
+    assert os.listdir(str(tmpdir)) == ['new_term_rule.terms']
+
+    # On restart, only the terms since the baseline are queried
+    rule = new_term_rule([{'key': 'key3', 'doc_count': 1, 'values': {'buckets': [{'key': 'key4', 'doc_count': 1}]}}],
+                         '2021-01-31T12:00:00Z')
+    assert rule.es.search.call_count == 2
+    time_filter = queries[0]['aggs']['filtered']['filter']['bool']['must'][0]['range']
+    assert time_filter['@timestamp']['gte'] == '2021-01-31T00:00:00Z'
+    assert sorted(rule.seen_values['a']) == ['key1', 'key3']
+    assert sorted(rule.seen_values[('b', 'c')]) == [('key1', 'key2'), ('key3', 'key4')]
+
+    # The terms of the baseline not seen within terms_window_size are forgotten
+    rule = new_term_rule([], '2021-03-02T06:00:00Z')
+    time_filter = queries[0]['aggs']['filtered']['filter']['bool']['must'][0]['range']
+    assert time_filter['@timestamp']['gte'] == '2021-01-31T12:00:00Z'
+    assert list(rule.seen_values['a']) == ['key3']
+    assert list(rule.seen_values[('b', 'c')]) == [('key3', 'key4')]
+
+    # A baseline older than terms_window_size is queried again
+    rule = new_term_rule(terms, '2021-04-30T12:00:00Z')
+    assert rule.es.search.call_count == 60
+    assert list(rule.seen_values['a']) == ['key1']
+
+    # So is the baseline of other fields
+    rules['fields'] = ['a']
+    rule = new_term_rule(terms, '2021-04-30T13:00:00Z')
+    assert rule.es.search.call_count == 30
+
+
+def test_new_term_composite_paging():
+    rules = {'fields': ['a', ['b', 'c']],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'terms_window_size': {'days': 1}, 'terms_page_size': 2,
+             'filter': [{'term': {'d': 'e'}}],
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts}
+    pages = {'a.keyword': [[{'a': 'key1'}, {'a': 'key2'}], [{'a': 'key3'}]],
+             'b.keyword': [[{'b': 'key1', 'c': 'key2'}, {'b': 'key1', 'c': 'key3'}], []]}
+    queries = []
+
+    def search(body, **kwargs):
+        queries.append(copy.deepcopy(body))
+        composite = body['aggs']['values']['composite']
+        keys = pages[composite['sources'][0][next(iter(composite['sources'][0]))]['terms']['field']]
+        keys = keys[1] if 'after' in composite else keys[0]
+        return {'aggregations': {'values': {'buckets': [{'key': key, 'doc_count': 1} for key in keys],
+                                            'after_key': keys[-1] if keys else None}}}
+
+    with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
+        mock_es.return_value = mock.Mock()
+        mock_es.return_value.search.side_effect = search
+        mock_es.return_value.info.return_value = {'version': {'number': '7.10.2'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = True
+        rule = NewTermsRule(rules)
+
+    # Both fields take two pages
+    assert len(queries) == 4
+    assert queries[0]['query']['bool']['filter'][1] == {'term': {'d': 'e'}}
+    assert queries[0]['aggs']['values']['composite']['size'] == 2
+    assert queries[1]['aggs']['values']['composite']['after'] == {'a': 'key2'}
+    assert queries[2]['aggs']['values']['composite']['sources'] == [{'b': {'terms': {'field': 'b.keyword'}}},
+                                                                    {'c': {'terms': {'field': 'c.keyword'}}}]
+    assert sorted(rule.seen_values['a']) == ['key1', 'key2', 'key3']
+    assert sorted(rule.seen_values[('b', 'c')]) == [('key1', 'key2'), ('key1', 'key3')]
+
+    rule.add_data([{'@timestamp': ts_now(), 'a': 'key3', 'b': 'key1', 'c': 'key4'}])
+    assert len(rule.matches) == 1
+    assert rule.matches[0]['new_field'] == ('b', 'c')
+
+
+def test_new_term_max_seen_terms(tmpdir):
+    rules = {'name': 'new_term_rule', 'fields': ['a', ['b', 'c']],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'terms_window_size': {'days': 2}, 'max_seen_terms': 2,
+             'terms_baseline_path': str(tmpdir),
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts}
+    mock_res = {'aggregations': {'filtered': {'values': {'buckets': [
+        {'key': 'key1', 'doc_count': 1, 'values': {'buckets': [{'key': 'key2', 'doc_count': 1}]}}]}}}}
+
+    def new_term_rule():
+        with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es, \
+                mock.patch('elastalert.ruletypes.ts_now', return_value=ts_to_dt('2021-01-03T00:00:00Z')):
+            mock_es.return_value = mock.Mock()
+            mock_es.return_value.search.return_value = mock_res
+            mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+            mock_es.return_value.is_atleastsixtwo.return_value = False
+            return NewTermsRule(rules)
+
+    rule = new_term_rule()
+    assert rule.num_seen_terms == 2
+    assert rule.seen_values['a'] == {'key1': ts_to_dt('2021-01-03T00:00:00Z')}
+    size = rule.seen_terms_bytes
+    assert size > 0
+
+    rule.add_data([{'@timestamp': ts_to_dt('2021-01-03T01:00:00Z'), 'a': 'key2'},
+                   {'@timestamp': ts_to_dt('2021-01-03T02:00:00Z'), 'a': 'key1'}])
+    assert [match['a'] for match in rule.matches] == ['key2']
+    assert rule.seen_terms_bytes > size
+
+    # Past max_seen_terms, the least recently seen term is forgotten
+    rule.add_data([{'@timestamp': ts_to_dt('2021-01-03T03:00:00Z'), 'a': 'key3'}])
+    assert list(rule.seen_values['a']) == ['key1', 'key3']
+    assert rule.evicted_terms == 1
+
+    # So are the terms not seen within terms_window_size
+    rule.garbage_collect(ts_to_dt('2021-01-05T02:30:00Z'))
+    assert list(rule.seen_values['a']) == ['key3']
+    assert rule.seen_values[('b', 'c')] == {}
+    assert rule.seen_terms_bytes < size
+
+    # The baseline keeps the time the terms were last seen
+    rule.save_terms_baseline(ts_to_dt('2021-01-03T00:00:00Z'))
+    rule.es.search.reset_mock()
+    rule = new_term_rule()
+    assert rule.es.search.call_count == 0
+    assert rule.seen_values['a'] == {'key3': ts_to_dt('2021-01-03T03:00:00Z')}
+
+
 def test_new_term_nested_field():
 
     rules = {'fields': ['a', 'b.c'],
@@ -629,6 +780,7 @@ def test_new_term_nested_field():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         rule = NewTermsRule(rules)
 
         assert rule.es.search.call_count == 60
@@ -654,6 +806,7 @@ def test_new_term_with_terms():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         rule = NewTermsRule(rules)
 
         # Only 15 queries because of custom step size
@@ -724,6 +877,7 @@ def test_new_term_with_composite_fields():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         rule = NewTermsRule(rules)
 
         assert rule.es.search.call_count == 60
@@ -761,6 +915,7 @@ def test_new_term_with_composite_fields():
         mock_es.return_value = mock.Mock()
         mock_es.return_value.search.return_value = mock_res
         mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        mock_es.return_value.is_atleastsixtwo.return_value = False
         rule = NewTermsRule(rules)
     rule.add_data([{'@timestamp': ts_now(), 'a': 'key2'}])
     assert len(rule.matches) == 2
@@ -942,6 +1097,38 @@ def test_cardinality_max():
         assert len(rule.matches) == 0
 
 
+@pytest.mark.parametrize('rule_type, rules', [
+    (FrequencyRule, {'num_events': 10, 'timeframe': datetime.timedelta(seconds=20), 'query_key': 'user'}),
+    (FlatlineRule, {'threshold': 25, 'timeframe': datetime.timedelta(seconds=30)}),
+    (SpikeRule, {'spike_height': 2, 'spike_type': 'up', 'timeframe': datetime.timedelta(seconds=10)}),
+    (CardinalityRule, {'max_cardinality': 12, 'cardinality_field': 'user', 'timeframe': datetime.timedelta(minutes=10)}),
+])
+def test_rule_state(rule_type, rules):
+    rules['timestamp_field'] = '@timestamp'
+    events = hits(40)
+    for i, event in enumerate(events):
+        event['user'] = 'user%s' % (i % 15)
+    # Double the rate of events after the first 30 seconds
+    events += [create_event(event['@timestamp'] + datetime.timedelta(milliseconds=1), user='user0') for event in events[30:]]
+    events.sort(key=lambda event: event['@timestamp'])
+
+    uninterrupted = rule_type(copy.deepcopy(rules))
+    uninterrupted.add_data(copy.deepcopy(events[:20]))
+    state = loads_state(dumps_state(uninterrupted.get_state()))
+    uninterrupted.matches = []
+
+    # A rule restored from the state matches like a rule that kept running
+    restored = rule_type(copy.deepcopy(rules))
+    restored.set_state(state)
+    for rule in (uninterrupted, restored):
+        rule.add_data(copy.deepcopy(events[20:]))
+        rule.garbage_collect(events[-1]['@timestamp'] + datetime.timedelta(seconds=20))
+    assert uninterrupted.matches
+    assert restored.matches == uninterrupted.matches
+
+    assert AnyRule({}).get_state() is None
+
+
 def test_cardinality_min():
     rules = {'min_cardinality': 4,
              'timeframe': datetime.timedelta(minutes=10),
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from elastalert.scheduling import RuleScheduler
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def noop():
+    pass
+
+
+def test_rule_scheduler_order():
+    clock = Clock()
+    scheduler = RuleScheduler(max_threads=10, clock=clock)
+    scheduler.add('report', noop, [], 60, priority=1, next_run=900)
+    scheduler.add('slow', noop, [], 600, next_run=900)
+    scheduler.add('fast', noop, [], 60, next_run=950)
+    scheduler.add('delayed', noop, [], 60, slack=600, next_run=900)
+    scheduler.add('later', noop, [], 60, next_run=1100)
+
+    # Highest priority class first, then by deadline
+    order = [scheduler._next_job() for _ in range(4)]
+    assert [job.name for job in order] == ['fast', 'slow', 'delayed', 'report']
+    assert order[0].lag == 50
+    assert scheduler._next_job() is None
+    assert scheduler._timeout() == 100
+
+
+def test_rule_scheduler_dropped_runs():
+    clock = Clock()
+    scheduler = RuleScheduler(clock=clock)
+    scheduler.add('rule', noop, [], 60, next_run=1000)
+    job = scheduler._next_job()
+    assert job.runs == 1
+
+    # A run which finishes before the next one is due drops nothing
+    clock.now = 1030
+    scheduler._finish(job)
+    assert job.due == 1060
+    assert scheduler._next_job() is None
+
+    clock.now = 1060
+    job = scheduler._next_job()
+    # The runs due at 1120 and 1180 are overtaken by the one due at 1240
+    clock.now = 1250
+    scheduler._finish(job)
+    assert job.dropped_runs == 2
+    assert job.due == 1240
+    assert scheduler._next_job() is job
+    assert job.lag == 10
+
+
+def test_rule_scheduler_reserved_threads():
+    clock = Clock()
+    scheduler = RuleScheduler(max_threads=2, reserved_threads=1, clock=clock)
+    scheduler.add('scroll', noop, [], 60, priority=1, next_run=900)
+    scheduler.add('other scroll', noop, [], 60, priority=1, next_run=900)
+    assert scheduler._next_job().name == 'scroll'
+    scheduler._busy = 1
+    # The last thread is kept for the highest priority class
+    assert scheduler._next_job() is None
+    scheduler.add('page', noop, [], 60, next_run=950)
+    assert scheduler._next_job().name == 'page'
+
+
+def test_rule_scheduler_reschedule_and_remove():
+    clock = Clock()
+    scheduler = RuleScheduler(clock=clock)
+    scheduler.add('rule', noop, [], 60, next_run=1000)
+    scheduler.reschedule('rule', 2000)
+    assert scheduler._next_job() is None
+
+    clock.now = 2000
+    job = scheduler._next_job()
+    # Rescheduled while running, the next run is due then
+    scheduler.reschedule('rule', 5000)
+    scheduler._finish(job)
+    assert job.due == 5000
+
+    scheduler.remove('rule')
+    clock.now = 5000
+    assert scheduler._next_job() is None
+    assert scheduler.get_job('rule') is None
+
+
+def test_rule_scheduler_runs_rules():
+    ran = threading.Event()
+    scheduler = RuleScheduler(max_threads=2)
+    scheduler.add('rule', ran.set, [], 60)
+    scheduler.start()
+    try:
+        assert ran.wait(5)
+    finally:
+        scheduler.shutdown(5)
+    assert scheduler.get_job('rule').runs == 1
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+
+import pytest
+
+from elastalert.spool import WritebackSpool
+
+
+def test_spool_append_and_replay(tmpdir):
+    spool = WritebackSpool(str(tmpdir), max_size=10000, segment_size=200)
+    ids = spool.append([(None, 'silence', None, {'rule_name': 'a', 'until': datetime.datetime(2021, 1, 1)}),
+                        ('wb', None, 'id2', {'rule_name': 'b'})])
+    assert ids[1] == 'id2'
+    spool.append([(None, 'elastalert_status', None, {'n': i}) for i in range(10)])
+    assert spool
+    assert spool.spooled == 12
+    assert len(os.listdir(str(tmpdir))) == 2
+
+    sent = []
+    assert spool.replay(lambda documents: sent.extend(documents), batch_size=5) == 12
+    assert sent[0] == (None, 'silence', ids[0], {'rule_name': 'a', 'until': '2021-01-01T00:00:00'})
+    assert sent[1] == ('wb', None, 'id2', {'rule_name': 'b'})
+    assert [document[3] for document in sent[2:]] == [{'n': i} for i in range(10)]
+    assert not spool
+    assert spool.size == 0
+    assert spool.replayed == 12
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_spool_survives_restart(tmpdir):
+    spool = WritebackSpool(str(tmpdir))
+    spool.append([(None, 'elastalert', 'id1', {'rule_name': 'a'})])
+    spool.close()
+    # A crash cut the last line short
+    with open(os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0]), 'ab') as f:
+        f.write(b'{"index": nu')
+
+    spool = WritebackSpool(str(tmpdir))
+    assert spool.size > 0
+    sent = []
+    assert spool.replay(sent.extend) == 1
+    assert sent == [(None, 'elastalert', 'id1', {'rule_name': 'a'})]
+
+
+def test_spool_replay_error_keeps_documents(tmpdir):
+    spool = WritebackSpool(str(tmpdir), segment_size=1)
+    spool.append([(None, 'elastalert', 'id1', {'n': 1})])
+    spool.append([(None, 'elastalert', 'id2', {'n': 2})])
+
+    def send(documents):
+        if documents[0][2] == 'id2':
+            raise ValueError('unavailable')
+
+    with pytest.raises(ValueError):
+        spool.replay(send)
+    assert spool.replayed == 1
+    assert len(os.listdir(str(tmpdir))) == 1
+
+    # New documents are spooled after the ones still waiting
+    spool.append([(None, 'elastalert', 'id3', {'n': 3})])
+    sent = []
+    assert spool.replay(sent.extend) == 2
+    assert [document[2] for document in sent] == ['id2', 'id3']
+
+
+def test_spool_max_size(tmpdir):
+    spool = WritebackSpool(str(tmpdir), max_size=300, segment_size=100)
+    for i in range(20):
+        spool.append([(None, 'elastalert_status', 'id%s' % (i), {'n': i})])
+    assert spool.size <= 300 + 100
+    assert spool.dropped > 0
+    sent = []
+    spool.replay(sent.extend)
+    assert sent[-1][2] == 'id19'
+    assert len(sent) + spool.dropped == 20
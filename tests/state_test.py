@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+
+import mock
+import pytest
+from elasticsearch.exceptions import NotFoundError
+
+from elastalert.state import dumps_state
+from elastalert.state import FileRuleStateStore
+from elastalert.state import loads_state
+from elastalert.state import STATE_PREFIX
+from elastalert.state import WritebackRuleStateStore
+from elastalert.util import ts_to_dt
+
+
+def test_dumps_and_loads_state():
+    ts = ts_to_dt('2021-01-01T00:00:00Z')
+    state = {'windows': [['key', [[{'@timestamp': ts, 'user': 'a'}, 1]]], [5, []]], 'filled': True}
+    assert loads_state(dumps_state(state)) == state
+
+    with pytest.raises(TypeError):
+        dumps_state({'value': object()})
+    with pytest.raises(ValueError):
+        loads_state(b'not a state')
+
+
+def test_file_rule_state_store(tmpdir):
+    store = FileRuleStateStore(str(tmpdir))
+    assert store.load('my/rule') is None
+    store.save('my/rule', b'state')
+    store.save('my/rule', b'new state')
+    assert store.load('my/rule') == b'new state'
+    assert os.listdir(str(tmpdir)) == ['my%2Frule.state']
+
+
+def test_writeback_rule_state_store():
+    writeback_es = mock.Mock()
+    writeback_es.resolve_writeback_index.return_value = 'wb_status'
+    writeback_es.is_atleastsixtwo.return_value = True
+    store = WritebackRuleStateStore(writeback_es, 'wb')
+    store.save('rule', b'state')
+    body = writeback_es.index.call_args[1]['body']
+    assert writeback_es.index.call_args[1]['id'] == STATE_PREFIX + 'rule'
+    assert body['rule_name'] == STATE_PREFIX + 'rule'
+
+    writeback_es.get.return_value = {'_source': body}
+    assert store.load('rule') == b'state'
+    writeback_es.get.assert_called_with(index='wb_status', id=STATE_PREFIX + 'rule')
+
+    writeback_es.get.side_effect = NotFoundError(404, 'not found')
+    assert store.load('rule') is None
@@ -4,9 +4,13 @@ from datetime import timedelta
 
 import mock
 import pytest
+import pytz
 from dateutil.parser import parse as dt
+from elasticsearch.exceptions import TransportError
 
 from elastalert.util import add_raw_postfix
+from elastalert.util import compile_es_key
+from elastalert.util import ElasticSearchClientPool
 from elastalert.util import dt_to_ts_with_format
 from elastalert.util import flatten_dict
 from elastalert.util import format_index
@@ -18,6 +22,7 @@ from elastalert.util import replace_dots_in_field_names
 from elastalert.util import resolve_string
 from elastalert.util import set_es_key
 from elastalert.util import should_scrolling_continue
+from elastalert.util import ts_to_dt
 from elastalert.util import ts_to_dt_with_format
 
 
@@ -128,6 +133,25 @@ def test_looking_up_arrays(ea):
     assert lookup_es_key(record, 'objects[1]foo[0]baz') is None
 
 
+def test_compile_es_key():
+    records = [
+        {'Fields': {'ts': 'one', 'ts.value': 2, 'null': None}, 'Fields.user': 'jimmay'},
+        {'foo.bar': {'bar': 'ray'}, 'foo': {'baz': 3}},
+        {'flags': [1, 2, 3],
+         'objects': [{'foo': 'bar'}, {'foo': [{'bar': 'baz'}]}, {'foo': {'bar': 'baz'}}]},
+        {},
+    ]
+    terms = ['Fields.ts', 'Fields.ts.value', 'Fields.null.foo', 'Fields.user', 'Fields.missing', 'foo.bar',
+             'foo.baz', 'flags[0]', 'flags[3]', 'objects[0]foo', 'objects[1]foo[0]bar', 'objects[2]foo.bar',
+             'objects[1]foo[1]bar', 'objects[1]foo[0]baz', 'missing[0]']
+    for term in terms:
+        get_term = compile_es_key(term)
+        for record in records:
+            assert get_term(record) == lookup_es_key(record, term), term
+    assert compile_es_key('foo.bar')(records[1]) == {'bar': 'ray'}
+    assert compile_es_key(None)(records[0]) is None
+
+
 def test_add_raw_postfix(ea):
     expected = 'foo.raw'
     assert add_raw_postfix('foo', False) == expected
@@ -234,6 +258,39 @@ def test_should_scrolling_continue():
     assert should_scrolling_continue(rule_over_max_scrolling) is False
 
 
+@pytest.mark.parametrize('timestamp', [
+    '2014-09-26T12:34:45Z',
+    '2014-09-26T12:34:45.123Z',
+    '2014-09-26T12:34:45.123456789Z',
+    '2014-09-26T12:34:45',
+    '2014-09-26 12:34:45.5',
+    '2014-09-26T12:34:45+02:00',
+    '2014-09-26T12:34:45.001-0530',
+    '2014-09-26T12:34:45+00:00',
+    '2014-09-26',
+    'Sep 26 2014 12:34:45',
+])
+def test_ts_to_dt(timestamp):
+    expected = dt(timestamp)
+    if expected.tzinfo is None:
+        expected = expected.replace(tzinfo=pytz.utc)
+    actual = ts_to_dt(timestamp)
+    assert actual == expected
+    assert actual.utcoffset() == expected.utcoffset()
+
+
+def test_ts_to_dt_invalid():
+    for timestamp in ['2014-13-13T00:00:00Z', '2014-11-24T30:00:00', 'Not A Timestamp']:
+        with pytest.raises(ValueError):
+            ts_to_dt(timestamp)
+
+
+def test_ts_to_dt_matches_dateutil():
+    start = datetime(2014, 9, 26, 12, 34, 45, 123000)
+    timestamps = [(start + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z' for i in range(10000)]
+    assert [ts_to_dt(ts) for ts in timestamps] == [dt(ts) for ts in timestamps]
+
+
 def test_ts_to_dt_with_format():
     assert ts_to_dt_with_format('2021/02/01 12:30:00', '%Y/%m/%d %H:%M:%S') == dt('2021-02-01 12:30:00+00:00')
     assert ts_to_dt_with_format('01/02/2021 12:30:00', '%d/%m/%Y %H:%M:%S') == dt('2021-02-01 12:30:00+00:00')
@@ -251,3 +308,80 @@ def test_flatten_dict():
 def test_pytzfy():
     assert pytzfy(dt('2021-02-01 12:30:00+00:00')) == dt('2021-02-01 12:30:00+00:00')
     assert pytzfy(datetime(2018, 12, 31, 5, 0, 30, 1000)) == dt('2018-12-31 05:00:30.001000')
+
+
+def test_es_client_pool_shares_clients_with_same_connection_settings(environ):
+    environ.pop('ES_HOST', None)
+    environ.pop('ES_PORT', None)
+    pool = ElasticSearchClientPool()
+    factory = mock.Mock(side_effect=lambda conf: object())
+    client1 = pool.get({'name': 'rule1', 'es_host': 'es', 'es_port': 9200}, factory)
+    client2 = pool.get({'name': 'rule2', 'es_host': 'es', 'es_port': 9200}, factory)
+    client3 = pool.get({'name': 'rule3', 'es_host': 'es', 'es_port': 9200, 'es_username': 'u', 'es_password': 'p'}, factory)
+
+    assert client1 is client2
+    assert client1 is not client3
+    assert factory.call_count == 2
+    assert len(pool) == 2
+
+    stats = pool.stats()
+    assert stats['clients'] == 2
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert sorted(p['rules'] for p in stats['pools']) == [1, 2]
+
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_es_client_pool_release_unused(environ):
+    environ.pop('ES_HOST', None)
+    environ.pop('ES_PORT', None)
+    pool = ElasticSearchClientPool()
+    confs = [{'name': 'rule1', 'es_host': 'es', 'es_port': 9200},
+             {'name': 'rule2', 'es_host': 'es', 'es_port': 9200},
+             {'name': 'rule3', 'es_host': 'other', 'es_port': 9200}]
+
+    def factory(conf):
+        client = mock.Mock()
+        client.transport.connection_pool.connections = []
+        return client
+
+    clients = [pool.get(conf, factory) for conf in confs]
+
+    assert pool.release_unused(confs) == []
+    # rule3 now connects with other settings, rule2 was removed
+    confs = [confs[0], {'name': 'rule3', 'es_host': 'other', 'es_port': 9200, 'es_username': 'u', 'es_password': 'p'}]
+    pool.get(confs[1], factory)
+    assert pool.release_unused(confs) == [clients[2]]
+    clients[2].transport.close.assert_called_once_with()
+    assert not clients[0].transport.close.called
+    assert len(pool) == 2
+    assert [p['rules'] for p in pool.stats()['pools']] == [1, 1]
+
+
+def test_es_client_pool_probe_asks_each_cluster_once(environ):
+    environ.pop('ES_HOST', None)
+    environ.pop('ES_PORT', None)
+
+    class VersionedClient(object):
+        def __init__(self, conf):
+            self.info_calls = 0
+            self.host = conf['es_host']
+
+        @property
+        def es_version(self):
+            self.info_calls += 1
+            if self.host == 'down':
+                raise TransportError('N/A', 'unreachable')
+            return '7.10.2'
+
+    pool = ElasticSearchClientPool()
+    confs = [{'name': 'rule%s' % i, 'es_host': 'es', 'es_port': 9200} for i in range(5)]
+    confs.append({'name': 'other', 'es_host': 'down', 'es_port': 9200})
+    versions = pool.probe(confs, VersionedClient)
+
+    assert versions == {('es', 9200): '7.10.2', ('down', 9200): None}
+    assert len(pool) == 2
+    assert pool.get(confs[0]).info_calls == 1
+    assert pool.get(confs[-1]).info_calls == 1
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from elastalert.util import EAException
+from elastalert.workers import rule_partition
+from elastalert.workers import RuleWorkerPool
+
+
+def echo_worker(args, index, count, tasks, results):
+    """ Stands in for run_rule_worker, answering each task with what it was asked. """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] in ('reload', 'reset'):
+            continue
+        _, request_id, rule_name, endtime, starttime = task
+        results.put(('started', request_id))
+        if rule_name == 'broken':
+            results.put((request_id, None, ('EAException', 'broken rule')))
+            continue
+        if rule_name == 'crash':
+            os._exit(1)
+        if rule_name == 'hang':
+            time.sleep(60)
+        if rule_name == 'slow':
+            time.sleep(0.7)
+        results.put((request_id, {'rule_name': rule_name, 'index': index, 'args': args, 'endtime': endtime}, None))
+
+
+def test_rule_partition():
+    assert rule_partition('rule', 4) == rule_partition('rule', 4)
+    assert set(rule_partition('rule %s' % (i), 4) for i in range(100)) == set(range(4))
+
+
+def test_rule_worker_pool():
+    pool = RuleWorkerPool(['--verbose'], 2, worker=echo_worker)
+    try:
+        for name in ['a', 'b', 'c']:
+            result = pool.run(name, 10)
+            assert result == {'rule_name': name, 'index': rule_partition(name, 2), 'args': ['--verbose'], 'endtime': 10}
+
+        pool.reload()
+        with pytest.raises(EAException):
+            pool.run('broken', 10)
+    finally:
+        pool.close()
+    assert not any(process.is_alive() for process in pool.processes)
+
+
+def test_rule_worker_pool_restarts_workers():
+    pool = RuleWorkerPool(['--verbose'], 1, worker=echo_worker, watch_interval=0.1)
+    try:
+        # The requests of a worker which exits fail, and it is started again
+        process = pool.processes[0]
+        with pytest.raises(EAException):
+            pool.run('crash', 10, timeout=30)
+        assert pool.processes[0] is not process
+        assert pool.run('a', 10)['rule_name'] == 'a'
+
+        # So are those of a worker which does not answer in time
+        process = pool.processes[0]
+        with pytest.raises(EAException):
+            pool.run('hang', 10, timeout=1)
+        assert not process.is_alive()
+        assert pool.run('a', 10)['rule_name'] == 'a'
+    finally:
+        pool.close()
+
+
+def test_rule_worker_pool_timeout_starts_with_request():
+    pool = RuleWorkerPool(['--verbose'], 1, worker=echo_worker, watch_interval=0.1)
+    try:
+        # Together the two requests take longer than the timeout, but neither does on its own
+        process = pool.processes[0]
+        futures = [pool.submit('slow', 10, timeout=1) for _ in range(2)]
+        assert [future.result(30)['rule_name'] for future in futures] == ['slow', 'slow']
+        assert pool.processes[0] is process
+        assert process.is_alive()
+    finally:
+        pool.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+from elasticsearch.exceptions import ElasticsearchException
+
+from elastalert.writeback import WritebackQueue
+
+
+def bulk_ok(body):
+    return {'errors': False, 'items': [{'index': {'_id': action['index']['_id'], 'status': 201}} for action in body[::2]]}
+
+
+def test_writeback_queue_flush():
+    client = mock.Mock()
+    client.bulk.side_effect = bulk_ok
+    queue = WritebackQueue(client, bulk_size=100, flush_interval=60)
+
+    res1 = queue.add('elastalert_status', {'rule_name': 'a'})
+    res2 = queue.add('elastalert', {'rule_name': 'b'}, doc_type='elastalert')
+    assert res1['_id'] != res2['_id']
+    assert res1['result'] == 'queued'
+    assert len(queue) == 2
+    assert not client.bulk.called
+
+    assert queue.flush() == []
+    body = client.bulk.call_args[1]['body']
+    assert body == [{'index': {'_index': 'elastalert_status', '_id': res1['_id']}}, {'rule_name': 'a'},
+                    {'index': {'_index': 'elastalert', '_id': res2['_id'], '_type': 'elastalert'}}, {'rule_name': 'b'}]
+    assert len(queue) == 0
+    assert queue.documents == 2
+    assert queue.requests == 1
+
+    # Nothing to send
+    assert queue.flush() == []
+    assert queue.requests == 1
+    queue.close()
+
+
+def test_writeback_queue_flushes_when_full():
+    client = mock.Mock()
+    flushed = threading.Event()
+
+    def bulk(body):
+        flushed.set()
+        return bulk_ok(body)
+
+    client.bulk.side_effect = bulk
+    queue = WritebackQueue(client, bulk_size=3, flush_interval=60)
+    for i in range(3):
+        queue.add('elastalert_status', {'n': i})
+
+    assert flushed.wait(5)
+    assert len(client.bulk.call_args[1]['body']) == 6
+    queue.close()
+
+
+def test_writeback_queue_flushes_after_interval():
+    client = mock.Mock()
+    flushed = threading.Event()
+
+    def bulk(body):
+        flushed.set()
+        return bulk_ok(body)
+
+    client.bulk.side_effect = bulk
+    queue = WritebackQueue(client, bulk_size=100, flush_interval=0.01)
+    queue.add('elastalert_status', {'n': 1})
+
+    assert flushed.wait(5)
+    queue.close()
+
+
+def test_writeback_queue_close_flushes():
+    client = mock.Mock()
+    client.bulk.side_effect = bulk_ok
+    queue = WritebackQueue(client, bulk_size=100, flush_interval=60)
+    queue.add('elastalert_status', {'n': 1})
+
+    assert queue.close() == []
+    assert client.bulk.call_count == 1
+    assert not queue._thread.is_alive()
+
+
+def test_writeback_queue_errors():
+    client = mock.Mock()
+    queue = WritebackQueue(client, bulk_size=100, flush_interval=60)
+    res1 = queue.add('elastalert_status', {'n': 1})
+    queue.add('elastalert_status', {'n': 2})
+
+    def bulk(body):
+        res = bulk_ok(body)
+        res['errors'] = True
+        res['items'][0]['index']['error'] = {'type': 'mapper_parsing_exception'}
+        return res
+
+    client.bulk.side_effect = bulk
+    assert queue.flush() == [({'index': {'_index': 'elastalert_status', '_id': res1['_id']}}, {'n': 1})]
+    assert queue.documents == 1
+
+    queue.add('elastalert_status', {'n': 3})
+    client.bulk.side_effect = ElasticsearchException('Nope')
+    assert [pair[1] for pair in queue.flush()] == [{'n': 3}]
+    queue.close()
+
+
+def test_writeback_queue_on_error():
+    client = mock.Mock()
+    on_error = mock.Mock()
+    queue = WritebackQueue(client, bulk_size=100, flush_interval=60, on_error=on_error)
+    queue.add('elastalert_status', {'n': 1})
+    queue.add('elastalert_status', {'n': 2})
+
+    def bulk(body):
+        res = bulk_ok(body)
+        res['errors'] = True
+        res['items'][0]['index'].update({'status': 400, 'error': {'type': 'mapper_parsing_exception'}})
+        res['items'][1]['index'].update({'status': 503, 'error': {'type': 'unavailable_shards_exception'}})
+        return res
+
+    client.bulk.side_effect = bulk
+    assert len(queue.flush()) == 2
+    # Only the document which may be written later is handed on
+    assert [pair[1] for pair in on_error.call_args[0][0]] == [{'n': 2}]
+
+    queue.add('elastalert_status', {'n': 3})
+    client.bulk.side_effect = ElasticsearchException('Nope')
+    queue.flush()
+    assert [pair[1] for pair in on_error.call_args[0][0]] == [{'n': 3}]
+    queue.close()